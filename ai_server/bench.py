@@ -0,0 +1,237 @@
+"""Offline micro-benchmarks for the pure-Python hot paths: dice, reply formatting, context, session codec (no API calls).
+
+    python bench.py                               # 전체 실행
+    python bench.py --filter dice                 # 이름에 'dice'가 들어간 케이스만
+    python bench.py --sizes 100,10000             # synthetic session 크기 지정
+    python bench.py --save bench_baseline.json    # 결과를 baseline으로 저장
+    python bench.py --compare bench_baseline.json # baseline 대비 비교, 느려진 케이스가 있으면 exit 1
+
+각 케이스는 한 번 호출에 걸리는 시간(µs)을 repeat번 측정해 median/min을 보고한다.
+세션 파일·캐시는 임시 디렉터리에 쓰고 끝나면 지운다.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+_TMP = Path(tempfile.mkdtemp(prefix="trpg-bench-"))
+# main import 전에 설정: API 키 없이도 import 되도록, 캐시/메모리는 임시 디렉터리로
+os.environ.setdefault("OPENAI_API_KEY", "bench-offline")
+os.environ.setdefault("MEMORY_BACKEND", "local")
+os.environ.setdefault("CHROMA_DIR", str(_TMP / "chroma"))
+os.environ.setdefault("EMBED_CACHE_DIR", str(_TMP / "embeddings"))
+os.environ.setdefault("SESSION_FSYNC", "false")
+
+sys.path.insert(0, str(Path(__file__).parent))
+import numpy as np  # noqa: E402
+import main  # noqa: E402
+import dice  # noqa: E402
+import models  # noqa: E402
+import stores  # noqa: E402
+
+stores.SESS_DIR = _TMP / "sessions"
+stores.SESS_DIR.mkdir(parents=True, exist_ok=True)
+
+# ==========================
+# Corpus
+# ==========================
+PLAYER_INPUTS = [
+    "문을 천천히 열고 안쪽을 살핀다",
+    "단검으로 경비병의 옆구리를 찌른다 2d6+1",
+    "소총을 들어 창문 너머의 그림자를 조준한다",
+    "정신력 판정 (45) 굴려볼게",
+    "공포에 질려 뒤로 물러선다",
+    "근력으로 철문을 들어올리려 한다 [60%]",
+    "상인과 가격을 협상한다. 설득 체크 70",
+    "d20 로 관찰 판정",
+    "벽을 타고 등반해서 지붕으로 올라간다",
+    "말없이 주변 사람들의 표정을 관찰한다",
+    "4d6kh3 로 능력치를 굴린다",
+    "권총을 쏜다! 명중했나?",
+    "어두운 복도를 달려 계단 쪽으로 도망친다",
+    "악몽에서 깨어나 식은땀을 닦는다",
+    "운전대를 꺾어 골목으로 들어간다 회피 판정 55",
+    "그 편지를 다시 읽어본다",
+]
+MODEL_REPLIES = [
+    "사회자: 문이 삐걱거리며 열린다. 안쪽에는 먼지 쌓인 책상과 꺼진 램프가 있다.",
+    "GM: 경비병이 비명을 지르며 쓰러진다.\nNPC: 누, 누구냐!",
+    "**플레이어:** 잠깐, 저기 뭔가 움직였어.",
+    "사회자 : 바람이 창문을 흔든다. 멀리서 개 짖는 소리가 들린다. 당신은 이상한 냄새를 맡는다.",
+    "ENEMY: 크크크… 여기까지 오다니 제법이군.",
+    "상인은 한참을 고민하더니 고개를 끄덕인다. \"좋소, 그 가격에 드리지.\"",
+]
+DICE_EXPRS = ["d20", "2d6+1", "3d4-2", "d100", "4d6kh3", "2d20kl1", "2d6+1d4+3", "6d10>=7", "3d6!", "40d6", "1000d6"]
+STORY_CORE = {
+    "world": "현대 서울의 도시 미스터리",
+    "theme": "기이한 실종",
+    "facts": [f"사실 {i}: 실종자는 마지막으로 {i}번 버스를 탔다" for i in range(40)],
+    "relationships": [f"인물{i} ↔ 인물{i + 1}: 오래된 동료" for i in range(20)],
+    "open_threads": [f"미해결 단서 {i}" for i in range(15)],
+}
+CORE_UPDATE = {
+    "facts": STORY_CORE["facts"][-5:] + [f"새 사실 {i}" for i in range(5)],
+    "relationships": ["인물3 ↔ 형사: 의심"],
+    "open_threads": ["지하 창고의 열쇠", "미해결 단서 3"],
+}
+_SPEAKERS = ["사회자", "플레이어(민수)", "플레이어(지연)", "NPC(상인)", "ENEMY(그림자)"]
+
+
+def synthetic_session(n_lines: int, seed: int = 0) -> "models.SessionState":
+    """n_lines 길이의 history를 가진 세션 (실제 대화와 비슷한 길이 분포의 한국어 문장)."""
+    rng = random.Random(seed)
+    texts = PLAYER_INPUTS + [r.split(":", 1)[-1].strip() for r in MODEL_REPLIES]
+    history = [f"{rng.choice(_SPEAKERS)}: {rng.choice(texts)}" for _ in range(n_lines)]
+    outline = [{"act": i, "title": f"{i}막", "summary": "도시 곳곳에서 단서를 모은다"} for i in range(1, 4)]
+    state = models.SessionState(story_core=dict(STORY_CORE), plot_outline=outline, current_act=1, history=history)
+    state.set_persona(models.Persona(role_type="PLAYER", name="민수", traits=["신중함", "호기심"], speech_style="짧고 건조하게"))
+    return state
+
+
+# ==========================
+# Cases
+# ==========================
+def _cycle(fn, items):
+    """Return (callable, ops): one call runs fn over every item."""
+    def run():
+        for x in items:
+            fn(x)
+    return run, len(items)
+
+
+def build_cases(sizes: list[int]) -> dict:
+    cases = {
+        "dice/roll_dice": _cycle(dice.roll_dice, DICE_EXPRS),
+        "dice/infer_roll_from_texts": _cycle(lambda t: dice.infer_roll_from_texts(t, None, STORY_CORE), PLAYER_INPUTS),
+        "dice/_extract_percent_target": _cycle(dice._extract_percent_target, PLAYER_INPUTS),
+        "dice/_contextual_dice_expr": _cycle(lambda t: dice._contextual_dice_expr(t, STORY_CORE), PLAYER_INPUTS),
+        "reply/_normalize_reply": _cycle(main._normalize_reply, MODEL_REPLIES),
+        "core/merge_core": (lambda: models.merge_core(STORY_CORE, CORE_UPDATE), 1),
+    }
+    for n in sizes:
+        # 케이스마다 별도 세션: append 케이스가 history를 늘려도 다른 측정에 섞이지 않게
+        load_sid = f"bench-load-{n}"
+        loaded = synthetic_session(n)
+        stores.save_session(load_sid, loaded)
+        snap_state, append_state, prompt_state = synthetic_session(n), synthetic_session(n), synthetic_session(n)
+        stores.save_session(f"bench-append-{n}", append_state)
+
+        def snapshot(state=snap_state, sid=f"bench-snapshot-{n}"):
+            state._snapshotted = False
+            stores.save_session(sid, state)
+
+        def append(state=append_state, sid=f"bench-append-{n}"):
+            state.add_history("플레이어(민수): 문을 천천히 열고 안쪽을 살핀다")
+            stores.save_session(sid, state)
+
+        def prompt(state=prompt_state):
+            lines, notes = main._select_context(state, main._context_budget("reply", "PLAYER"), ["메모: 실종자는 버스를 탔다"])
+            main._system_prefix(state, "민수", "PLAYER", True)
+            return lines, notes
+
+        payload = {**loaded.model_dump(), "_seq": loaded._seq}
+        blob = stores.encode_snapshot(payload)
+        text = json.dumps(payload, ensure_ascii=False)
+
+        cases[f"session/load_session/{n}"] = (lambda sid=load_sid: stores.load_session(sid), 1)
+        cases[f"codec/json_decode/{n}"] = (lambda text=text: json.loads(text), 1)
+        cases[f"codec/binary_encode/{n}"] = (lambda payload=payload: stores.encode_snapshot(payload), 1)
+        cases[f"codec/binary_decode/{n}"] = (lambda blob=blob: stores.SessionBlob(blob).payload(), 1)
+        cases[f"codec/binary_tail30/{n}"] = (lambda blob=blob: stores.SessionBlob(blob).history_tail(30), 1)
+        cases[f"session/save_snapshot/{n}"] = (snapshot, 1)
+        cases[f"session/save_append/{n}"] = (append, 1)
+        cases[f"prompt/assembly/{n}"] = (prompt, 1)
+    return cases
+
+
+def measure(fn, ops: int, repeat: int, min_time: float) -> dict:
+    """timeit autorange 방식: min_time 이상 걸리도록 loop 수를 정하고 repeat번 측정."""
+    fn()  # warm-up (캐시/lazy 초기화)
+    loops = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        if time.perf_counter() - t0 >= min_time or loops >= 1 << 20:
+            break
+        loops *= 2
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        samples.append((time.perf_counter() - t0) / (loops * ops) * 1e6)
+    return {"median_us": statistics.median(samples), "min_us": min(samples), "loops": loops}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Print ratios against a baseline; returns the names that regressed beyond threshold."""
+    regressed = []
+    base = baseline.get("results", {})
+    print(f"\n{'case':42s} {'baseline':>12s} {'now':>12s} {'ratio':>7s}")
+    for name, r in results.items():
+        b = base.get(name)
+        if not b:
+            print(f"{name:42s} {'-':>12s} {r['median_us']:12.2f} {'new':>7s}")
+            continue
+        ratio = r["median_us"] / b["median_us"] if b["median_us"] else float("inf")
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"{name:42s} {b['median_us']:12.2f} {r['median_us']:12.2f} {ratio:7.2f}{flag}")
+        if flag:
+            regressed.append(name)
+    return regressed
+
+
+def main_cli(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", default="100,10000,100000", help="synthetic session history lengths")
+    ap.add_argument("--filter", default="", help="only run cases whose name contains this")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--min-time", type=float, default=0.2, help="seconds per measurement")
+    ap.add_argument("--save", help="write results as a baseline JSON file")
+    ap.add_argument("--compare", help="baseline JSON file to compare against")
+    ap.add_argument("--threshold", type=float, default=1.25, help="median ratio that counts as a regression")
+    args = ap.parse_args(argv)
+
+    random.seed(1234)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    results = {}
+    try:
+        cases = build_cases(sizes)
+        for name, (fn, ops) in cases.items():
+            if args.filter and args.filter not in name:
+                continue
+            r = measure(fn, ops, args.repeat, args.min_time)
+            results[name] = r
+            print(f"{name:42s} {r['median_us']:12.2f} µs  (min {r['min_us']:.2f}, loops {r['loops']})", flush=True)
+    finally:
+        shutil.rmtree(_TMP, ignore_errors=True)
+
+    if args.save:
+        meta = {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "sizes": sizes,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        Path(args.save).write_text(json.dumps({"meta": meta, "results": results}, indent=2), encoding="utf-8")
+        print(f"\nbaseline saved → {args.save}")
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        regressed = compare(results, baseline, args.threshold)
+        if regressed:
+            print(f"\n{len(regressed)} case(s) slower than {args.threshold:.2f}x baseline")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,576 @@
+"""Dice engine (parser, roller, exact distributions) and roll inference from free-form player input."""
+import functools
+import json
+import os
+import random
+import re
+import time
+from collections import deque
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+# ==========================
+# Dice engine
+# ==========================
+# 표현식은 한 번 파싱해 AST(항 튜플)로 캐시하고, 굴림은 AST만 평가한다.
+# 지원 문법 (대소문자 무시, 공백 무시):
+#   2d6+1d4+3   여러 항의 합/차
+#   d%          d100
+#   4d6kh3      keep highest (kl / dh / dl, 'k' = kh, 'd' = dl)
+#   3d6!        exploding: 최대값이 나오면 다시 굴려 그 주사위에 더한다 (compounding)
+#   6d10>=7     성공 개수 (>=, <=, >, <, =)
+DICE_MAX_COUNT = int(os.getenv("DICE_MAX_COUNT", "10000"))
+DICE_MAX_SIDES = int(os.getenv("DICE_MAX_SIDES", "10000"))
+DICE_NUMPY_MIN = int(os.getenv("DICE_NUMPY_MIN", "64"))       # 이 개수 이상이면 NumPy로 굴린다
+DICE_DETAIL_MAX = 20                                            # detail에 개별 눈을 나열할 최대 개수
+DICE_EXPLODE_MAX = 100                                          # 주사위 하나당 폭발 횟수 상한
+DICE_CHUNK_CELLS = 1 << 20                                      # roll_dice_many가 한 번에 만드는 (행 × 주사위) 수
+
+_DICE_TERM_RE = re.compile(
+    r"([+-])?(?:(\d*)d(\d+|%)(!)?(?:(kh|kl|dh|dl|k|d)(\d+))?(?:(>=|<=|>|<|=)(\d+))?|(\d+))"
+)
+_dice_rng = np.random.default_rng()
+
+
+class DiceTerm(NamedTuple):
+    sign: int
+    count: int
+    sides: int
+    explode: bool = False
+    keep: Optional[str] = None      # "kh" | "kl" | "dh" | "dl"
+    keep_n: int = 0
+    cmp: Optional[str] = None       # 성공 판정 비교자
+    target: int = 0
+
+
+_CMP = {
+    ">=": lambda a, b: a >= b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    "<": lambda a, b: a < b,
+    "=": lambda a, b: a == b,
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_dice(expr: str) -> Optional[tuple]:
+    """Compile a dice expression into a tuple of DiceTerm / int terms.
+    Returns None for anything that is not a valid expression with at least one dice term."""
+    s = (expr or "").replace(" ", "").lower()
+    terms: list = []
+    pos = 0
+    while pos < len(s):
+        m = _DICE_TERM_RE.match(s, pos)
+        if not m or m.end() == pos or (terms and not m.group(1)):
+            return None
+        pos = m.end()
+        sign = -1 if m.group(1) == "-" else 1
+        if m.group(9) is not None:
+            terms.append(sign * int(m.group(9)))
+            continue
+        count = int(m.group(2)) if m.group(2) else 1
+        sides = 100 if m.group(3) == "%" else int(m.group(3))
+        if not (1 <= count <= DICE_MAX_COUNT and 1 <= sides <= DICE_MAX_SIDES):
+            return None
+        keep = m.group(5)
+        keep = {"k": "kh", "d": "dl"}.get(keep, keep)
+        keep_n = int(m.group(6)) if keep else 0
+        if keep and keep_n > count:
+            return None
+        explode = bool(m.group(4)) and sides > 1
+        target = int(m.group(8)) if m.group(7) else 0
+        terms.append(DiceTerm(sign, count, sides, explode, keep, keep_n, m.group(7), target))
+    if not any(isinstance(t, DiceTerm) for t in terms):
+        return None
+    return tuple(terms)
+
+
+def _keep_slice(t: DiceTerm) -> slice:
+    """Slice of the ascending-sorted dice that a keep/drop modifier retains."""
+    if t.keep == "kh":
+        return slice(t.count - t.keep_n, t.count)
+    if t.keep == "kl":
+        return slice(0, t.keep_n)
+    if t.keep == "dh":
+        return slice(0, t.count - t.keep_n)
+    if t.keep == "dl":
+        return slice(t.keep_n, t.count)
+    return slice(0, t.count)
+
+
+def _roll_matrix(t: DiceTerm, n: int) -> np.ndarray:
+    """(n, count) die faces for n independent rolls of one term, explosions included."""
+    rolls = _dice_rng.integers(1, t.sides + 1, size=(n, t.count))
+    if t.explode:
+        live = rolls == t.sides
+        for _ in range(DICE_EXPLODE_MAX):
+            k = int(live.sum())
+            if not k:
+                break
+            extra = _dice_rng.integers(1, t.sides + 1, size=k)
+            rolls[live] += extra
+            live[live] = extra == t.sides
+    return rolls
+
+
+def _reduce_matrix(t: DiceTerm, rolls: np.ndarray) -> np.ndarray:
+    """Per-row value of a rolled term: kept-dice sum or success count."""
+    if t.keep:
+        rolls = np.sort(rolls, axis=1)[:, _keep_slice(t)]
+    if t.cmp:
+        return _CMP[t.cmp](rolls, t.target).sum(axis=1)
+    return rolls.sum(axis=1)
+
+
+def _roll_small(t: DiceTerm) -> list[int]:
+    rolls = [random.randint(1, t.sides) for _ in range(t.count)]
+    if t.explode:
+        for i, r in enumerate(rolls):
+            depth = 0
+            while r == t.sides and depth < DICE_EXPLODE_MAX:
+                r = random.randint(1, t.sides)
+                rolls[i] += r
+                depth += 1
+    return rolls
+
+
+def _eval_term(t: DiceTerm) -> tuple[int, str]:
+    if t.count >= DICE_NUMPY_MIN:
+        rolls = _roll_matrix(t, 1)
+        value = int(_reduce_matrix(t, rolls)[0])
+        shown = rolls[0].tolist() if t.count <= DICE_DETAIL_MAX else None
+    else:
+        rolls = _roll_small(t)
+        kept = sorted(rolls)[_keep_slice(t)] if t.keep else rolls
+        value = sum(1 for r in kept if _CMP[t.cmp](r, t.target)) if t.cmp else sum(kept)
+        shown = rolls if t.count <= DICE_DETAIL_MAX else None
+    text = str(shown) if shown is not None else f"[{t.count}d{t.sides}]"
+    if t.keep:
+        text += f"{t.keep}{t.keep_n}"
+    if t.cmp:
+        text += f"{t.cmp}{t.target}:{value}"
+    return value, text
+
+
+def roll_dice(expr: str) -> tuple[int, str]:
+    # Patterns: "2d6+1", "d20", "3d4-2", "4d6kh3", "2d6+1d4+3", "6d10>=7", "3d6!"
+    terms = parse_dice(expr)
+    if terms is None:
+        raise ValueError(f"Invalid dice expression: {expr}")
+    total = 0
+    detail = ""
+    for i, t in enumerate(terms):
+        if isinstance(t, int):
+            total += t
+            detail += f"{t:+d}"
+            continue
+        value, text = _eval_term(t)
+        total += t.sign * value
+        if t.sign < 0:
+            detail += "-" + text
+        else:
+            detail += ("+" if i else "") + text
+    return total, f"{detail} = {total}"
+
+
+def dice_cells(expr: str) -> int:
+    """Dice rolled per evaluation of expr (repeat × 이 값이 roll_dice_many가 만드는 눈의 수)."""
+    terms = parse_dice(expr)
+    if terms is None:
+        raise ValueError(f"Invalid dice expression: {expr}")
+    return sum(t.count for t in terms if isinstance(t, DiceTerm))
+
+
+def roll_dice_many(expr: str, n: int) -> np.ndarray:
+    """Roll the same expression n times at once; returns an int array of totals.
+    행을 DICE_CHUNK_CELLS 단위로 나눠 굴리므로 임시 행렬 크기는 n과 무관하게 제한된다."""
+    terms = parse_dice(expr)
+    if terms is None:
+        raise ValueError(f"Invalid dice expression: {expr}")
+    totals = np.zeros(n, dtype=np.int64)
+    for t in terms:
+        if isinstance(t, int):
+            totals += t
+            continue
+        step = max(1, DICE_CHUNK_CELLS // t.count)
+        for a in range(0, n, step):
+            b = min(a + step, n)
+            totals[a:b] += t.sign * _reduce_matrix(t, _roll_matrix(t, b - a))
+    return totals
+
+# --- Exact distributions ---
+DICE_DIST_MAX_SUPPORT = int(os.getenv("DICE_DIST_MAX_SUPPORT", "200000"))   # 결과값 범위 상한
+DICE_DIST_MAX_ENUM = int(os.getenv("DICE_DIST_MAX_ENUM", "2000000"))        # keep/drop 전수 조사 상한
+DICE_DIST_TAIL = 1e-12                                                       # exploding 꼬리 확률 절단
+
+
+def _convolve(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    if min(len(a), len(b)) < 512:
+        return np.convolve(a, b)
+    n = len(a) + len(b) - 1
+    size = 1 << (n - 1).bit_length()
+    out = np.fft.irfft(np.fft.rfft(a, size) * np.fft.rfft(b, size), size)[:n]
+    return np.clip(out, 0.0, None)
+
+
+def _pmf_power(pmf: np.ndarray, n: int) -> np.ndarray:
+    """pmf convolved with itself n times (exponentiation by squaring)."""
+    out = np.ones(1)
+    while n:
+        if n & 1:
+            out = _convolve(out, pmf)
+        n >>= 1
+        if n:
+            pmf = _convolve(pmf, pmf)
+    return out
+
+
+def _die_pmf(t: DiceTerm) -> np.ndarray:
+    """PMF of a single die face value (index = value), compounding explosions truncated at DICE_DIST_TAIL."""
+    s = t.sides
+    depth = 0
+    if t.explode:
+        while depth < DICE_EXPLODE_MAX and (1.0 / s) ** (depth + 1) > DICE_DIST_TAIL:
+            depth += 1
+    pmf = np.zeros(s * (depth + 1) + 1)
+    for k in range(depth + 1):
+        w = (1.0 / s) ** (k + 1)
+        pmf[k * s + 1:k * s + s] = w
+        pmf[k * s + s] = w if k == depth else 0.0
+    return pmf / pmf.sum()
+
+
+def _trim(pmf: np.ndarray) -> tuple[int, np.ndarray]:
+    nz = np.flatnonzero(pmf)
+    return int(nz[0]), pmf[nz[0]:nz[-1] + 1]
+
+
+def _term_pmf(t: DiceTerm) -> tuple[int, np.ndarray]:
+    """(min_value, pmf) of one dice term's contribution, before its sign."""
+    lo, die = _trim(_die_pmf(t))
+    if t.keep:
+        faces = np.flatnonzero(die)
+        if len(faces) ** t.count > DICE_DIST_MAX_ENUM:
+            raise ValueError(f"Too many outcomes for an exact keep/drop distribution: {t.count}d{t.sides}")
+        grid = np.stack(np.meshgrid(*([faces] * t.count), indexing="ij"), axis=-1).reshape(-1, t.count)
+        weights = np.prod(die[grid], axis=1)
+        return _trim(np.bincount(_reduce_matrix(t, grid + lo), weights=weights))
+    if t.cmp:
+        p = float(die[_CMP[t.cmp](np.arange(lo, lo + len(die)), t.target)].sum())
+        return _trim(_pmf_power(np.array([1.0 - p, p]), t.count))
+    if t.count * (len(die) - 1) > DICE_DIST_MAX_SUPPORT:
+        raise ValueError(f"Distribution too wide: {t.count}d{t.sides}")
+    return lo * t.count, _pmf_power(die, t.count)
+
+
+@functools.lru_cache(maxsize=1024)
+def _distribution(const: int, dice: tuple) -> tuple[int, np.ndarray]:
+    offset, pmf = const, np.ones(1)
+    for t in dice:
+        lo, term = _term_pmf(t)
+        if t.sign < 0:
+            term = term[::-1]
+            lo = -(lo + len(term) - 1)
+        offset += lo
+        pmf = _convolve(pmf, term)
+        if len(pmf) > DICE_DIST_MAX_SUPPORT:
+            raise ValueError("Distribution too wide")
+    pmf = pmf / pmf.sum()
+    pmf.setflags(write=False)
+    return offset, pmf
+
+
+def dice_distribution(expr: str) -> tuple[int, np.ndarray]:
+    """Exact distribution of an expression as (min_value, pmf); pmf[i] = P(total == min_value + i).
+    Memoised per normalised expression (term order and spacing do not matter); the array is read-only."""
+    terms = parse_dice(expr)
+    if terms is None:
+        raise ValueError(f"Invalid dice expression: {expr}")
+    const = sum(t for t in terms if isinstance(t, int))
+    dice = tuple(sorted((t for t in terms if not isinstance(t, int)), key=repr))
+    return _distribution(const, dice)
+
+
+def dice_stats(expr: str, target: Optional[int] = None, compare: str = "<=") -> dict:
+    """PMF/CDF, mean and variance of an expression, plus P(total <compare> target) if a target is given.
+    compare defaults to '<=' (roll-under, 퍼센트 판정과 같은 방향)."""
+    if compare not in _CMP:
+        raise ValueError(f"Invalid comparison: {compare}")
+    lo, pmf = dice_distribution(expr)
+    values = np.arange(lo, lo + len(pmf))
+    mean = float(values @ pmf)
+    variance = float(((values - mean) ** 2) @ pmf)
+    out = {
+        "expr": expr,
+        "min": lo,
+        "max": int(values[-1]),
+        "mean": mean,
+        "variance": variance,
+        "stddev": variance ** 0.5,
+        "values": values.tolist(),
+        "pmf": pmf.tolist(),
+        "cdf": np.minimum(np.cumsum(pmf), 1.0).tolist(),
+    }
+    if target is not None:
+        out["target"] = target
+        out["compare"] = compare
+        out["success"] = float(pmf[_CMP[compare](values, target)].sum())
+    return out
+
+# --- Dice inference helpers -------------------------------------------------
+
+def _extract_percent_target(text: str) -> Optional[int]:
+    """Infer a percent target (1~100) from free-form text.
+    Tries numbers in parentheses/brackets first, then near 판정/체크/검사 keywords.
+    """
+    if not text:
+        return None
+    # (35) or [35] or (35%) style
+    m = re.search(r"[\(\[]\s*(\d{1,3})\s*%?\s*[\)\]]", text)
+    if m:
+        try:
+            v = int(m.group(1))
+            if 1 <= v <= 100:
+                return v
+        except Exception:
+            pass
+    # around keywords → first 1~100 number
+    if re.search(r"(판정|체크|검사|check|roll)", text, re.IGNORECASE):
+        m = re.search(r"(?:성공률|목표|수치|값)\s*(\d{1,3})", text)
+        if m:
+            try:
+                v = int(m.group(1))
+                if 1 <= v <= 100:
+                    return v
+            except Exception:
+                pass
+        m = re.search(r"\b(\d{1,3})\b", text)
+        if m:
+            try:
+                v = int(m.group(1))
+                if 1 <= v <= 100:
+                    return v
+            except Exception:
+                pass
+    return None
+
+
+# --- Contextual dice keywords ---
+# 버킷은 우선순위 순서. 여러 버킷이 맞으면 앞의 버킷이 이긴다.
+_DEFAULT_DICE_BUCKETS: list[tuple[str, str, list[str]]] = [
+    ("combat_light", "d4", ["단검","단도","주먹","펀치","소형","작은","경량"]),
+    ("combat_heavy", "d8", ["소총","샷건","대검","양손검","망치","대형","강타","치명","헤비"]),
+    ("combat_mid", "d6", ["권총","칼","몽둥이","곤봉","사격","공격","격투","회피","타격","명중","전투"]),
+    ("mental_heavy", "d20", ["공포","광기","정신붕괴","패닉","악몽"]),
+    ("mental_core", "d10", ["정신력","이성","san","의지","멘탈"]),
+    ("mental_light", "d8", ["주의","집중","불안","긴장","의심","심리","설득","협상","관찰"]),
+    ("physical_heavy", "d20", ["근력","힘","버티","들어올리","지구력","인내","수영","등반","철문","벽"]),
+    ("physical_light", "d10", ["운전","민첩","균형","도약","회피","숨기","손재주"]),
+]
+DICE_KEYWORDS_DIR = Path(os.getenv("DICE_KEYWORDS_DIR", str(Path(__file__).parent / "dice_keywords")))
+DICE_KEYWORDS_RELOAD = float(os.getenv("DICE_KEYWORDS_RELOAD", "2"))   # 디렉터리 변경 확인 주기(초)
+
+
+class KeywordAutomaton:
+    """Aho-Corasick matcher over every bucket's keywords; one pass over the text finds all hits."""
+
+    def __init__(self, buckets: list[tuple[str, str, list[str]]]):
+        self.buckets = buckets
+        goto: list[dict] = [{}]
+        out: list[set] = [set()]
+        for i, (_, _, keywords) in enumerate(buckets):
+            for kw in keywords:
+                kw = kw.lower()
+                if not kw:
+                    continue
+                s = 0
+                for ch in kw:
+                    nxt = goto[s].get(ch)
+                    if nxt is None:
+                        nxt = len(goto)
+                        goto[s][ch] = nxt
+                        goto.append({})
+                        out.append(set())
+                    s = nxt
+                out[s].add(i)
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            s = queue.popleft()
+            for ch, nxt in goto[s].items():
+                f = fail[s]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] |= out[fail[nxt]]
+                queue.append(nxt)
+        self._goto = goto
+        self._fail = fail
+        # 가장 높은 우선순위(가장 작은 버킷 번호)만 필요하므로 상태별 최솟값을 미리 계산
+        self._best = [min(o) if o else None for o in out]
+
+    def best(self, text: str) -> Optional[int]:
+        """Index of the highest-priority bucket with a keyword in text (text already lower-cased)."""
+        goto, fail, best = self._goto, self._fail, self._best
+        s = 0
+        hit = None
+        for ch in text:
+            while s and ch not in goto[s]:
+                s = fail[s]
+            s = goto[s].get(ch, 0)
+            b = best[s]
+            if b is not None and (hit is None or b < hit):
+                hit = b
+                if hit == 0:
+                    break
+        return hit
+
+    def expr_for(self, text: str) -> Optional[str]:
+        i = self.best(text)
+        return None if i is None else self.buckets[i][1]
+
+
+class DiceKeywordRegistry:
+    """Keyword sets per world/genre, loaded from DICE_KEYWORDS_DIR/*.json and hot-reloaded on change.
+
+    File format:
+        {"match": ["판타지", "fantasy"],            # world/genre/theme에 포함되면 이 세트 사용
+         "replace": false,                          # true면 기본 버킷을 버리고 이 파일만 사용
+         "buckets": {"combat_heavy": ["도끼"],       # 기존 버킷에 키워드 추가
+                     "magic": {"expr": "d12", "keywords": ["마법", "주문"]}}}   # 새 버킷 (뒤쪽 우선순위)
+    default.json은 match 없이 모든 세션의 기본 세트를 덮어쓴다.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._checked = 0.0
+        self._stamp: tuple = ()
+        self._sets: list[tuple[list[str], KeywordAutomaton]] = []
+        self._default = KeywordAutomaton(_DEFAULT_DICE_BUCKETS)
+
+    def _scan(self) -> tuple:
+        try:
+            return tuple(sorted((p.name, p.stat().st_mtime_ns, p.stat().st_size) for p in self.directory.glob("*.json")))
+        except OSError:
+            return ()
+
+    @staticmethod
+    def _build(base: list, spec: dict) -> list:
+        buckets = [] if spec.get("replace") else [(n, e, list(k)) for n, e, k in base]
+        index = {n: i for i, (n, _, _) in enumerate(buckets)}
+        for name, val in (spec.get("buckets") or {}).items():
+            if isinstance(val, dict):
+                expr, keywords = val.get("expr"), list(val.get("keywords") or [])
+            else:
+                expr, keywords = None, list(val or [])
+            if name in index:
+                n, e, k = buckets[index[name]]
+                buckets[index[name]] = (n, expr or e, k + keywords)
+            elif expr and parse_dice(expr) is not None:
+                index[name] = len(buckets)
+                buckets.append((name, expr, keywords))
+        return buckets
+
+    def _reload(self):
+        base = _DEFAULT_DICE_BUCKETS
+        specs = []
+        for name, _, _ in self._stamp:
+            try:
+                spec = json.loads((self.directory / name).read_text(encoding="utf-8"))
+            except Exception:
+                continue
+            if name == "default.json":
+                base = self._build(base, spec)
+            else:
+                specs.append(spec)
+        self._default = KeywordAutomaton(base)
+        self._sets = [
+            ([m.lower() for m in spec.get("match") or [] if m], KeywordAutomaton(self._build(base, spec)))
+            for spec in specs
+        ]
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self._checked < DICE_KEYWORDS_RELOAD:
+            return
+        self._checked = now
+        stamp = self._scan()
+        if stamp != self._stamp:
+            self._stamp = stamp
+            self._reload()
+
+    def for_core(self, story_core: dict | None) -> KeywordAutomaton:
+        self._refresh()
+        if story_core and self._sets:
+            key = " ".join(str(story_core.get(k) or "") for k in ("world", "genre", "theme")).lower()
+            for match, automaton in self._sets:
+                if any(m in key for m in match):
+                    return automaton
+        return self._default
+
+
+dice_keywords = DiceKeywordRegistry(DICE_KEYWORDS_DIR)
+
+
+def _contextual_dice_expr(user_input: str, story_core: dict | None = None) -> Optional[str]:
+    """Heuristically decide dice from situation keywords.
+    - Combat/attack → d4/d6/d8
+    - Mental/SAN/공포/의지 → d8/d10/d20
+    - Physical/근력/지구력/달리기 등 → d10/d20
+    Keyword buckets come from dice_keywords (per world/genre). Returns an expression like 'd6'.
+    """
+    return dice_keywords.for_core(story_core).expr_for((user_input or "").lower())
+
+
+def infer_roll_from_texts(user_input: str, character_hint: Optional[str] = None, story_core: dict | None = None) -> Optional[dict]:
+    """Infer a dice result from free text.
+    Priority:
+      1) Explicit dice in user_input (e.g., 2d6+1)
+      2) character_hint like 'd100' / '2d6+1' (ROLL override)
+      3) Contextual heuristic by keywords (combat / mental / physical)
+      4) Implicit percent check with target (e.g., '(35)') → d100 vs target
+    Returns dict: {expr,total,detail[,target,success]}
+    """
+    # 1) explicit token in the message
+    tokens = (user_input or "").strip().split()
+    for tok in tokens:
+        if "d" not in tok.lower() or parse_dice(tok) is None:
+            continue
+        try:
+            total, detail = roll_dice(tok)
+            return {"expr": tok, "total": total, "detail": detail}
+        except ValueError:
+            continue
+
+    # 2) hint as dice expression (for ROLL mode)
+    if character_hint:
+        hint = (character_hint or "").strip().lower()
+        try:
+            total, detail = roll_dice(hint)
+            return {"expr": hint, "total": total, "detail": detail}
+        except ValueError:
+            pass
+        if re.fullmatch(r"d(\d+)", hint):  # allow 'd100' style
+            try:
+                total, detail = roll_dice(hint)
+                return {"expr": hint, "total": total, "detail": detail}
+            except ValueError:
+                pass
+
+    # 3) contextual heuristics
+    expr = _contextual_dice_expr(user_input, story_core)
+    if expr:
+        total, detail = roll_dice(expr)
+        return {"expr": expr, "total": total, "detail": detail}
+
+    # 4) percent target inference
+    target = _extract_percent_target(user_input or "")
+    if target is not None:
+        roll = random.randint(1, 100)
+        success = roll <= target
+        detail = f"d100: {roll} vs {target} → {'성공' if success else '실패'} (차이 {abs(roll - target)})"
+        return {"expr": "d100", "total": roll, "detail": detail, "target": target, "success": success}
+
+    return None
@@ -0,0 +1,165 @@
+"""Load generator for the TRPG server: each virtual user runs /trpg/init → /trpg/scene → N × /trpg/reply.
+
+    python mock_llm.py --port 9000 &
+    OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=mock uvicorn main:app --port 8000 &
+    python loadgen.py --base http://127.0.0.1:8000 --users 50 --turns 5 [--stream] [--json out.json]
+
+엔드포인트별 요청 수 / 오류 수 / p50·p95·p99 지연과 전체 RPS를 출력한다.
+--stream이면 reply/scene을 SSE로 받고 첫 이벤트까지의 시간(ttfb)도 따로 집계한다.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import defaultdict
+
+import httpx
+import numpy as np
+
+WORLDS = [
+    {"world": "현대 서울의 도시 미스터리", "theme": "기이한 실종"},
+    {"world": "중세 판타지 왕국", "theme": "용의 음모"},
+    {"world": "SF 우주 식민지", "theme": "생존 호러"},
+]
+INPUTS = [
+    "주변을 천천히 둘러본다",
+    "단검을 꺼내 경계한다",
+    "상인에게 최근 소문을 묻는다. 설득 판정 (55)",
+    "문을 밀어 열고 안으로 들어간다",
+    "2d6+1 로 공격한다",
+    "창밖의 그림자를 관찰한다",
+]
+
+
+class Recorder:
+    def __init__(self):
+        self.latency: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+
+    def ok(self, name: str, seconds: float):
+        self.latency[name].append(seconds)
+
+    def fail(self, name: str):
+        self.errors[name] += 1
+
+    def report(self, elapsed: float) -> dict:
+        out = {"elapsed_s": elapsed, "endpoints": {}}
+        total = 0
+        for name in sorted(set(self.latency) | set(self.errors)):
+            xs = np.array(self.latency.get(name, []), dtype=np.float64) * 1000
+            n = len(xs)
+            total += n + self.errors.get(name, 0)
+            row = {"count": n, "errors": self.errors.get(name, 0)}
+            if n:
+                p50, p95, p99 = np.percentile(xs, [50, 95, 99])
+                row.update({"p50_ms": p50, "p95_ms": p95, "p99_ms": p99, "max_ms": float(xs.max())})
+            out["endpoints"][name] = row
+        out["requests"] = total
+        out["rps"] = total / elapsed if elapsed > 0 else 0.0
+        return out
+
+
+async def _post(http: httpx.AsyncClient, rec: Recorder, name: str, path: str, body: dict, stream: bool) -> dict | None:
+    t0 = time.perf_counter()
+    try:
+        if not stream:
+            r = await http.post(path, json=body)
+            r.raise_for_status()
+            data = r.json()
+            if isinstance(data, dict) and data.get("error"):
+                raise RuntimeError(data["error"])
+            rec.ok(name, time.perf_counter() - t0)
+            return data
+        result = None
+        async with http.stream("POST", path, json=body) as r:
+            r.raise_for_status()
+            first = True
+            event = None
+            async for line in r.aiter_lines():
+                if first and line:
+                    rec.ok(f"{name}:ttfb", time.perf_counter() - t0)
+                    first = False
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:") and event in ("done", "error"):
+                    result = json.loads(line[5:])
+                    if event == "error":
+                        raise RuntimeError(result)
+        rec.ok(name, time.perf_counter() - t0)
+        return result
+    except Exception:
+        rec.fail(name)
+        return None
+
+
+async def virtual_user(http: httpx.AsyncClient, rec: Recorder, turns: int, stream: bool, think: float):
+    core = random.choice(WORLDS)
+    init = await _post(http, rec, "init", "/trpg/init", {"core": core}, False)
+    if not init or "session_id" not in init:
+        return
+    sid = init["session_id"]
+    await _post(http, rec, "scene", "/trpg/scene", {"session_id": sid, "act": 1, "stream": stream}, stream)
+    for _ in range(turns):
+        if think > 0:
+            await asyncio.sleep(random.uniform(0, 2 * think))
+        body = {
+            "session_id": sid,
+            "user_input": random.choice(INPUTS),
+            "role": "player",
+            "situation": "탐색",
+            "character": "민수",
+            "stream": stream,
+        }
+        await _post(http, rec, "reply", "/trpg/reply", body, stream)
+
+
+async def run(args) -> dict:
+    rec = Recorder()
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    async with httpx.AsyncClient(base_url=args.base, timeout=args.timeout, limits=limits) as http:
+        t0 = time.perf_counter()
+        if args.ramp > 0:
+            async def delayed(i):
+                await asyncio.sleep(args.ramp * i / args.users)
+                await virtual_user(http, rec, args.turns, args.stream, args.think)
+            await asyncio.gather(*(delayed(i) for i in range(args.users)))
+        else:
+            await asyncio.gather(*(virtual_user(http, rec, args.turns, args.stream, args.think) for _ in range(args.users)))
+        elapsed = time.perf_counter() - t0
+    return rec.report(elapsed)
+
+
+def print_report(report: dict):
+    print(f"{'endpoint':14s} {'count':>7s} {'errors':>7s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'max ms':>9s}")
+    for name, r in report["endpoints"].items():
+        if r["count"]:
+            print(f"{name:14s} {r['count']:7d} {r['errors']:7d} {r['p50_ms']:9.1f} {r['p95_ms']:9.1f} {r['p99_ms']:9.1f} {r['max_ms']:9.1f}")
+        else:
+            print(f"{name:14s} {0:7d} {r['errors']:7d} {'-':>9s} {'-':>9s} {'-':>9s} {'-':>9s}")
+    print(f"\n{report['requests']} requests in {report['elapsed_s']:.2f}s → {report['rps']:.1f} req/s")
+
+
+def main_cli(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--base", default="http://127.0.0.1:8000")
+    ap.add_argument("--users", type=int, default=20, help="concurrent virtual users (= sessions)")
+    ap.add_argument("--turns", type=int, default=5, help="/trpg/reply calls per user")
+    ap.add_argument("--think", type=float, default=0.0, help="mean think time between turns (s)")
+    ap.add_argument("--ramp", type=float, default=0.0, help="spread user start over this many seconds")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--stream", action="store_true", help="use SSE for scene/reply")
+    ap.add_argument("--json", help="also write the report to this file")
+    args = ap.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,152 +1,81 @@
 import re
-import random
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import os
 from pathlib import Path
 
-from openai import OpenAI
-
 import json
-
+import bisect
+import hashlib
+import random
+import threading
+import time
 import uuid
-from typing import Dict, Literal, Optional
+from collections import OrderedDict, deque
 
-from typing import List
+import numpy as np
 
-# Optional vector store (Chroma) for long-term memory
-try:
-    import chromadb
-    from chromadb.config import Settings
-    _CHROMA_AVAILABLE = True
-except Exception:
-    _CHROMA_AVAILABLE = False
+from typing import Dict, List, Optional
 
 # ==========================
-# Models
-# ==========================
-class Persona(BaseModel):
-    role_type: Literal["GM", "PLAYER", "NPC", "ENEMY"]
-    name: str
-    traits: list[str] = []
-    stats: dict = {}
-    speech_style: str = ""
-    goals: list[str] = []
-
-class SessionState(BaseModel):
-    story_core: dict
-    plot_outline: list[dict]
-    current_act: int
-    history: list[str]
-    personas: dict[str, Persona] = {}
-    scene_intro_done: bool = False
-
-# In-memory session cache (디스크 저장과 함께 사용)
-sessions: Dict[str, SessionState] = {}
-
-# ==========================
-# Env & OpenAI client
+# Env
 # ==========================
+# 아래 모듈들은 import 시점에 os.getenv로 설정을 읽으므로 .env.trpg를 먼저 로드한다
 load_dotenv(dotenv_path=Path(__file__).parent / ".env.trpg")
-api_key = os.getenv("OPENAI_API_KEY")
-MODEL_DEFAULT = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")  # ChatGPT UI에서는 4.1-mini가 4o-mini를 대체
-MODEL_FALLBACK = os.getenv("OPENAI_MODEL_FALLBACK", "gpt-5 -mini")
-
-client = OpenAI(api_key=api_key)
 
-app = FastAPI()
+from models import Persona, SessionState, _SCENE_LINE_RE, _estimate_tokens, _line_act_speaker, merge_core  # noqa: E402
+from metrics import TimingMiddleware, metrics, record_stage, stage  # noqa: E402
+from scheduler import MODEL_DEFAULT, achat, achat_stream, aclient, llm_scheduler, router  # noqa: E402
+from memory import (  # noqa: E402
+    MEMORY_EVERY_N, MEMORY_TOP_K, _amemory_upsert_strict, _embed_disk_writes, amemory_query,
+    embed_batcher, embed_cache, local_memory, memory_partitions,
+)
+from stores import (  # noqa: E402
+    SESSION_CODEC, _archive_dir, _session_flush_loop, _write_archive_segment, peek_session, session_lock, sessions,
+)
+from dice import dice_cells, dice_stats, infer_roll_from_texts, roll_dice, roll_dice_many  # noqa: E402
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    flusher = asyncio.create_task(_session_flush_loop())
+    post_turn.start()
+    try:
+        yield
+    finally:
+        flusher.cancel()
+        await post_turn.drain()
+        await sessions.aflush_all()
+        sessions.flush_all()  # 스레드 기록이 실패해 남은 것
+        await asyncio.gather(*_embed_disk_writes, return_exceptions=True)
+        for task in list(_outline_fills.values()):
+            task.cancel()  # 캐시 채우기는 다음 요청 때 다시 하면 된다
+        await asyncio.gather(*_outline_fills.values(), return_exceptions=True)
+        await aclient.close()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(TimingMiddleware)
 
 # DEV flags
 DEV_MODE = os.getenv("DEV_MODE", "false").lower() == "true"
 DEV_SESSION_ID: Optional[str] = None
 
 # ==========================
-# Memory / Embedding config
-# ==========================
-EMBED_MODEL = os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
-CHROMA_DIR = os.getenv("CHROMA_DIR", str((Path(__file__).parent / "chroma").resolve()))
-MEMORY_EVERY_N = int(os.getenv("MEMORY_EVERY_N", "6"))  # summarize every N history lines
-MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "4"))      # retrieved notes for context
-
-# Initialize Chroma client (optional)
-if _CHROMA_AVAILABLE:
-    try:
-        chroma_client = chromadb.PersistentClient(path=CHROMA_DIR)
-        memory_collection = chroma_client.get_or_create_collection("trpg_memories", metadata={"hnsw:space": "cosine"})
-    except Exception:
-        _CHROMA_AVAILABLE = False
-        memory_collection = None
-else:
-    memory_collection = None
-
-# ==========================
-# Session persistence (JSON)
+# Reply formatting
 # ==========================
-SESS_DIR = Path(__file__).parent / "sessions"
-SESS_DIR.mkdir(parents=True, exist_ok=True)
+def _sse(event: str, data) -> str:
+    """Format one Server-Sent Event frame."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-def _sess_path(sid: str) -> Path:
-    return SESS_DIR / f"{sid}.json"
-
-def load_session(sid: str) -> Optional[SessionState]:
-    p = _sess_path(sid)
-    if not p.exists():
-        return None
-    try:
-        data = json.loads(p.read_text(encoding="utf-8"))
-        # pydantic이 중첩 모델을 복원할 수 있도록 변환
-        if "personas" in data and isinstance(data["personas"], dict):
-            data["personas"] = {
-                k: Persona(**v) if not isinstance(v, Persona) else v
-                for k, v in data["personas"].items()
-            }
-        return SessionState(**data)
-    except Exception:
-        return None
-
-def save_session(sid: str, state: SessionState) -> None:
-    payload = state.model_dump()
-    _sess_path(sid).write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
-
-# ==========================
-# Utility
-# ==========================
-
-def chat(messages: list[dict], model: Optional[str] = None, **kwargs):
-    """OpenAI Chat API 래퍼. 기본 모델로 시도 후, 실패 시 Fallback."""
-    m = model or MODEL_DEFAULT
-    try:
-        return client.chat.completions.create(
-            model=m,
-            messages=messages,
-            **{"temperature": 0.7, **kwargs},
-        )
-    except Exception:
-        if MODEL_FALLBACK and MODEL_FALLBACK != m:
-            return client.chat.completions.create(
-                model=MODEL_FALLBACK,
-                messages=messages,
-                **{"temperature": 0.7, **kwargs},
-            )
-        raise
-
-
-def roll_dice(expr: str) -> tuple[int, str]:
-    # Patterns: "2d6+1", "d20", "3d4-2"
-    match = re.fullmatch(r"(\d*)d(\d+)([+-]\d+)?", expr)
-    if not match:
-        raise ValueError(f"Invalid dice expression: {expr}")
-    count = int(match.group(1)) if match.group(1) else 1
-    sides = int(match.group(2))
-    modifier = int(match.group(3)) if match.group(3) else 0
-    rolls = [random.randint(1, sides) for _ in range(count)]
-    total = sum(rolls) + modifier
-    detail = f"{rolls}{match.group(3) or ''} = {total}"
-    return total, detail
 
 # --- Helper: normalize model reply ---
+_ROLE_LABELS = ("사회자", "GM", "NPC", "ENEMY", "플레이어")
+_ROLE_LABEL_RE = re.compile(r"^\s*(사회자|GM|NPC|ENEMY|플레이어)\s*[:：]\s*")
+_ROLE_LABEL_PENDING_RE = re.compile(r"^(사회자|GM|NPC|ENEMY|플레이어)\s*$")
+
 def _normalize_reply(text: str) -> str:
     """Clean model output: strip role labels and accidental JSON wrappers."""
     t = (text or "").strip()
@@ -158,228 +87,628 @@ def _normalize_reply(text: str) -> str:
     except Exception:
         pass
     # Remove leading role labels like "사회자:", "NPC:", etc.
-    t = re.sub(r"^\s*(사회자|GM|NPC|ENEMY|플레이어)\s*[:：]\s*", "", t)
+    t = _ROLE_LABEL_RE.sub("", t)
     return t
 
-
-# --- Dice inference helpers -------------------------------------------------
-
-def _extract_percent_target(text: str) -> Optional[int]:
-    """Infer a percent target (1~100) from free-form text.
-    Tries numbers in parentheses/brackets first, then near 판정/체크/검사 keywords.
+class _ReplyStreamNormalizer:
+    """Incremental _normalize_reply for streamed output.
+    선두의 역할 라벨이 확정될 때까지만 버퍼링하고 이후는 그대로 흘려보낸다.
+    JSON 래퍼로 시작하면 끝까지 모았다가 finish()에서 한 번에 정규화한다.
     """
-    if not text:
-        return None
-    # (35) or [35] or (35%) style
-    m = re.search(r"[\(\[]\s*(\d{1,3})\s*%?\s*[\)\]]", text)
-    if m:
-        try:
-            v = int(m.group(1))
-            if 1 <= v <= 100:
-                return v
-        except Exception:
-            pass
-    # around keywords → first 1~100 number
-    if re.search(r"(판정|체크|검사|check|roll)", text, re.IGNORECASE):
-        m = re.search(r"(?:성공률|목표|수치|값)\s*(\d{1,3})", text)
-        if m:
-            try:
-                v = int(m.group(1))
-                if 1 <= v <= 100:
-                    return v
-            except Exception:
-                pass
-        m = re.search(r"\b(\d{1,3})\b", text)
-        if m:
-            try:
-                v = int(m.group(1))
-                if 1 <= v <= 100:
-                    return v
-            except Exception:
-                pass
-    return None
 
+    def __init__(self):
+        self.buf = ""
+        self.mode = "head"  # head | pass | json
+
+    def feed(self, delta: str) -> str:
+        if self.mode == "pass":
+            return delta
+        self.buf += delta
+        if self.mode == "json":
+            return ""
+        head = self.buf.lstrip()
+        if not head:
+            return ""
+        if head.startswith("{"):
+            self.mode = "json"
+            return ""
+        m = _ROLE_LABEL_RE.match(head)
+        if m and m.end() < len(head):
+            self.mode = "pass"
+            return head[m.end():]
+        if m or _ROLE_LABEL_PENDING_RE.match(head) or any(l.startswith(head) for l in _ROLE_LABELS):
+            return ""  # 라벨일 수 있음 → 대기
+        self.mode = "pass"
+        return head
+
+    def finish(self) -> str:
+        """Flush whatever is still held back."""
+        if self.mode == "pass":
+            return ""
+        return _normalize_reply(self.buf)
 
-def _contextual_dice_expr(user_input: str, story_core: dict | None = None) -> Optional[str]:
-    """Heuristically decide dice from situation keywords.
-    - Combat/attack → d4/d6/d8
-    - Mental/SAN/공포/의지 → d8/d10/d20
-    - Physical/근력/지구력/달리기 등 → d10/d20
-    Returns an expression like 'd6' (no count → 1 by default).
-    """
-    t = (user_input or "").lower()
-
-    # Keyword buckets
-    combat_light = ["단검","단도","주먹","펀치","소형","작은","경량"]
-    combat_mid   = ["권총","칼","몽둥이","곤봉","사격","공격","격투","회피","타격","명중","전투"]
-    combat_heavy = ["소총","샷건","대검","양손검","망치","대형","강타","치명","헤비"]
-
-    mental_light = ["주의","집중","불안","긴장","의심","심리","설득","협상","관찰"]
-    mental_core  = ["정신력","이성","san","의지","멘탈"]
-    mental_heavy = ["공포","광기","정신붕괴","패닉","악몽"]
-
-    physical_light = ["운전","민첩","균형","도약","회피","숨기","손재주"]
-    physical_heavy = ["근력","힘","버티","들어올리","지구력","인내","수영","등반","철문","벽"]
-
-    has = lambda keys: any(k in t for k in keys)
-
-    # Combat
-    if has(combat_light):
-        return "d4"
-    if has(combat_heavy):
-        return "d8"
-    if has(combat_mid):
-        return "d6"
-
-    # Mental
-    if has(mental_heavy):
-        return "d20"
-    if has(mental_core):
-        return "d10"
-    if has(mental_light):
-        return "d8"
-
-    # Physical
-    if has(physical_heavy):
-        return "d20"
-    if has(physical_light):
-        return "d10"
-
-    return None
-
-
-def infer_roll_from_texts(user_input: str, character_hint: Optional[str] = None, story_core: dict | None = None) -> Optional[dict]:
-    """Infer a dice result from free text.
-    Priority:
-      1) Explicit dice in user_input (e.g., 2d6+1)
-      2) character_hint like 'd100' / '2d6+1' (ROLL override)
-      3) Contextual heuristic by keywords (combat / mental / physical)
-      4) Implicit percent check with target (e.g., '(35)') → d100 vs target
-    Returns dict: {expr,total,detail[,target,success]}
-    """
-    # 1) explicit token in the message
-    tokens = (user_input or "").strip().split()
-    for tok in tokens:
-        try:
-            total, detail = roll_dice(tok)
-            return {"expr": tok, "total": total, "detail": detail}
-        except ValueError:
-            continue
+# ==========================
+# Core memory summary
+# ==========================
+def _core_prompt(history: list[str], toks: Optional[list[int]] = None) -> str:
+    """toks: history 끝부분과 정렬된 토큰 추정치 (SessionState.history_tokens()). 없을 때만 여기서 계산."""
+    if toks is None:
+        toks = [_estimate_tokens(l) for l in history[-CONTEXT_MAX_LINES:]]
+    lines = _tail_within_budget(history, toks, _context_budget("summary"))
+    return (
+        "다음 대화에서 줄거리 진행에 중요한 핵심만 JSON으로 요약해줘.\n"
+        "필드: facts[], relationships[], open_threads[].\n"
+        f"대화:\n{chr(10).join(lines)}\n"
+        "반드시 JSON만 출력."
+    )
 
-    # 2) hint as dice expression (for ROLL mode)
-    if character_hint:
-        hint = (character_hint or "").strip().lower()
-        try:
-            total, detail = roll_dice(hint)
-            return {"expr": hint, "total": total, "detail": detail}
-        except ValueError:
-            pass
-        if re.fullmatch(r"d(\d+)", hint):  # allow 'd100' style
-            try:
-                total, detail = roll_dice(hint)
-                return {"expr": hint, "total": total, "detail": detail}
-            except ValueError:
-                pass
+def _parse_core(content: str) -> dict:
+    data = json.loads(content or "{}")
+    return {
+        "facts": list(data.get("facts", [])),
+        "relationships": list(data.get("relationships", [])),
+        "open_threads": list(data.get("open_threads", [])),
+    }
 
-    # 3) contextual heuristics
-    expr = _contextual_dice_expr(user_input, story_core)
-    if expr:
-        total, detail = roll_dice(expr)
-        return {"expr": expr, "total": total, "detail": detail}
+async def _aextract_core_strict(history: list[str], toks: Optional[list[int]] = None) -> dict:
+    if not history:
+        return {}
+    r = await achat([{"role": "user", "content": _core_prompt(history, toks)}], purpose="summary", temperature=0.2, max_tokens=250)
+    return _parse_core(r.choices[0].message.content or "{}")
 
-    # 4) percent target inference
-    target = _extract_percent_target(user_input or "")
-    if target is not None:
-        roll = random.randint(1, 100)
-        success = roll <= target
-        detail = f"d100: {roll} vs {target} → {'성공' if success else '실패'} (차이 {abs(roll - target)})"
-        return {"expr": "d100", "total": roll, "detail": detail, "target": target, "success": success}
+async def aextract_core_from(history: list[str]) -> dict:
+    """Summarize recent history into core facts/relationships/open_threads."""
+    try:
+        return await _aextract_core_strict(history)
+    except Exception:
+        return {}
 
-    return None
 
+# ==========================
+# History compaction
+# ==========================
+# history가 HISTORY_HOT_MAX줄을 넘으면 앞부분(최근 HISTORY_HOT_KEEP줄 제외)을
+#   1) 장면 경계("Act N scene:")로 나누고, 요약 예산 크기의 window마다 extract_core → merge_core로 장면 요약
+#   2) 원문은 {sid}.archive/{start}.jsonl (cold segment, 불변)로 내려보내고
+#   3) compact delta로 live state에서 제거 + summary_tree(act → scenes)에 반영
+HISTORY_HOT_MAX = int(os.getenv("HISTORY_HOT_MAX", "400"))
+HISTORY_HOT_KEEP = int(os.getenv("HISTORY_HOT_KEEP", "200"))
+# KEEP >= MAX면 내려보낼 줄이 없는데 compaction만 매 턴 예약된다 → MAX의 절반으로 낮춘다
+if not 0 <= HISTORY_HOT_KEEP < HISTORY_HOT_MAX:
+    HISTORY_HOT_KEEP = max(0, HISTORY_HOT_MAX // 2)
+
+def _scene_chunks(lines: list[str], act: int) -> list[tuple[int, int, int]]:
+    """Split lines at scene boundaries → [(act, start, end)]."""
+    chunks = []
+    start = 0
+    for i, line in enumerate(lines):
+        m = _SCENE_LINE_RE.match(line)
+        if m and i > start:
+            chunks.append((act, start, i))
+            start = i
+        if m:
+            act = int(m.group(1))
+    if start < len(lines):
+        chunks.append((act, start, len(lines)))
+    return chunks
+
+def _budget_windows(lines: list[str], toks: list[int], budget: int) -> list[tuple[list[str], list[int]]]:
+    """Split into consecutive (lines, toks) windows that each fit budget."""
+    windows, cur, cur_toks, used = [], [], [], 0
+    for line, t in zip(lines, toks):
+        if cur and used + t > budget:
+            windows.append((cur, cur_toks))
+            cur, cur_toks, used = [], [], 0
+        cur.append(line)
+        cur_toks.append(t)
+        used += t
+    if cur:
+        windows.append((cur, cur_toks))
+    return windows
+
+async def compact_history(sid: str) -> bool:
+    """요약(LLM)과 archive 기록은 lock 밖에서, 결과 적용만 session_lock 안에서 한다."""
+    state = await sessions.aget(sid)
+    if not state or len(state.history) <= HISTORY_HOT_MAX:
+        return False
+    n = len(state.history) - HISTORY_HOT_KEEP
+    if n <= 0:
+        return False
+    base = state.archived_lines
+    lines = state.history[:n]
+    toks = state.history_tokens()[:n]
+    chunks = _scene_chunks(lines, state.archived_act)
+    nodes = []
+    for act, a, b in chunks:
+        core: dict = {}
+        for window in _budget_windows(lines[a:b], toks[a:b], _context_budget("summary")):
+            core = merge_core(core, await _aextract_core_strict(*window))
+        nodes.append({"act": act, "start": base + a, "end": base + b, "core": core})
+    await asyncio.to_thread(_write_archive_segment, sid, base, lines)
+    # 턴 처리(_finish_reply 등)와 같은 lock → 적용 중에 다른 요청이 state를 바꾸거나 다른 worker와 엇갈리지 않는다
+    async with session_lock(sid):
+        state = await sessions.aget(sid)
+        if not state or state.archived_lines != base or state.history[:n] != lines:
+            return False  # 그 사이 다른 compaction이 적용됨
+        state.compact(n, chunks[-1][0], nodes)
+        sessions.mark_dirty(sid)
+    return True
 
-# --- Embedding/Memory helpers ---
-def embed_texts(texts: List[str]) -> List[List[float]]:
-    """Return OpenAI embeddings for a list of texts."""
-    try:
-        res = client.embeddings.create(model=EMBED_MODEL, input=texts)
-        return [d.embedding for d in res.data]
-    except Exception:
-        return []
 
-def memory_upsert(session_id: str, chunks: List[str], metadicts: List[dict]) -> None:
-    if not _CHROMA_AVAILABLE or not memory_collection or not chunks:
-        return
+# ==========================
+# History index (paged reads)
+# ==========================
+# /trpg/session/{sid}/history용. 줄 번호는 archive + hot history를 이은 절대 index라 compaction 후에도 그대로다.
+# archive segment는 불변이므로 segment마다 (byte offset, act, speaker) 배열을 한 번 만들어 {start}.idx.npz로 옆에 두고,
+# 세션 단위 ArchiveIndex가 이를 이어 붙여 LRU로 들고 있는다. 페이지 하나 = posting 배열 searchsorted + limit번 seek/readline.
+# hot history 쪽은 SessionState.history_meta()가 줄마다 한 번만 계산한다 (길이는 HISTORY_HOT_MAX 이하).
+HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", "200"))
+HISTORY_INDEX_CACHE = int(os.getenv("HISTORY_INDEX_CACHE", "256"))  # sessions whose archive index stays in memory
+
+def _segment_index(p: Path, act0: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, list[str]]:
+    """(offsets, acts, speaker codes, speaker names) for one archive segment, cached in a sidecar file."""
+    side = p.with_suffix(".idx.npz")
     try:
-        vecs = embed_texts(chunks)
-        if not vecs:
-            return
-        ids = [f"{session_id}:{uuid.uuid4()}" for _ in chunks]
-        memory_collection.upsert(
-            ids=ids,
-            embeddings=vecs,
-            documents=chunks,
-            metadatas=[{"session_id": session_id, **m} for m in metadicts],
-        )
+        if side.stat().st_mtime_ns >= p.stat().st_mtime_ns:
+            with np.load(side) as z:
+                if int(z["act0"]) == act0:
+                    return z["offsets"], z["acts"], z["speakers"], [str(x) for x in z["names"]]
     except Exception:
-        # fail silently in dev
         pass
-
-def memory_query(session_id: str, query: str, k: int = MEMORY_TOP_K) -> List[str]:
-    if not _CHROMA_AVAILABLE or not memory_collection or not query.strip():
-        return []
+    offsets, acts, codes, names, lookup = [], [], [], [], {}
+    pos, act = 0, act0
+    with p.open("rb") as f:
+        for raw in f:
+            act, speaker = _line_act_speaker(json.loads(raw), act)
+            if speaker not in lookup:
+                lookup[speaker] = len(names)
+                names.append(speaker)
+            offsets.append(pos)
+            acts.append(act)
+            codes.append(lookup[speaker])
+            pos += len(raw)
+    arrays = (np.asarray(offsets, dtype=np.int64), np.asarray(acts, dtype=np.int32), np.asarray(codes, dtype=np.int32))
     try:
-        qvecs = embed_texts([query])
-        if not qvecs:
-            return []
-        res = memory_collection.query(query_embeddings=qvecs, n_results=k, where={"session_id": session_id})
-        docs = (res.get("documents") or [[]])[0]
-        return docs
+        tmp = side.with_suffix(".tmp")
+        with tmp.open("wb") as f:
+            np.savez(f, offsets=arrays[0], acts=arrays[1], speakers=arrays[2],
+                     names=np.asarray(names, dtype=str), act0=np.int32(act0))
+        os.replace(tmp, side)
     except Exception:
-        return []
+        pass  # sidecar는 캐시일 뿐: 못 쓰면 다음에 다시 만든다
+    return (*arrays, names)
+
+
+class ArchiveIndex:
+    """Absolute line → (segment, byte offset, act, speaker) over one session's archive segments."""
+
+    def __init__(self, sid: str):
+        self.sid = sid
+        self.lock = threading.Lock()
+        self.starts: list[int] = []
+        self.paths: list[Path] = []
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.acts = np.zeros(0, dtype=np.int32)
+        self.speakers = np.zeros(0, dtype=np.int32)
+        self.names: list[str] = []       # speaker code → name
+        self.codes: dict[str, int] = {}
+        self._postings: dict[tuple, np.ndarray] = {}
+
+    @property
+    def covered(self) -> int:
+        return len(self.acts)
+
+    def refresh(self, upto: int) -> None:
+        """Index new segments until at least upto lines are covered (segment는 뒤에만 붙는다)."""
+        if self.covered >= upto:
+            return
+        d = _archive_dir(self.sid)
+        segs = sorted((int(p.stem), p) for p in d.glob("*.jsonl")) if d.exists() else []
+        parts = []
+        for start, p in segs:
+            covered = self.covered + sum(len(a[1]) for a in parts)
+            if start < covered:
+                continue
+            if start > covered or covered >= upto:
+                break  # 빈틈(아직 안 쓰인 segment) 또는 충분함
+            act0 = int(parts[-1][1][-1]) if parts else (int(self.acts[-1]) if self.covered else 0)
+            offsets, acts, codes, names = _segment_index(p, act0)
+            remap = np.asarray([self._code(n) for n in names] or [0], dtype=np.int32)
+            parts.append((offsets, acts, remap[codes]))
+            self.starts.append(start)
+            self.paths.append(p)
+        if parts:
+            self.offsets = np.concatenate([self.offsets, *(a[0] for a in parts)])
+            self.acts = np.concatenate([self.acts, *(a[1] for a in parts)])
+            self.speakers = np.concatenate([self.speakers, *(a[2] for a in parts)])
+            self._postings.clear()
+
+    def _code(self, name: str) -> int:
+        if name not in self.codes:
+            self.codes[name] = len(self.names)
+            self.names.append(name)
+        return self.codes[name]
+
+    def positions(self, act: Optional[int], speaker: Optional[str]) -> np.ndarray:
+        """Sorted line indices matching the filters (filter 조합마다 한 번 만들고 재사용)."""
+        key = (act, speaker)
+        if key not in self._postings:
+            if act is None and speaker is None:
+                self._postings[key] = np.arange(self.covered)
+            else:
+                mask = np.ones(self.covered, dtype=bool)
+                if act is not None:
+                    mask &= self.acts == act
+                if speaker is not None:
+                    code = self.codes.get(speaker)
+                    mask &= (self.speakers == code) if code is not None else False
+                self._postings[key] = np.flatnonzero(mask)
+        return self._postings[key]
+
+    def lines(self, idxs) -> list[str]:
+        out: list[str] = []
+        files: dict[int, object] = {}
+        try:
+            for i in idxs:
+                seg = bisect.bisect_right(self.starts, i) - 1
+                f = files.get(seg)
+                if f is None:
+                    f = files[seg] = self.paths[seg].open("rb")
+                f.seek(int(self.offsets[i]))
+                out.append(json.loads(f.readline()))
+        finally:
+            for f in files.values():
+                f.close()
+        return out
 
-def extract_core_from(history: list[str]) -> dict:
-    """Summarize recent history into core facts/relationships/open_threads."""
-    if not history:
-        return {}
-    prompt = (
-        "다음 대화에서 줄거리 진행에 중요한 핵심만 JSON으로 요약해줘.\n"
-        "필드: facts[], relationships[], open_threads[].\n"
-        f"대화:\n{chr(10).join(history[-12:])}\n"
-        "반드시 JSON만 출력."
-    )
-    try:
-        r = chat([{"role": "user", "content": prompt}], temperature=0.2, max_tokens=250)
-        content = r.choices[0].message.content or "{}"
-        data = json.loads(content)
-        return {
-            "facts": list(data.get("facts", [])),
-            "relationships": list(data.get("relationships", [])),
-            "open_threads": list(data.get("open_threads", [])),
-        }
-    except Exception:
-        return {}
 
-def merge_core(dst: dict, src: dict) -> dict:
-    def merge_list(a, b):
-        a = a or []
-        b = b or []
-        seen = set(a)
-        out = list(a)
-        for x in b:
-            if x not in seen:
-                out.append(x)
-                seen.add(x)
-        return out
-    dst = dst or {}
-    src = src or {}
+class HistoryIndexCache:
+    def __init__(self, max_size: int = HISTORY_INDEX_CACHE):
+        self.max_size = max_size
+        self._items: "OrderedDict[str, ArchiveIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid: str) -> ArchiveIndex:
+        with self._lock:
+            idx = self._items.get(sid)
+            if idx is None:
+                idx = self._items[sid] = ArchiveIndex(sid)
+            self._items.move_to_end(sid)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+            return idx
+
+history_indexes = HistoryIndexCache()
+
+def history_page(sid: str, archived: int, hot: list[str], hot_meta: list[tuple[int, str]],
+                 before: Optional[int] = None, after: Optional[int] = None, limit: int = 50,
+                 act: Optional[int] = None, speaker: Optional[str] = None) -> dict:
+    """One page of history in absolute line order.
+    before=c → c보다 앞의 마지막 limit줄, after=c → c보다 뒤의 처음 limit줄, 둘 다 없으면 최신 페이지.
+    prev_cursor는 before=로, next_cursor는 after=로 그대로 넘기면 이어지는 페이지다 (없으면 None)."""
+    if archived > 0:
+        idx = history_indexes.get(sid)
+        with idx.lock:
+            idx.refresh(archived)
+            cold = idx.positions(act, speaker)
+        cold = cold[:int(np.searchsorted(cold, archived))]  # 아직 compact가 적용 안 된 segment는 제외
+    else:
+        idx, cold = None, np.zeros(0, dtype=np.int64)
+    hot_pos = [archived + i for i, (a, sp) in enumerate(hot_meta)
+               if (act is None or a == act) and (speaker is None or sp == speaker)]
+    nc, total = len(cold), len(cold) + len(hot_pos)
+
+    def rank(x: int) -> int:  # 매칭되는 줄 중 index < x 인 개수
+        return int(np.searchsorted(cold, x)) + bisect.bisect_left(hot_pos, x)
+
+    if after is not None:
+        lo = hi = after + 1
+        k0 = rank(lo)
+        k1 = min(k0 + limit, total)
+    else:
+        lo = hi = archived + len(hot) if before is None else before
+        k1 = rank(hi)
+        k0 = max(k1 - limit, 0)
+    picked_cold = [int(i) for i in cold[k0:min(k1, nc)]]
+    picked_hot = hot_pos[max(k0 - nc, 0):max(k1 - nc, 0)]
+    items = []
+    if picked_cold:
+        for i, text in zip(picked_cold, idx.lines(picked_cold)):
+            items.append({"index": i, "act": int(idx.acts[i]), "speaker": idx.names[idx.speakers[i]], "text": text})
+    for i in picked_hot:
+        a, sp = hot_meta[i - archived]
+        items.append({"index": i, "act": a, "speaker": sp, "text": hot[i - archived]})
     return {
-        **dst,
-        "facts": merge_list(dst.get("facts"), src.get("facts")),
-        "relationships": merge_list(dst.get("relationships"), src.get("relationships")),
-        "open_threads": merge_list(dst.get("open_threads"), src.get("open_threads")),
+        "items": items,
+        "prev_cursor": (items[0]["index"] if items else lo) if k0 > 0 else None,
+        "next_cursor": (items[-1]["index"] if items else hi - 1) if k1 < total else None,
+        "total_lines": archived + len(hot),
+        "matched": total,
     }
 
+# ==========================
+# Post-turn pipeline (background)
+# ==========================
+# 응답 반환 후 처리: amemory_upsert(임베딩+Chroma)와 N라인마다 핵심기억 요약.
+# 세션당 대기 작업은 하나로 합쳐지고(coalesce), 큐는 세션 수 기준으로 bounded.
+POST_TURN_WORKERS = int(os.getenv("POST_TURN_WORKERS", "2"))
+POST_TURN_QUEUE_MAX = int(os.getenv("POST_TURN_QUEUE_MAX", "1000"))
+POST_TURN_RETRIES = int(os.getenv("POST_TURN_RETRIES", "3"))
+POST_TURN_BACKOFF = float(os.getenv("POST_TURN_BACKOFF", "0.5"))        # seconds, doubled per retry
+POST_TURN_DRAIN_TIMEOUT = float(os.getenv("POST_TURN_DRAIN_TIMEOUT", "30"))
+
+class PostTurnPipeline:
+    """Bounded worker queue for post-reply memory work."""
+
+    def __init__(self, workers: int = POST_TURN_WORKERS, maxsize: int = POST_TURN_QUEUE_MAX):
+        self.n_workers = workers
+        self.maxsize = maxsize
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._pending: Dict[str, dict] = {}   # sid → 아직 처리되지 않은 (합쳐진) 작업
+        self._active: set[str] = set()        # 지금 처리 중인 sid (같은 세션 동시 처리 방지)
+        self._overflow: deque = deque()       # 큐가 가득 차서 못 넣은 sid (worker가 자리가 나면 옮긴다)
+        self._workers: list[asyncio.Task] = []
+        self.stats = {"submitted": 0, "coalesced": 0, "overflowed": 0, "done": 0, "retried": 0, "dropped": 0}
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.maxsize)  # 현재 이벤트 루프에 바인딩
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.n_workers)]
+
+    def submit(self, sid: str, chunks: List[str] = (), metas: List[dict] = (), summarize: bool = False, compact: bool = False) -> None:
+        """Queue work for sid; merges into a pending job if one exists. 절대 기다리지 않는다:
+        큐가 가득 차면 작업은 _pending에 합쳐진 채 overflow 목록에 남고, worker가 자리가 날 때 큐로 옮긴다."""
+        self.stats["submitted"] += 1
+        job = self._pending.get(sid)
+        if job is not None:
+            self.stats["coalesced"] += 1
+        else:
+            job = self._pending[sid] = {"chunks": [], "metas": [], "summarize": False, "compact": False}
+        job["chunks"].extend(chunks)
+        job["metas"].extend(metas)
+        job["summarize"] = job["summarize"] or summarize
+        job["compact"] = job["compact"] or compact
+        if not job.get("queued") and sid not in self._active:
+            job["queued"] = True
+            self._enqueue(sid)
+
+    def _enqueue(self, sid: str) -> None:
+        try:
+            self._queue.put_nowait(sid)
+        except asyncio.QueueFull:
+            self._overflow.append(sid)
+            self.stats["overflowed"] += 1
+
+    def _refill(self) -> None:
+        while self._overflow and not self._queue.full():
+            self._queue.put_nowait(self._overflow.popleft())
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "queued": self._queue.qsize(), "overflow": len(self._overflow), "pending": len(self._pending)}
+
+    async def drain(self, timeout: float = POST_TURN_DRAIN_TIMEOUT) -> None:
+        """Wait for queued work to finish (up to timeout), then stop the workers."""
+        if self._workers:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        for w in self._workers:
+            w.cancel()
+        self._workers = []
+
+    async def _worker(self) -> None:
+        while True:
+            sid = await self._queue.get()
+            job = self._pending.pop(sid, None)
+            self._active.add(sid)
+            try:
+                if job:
+                    await self._run(sid, job)
+            finally:
+                self._active.discard(sid)
+                # 처리 중에 들어온 작업과 overflow는 다시 큐로 (task_done 전에 넣어야 drain의 join이 놓치지 않음)
+                self._refill()
+                job = self._pending.get(sid)
+                if job is not None and not job.get("queued"):
+                    job["queued"] = True
+                    self._enqueue(sid)
+                self._queue.task_done()
+
+    async def _run(self, sid: str, job: dict) -> None:
+        for attempt in range(POST_TURN_RETRIES + 1):
+            try:
+                if job["chunks"]:
+                    await _amemory_upsert_strict(sid, job["chunks"], job["metas"])
+                    job["chunks"], job["metas"] = [], []
+                if job["summarize"]:
+                    state = await sessions.aget(sid)
+                    core = await _aextract_core_strict(state.history, state.history_tokens()) if state else {}
+                    state = await sessions.aget(sid)  # await 사이에 eviction/reload 되었을 수 있음
+                    if state and core:
+                        state.merge_story_core(core)
+                        sessions.mark_dirty(sid)
+                    job["summarize"] = False
+                if job["compact"]:
+                    await compact_history(sid)
+                    job["compact"] = False
+                self.stats["done"] += 1
+                return
+            except Exception:
+                if attempt == POST_TURN_RETRIES:
+                    self.stats["dropped"] += 1
+                    return
+                self.stats["retried"] += 1
+                await asyncio.sleep(POST_TURN_BACKOFF * (2 ** attempt))
+
+post_turn = PostTurnPipeline()
+
+# ==========================
+# Context window (token budget)
+# ==========================
+# 줄 수가 아니라 토큰 추정치로 프롬프트 크기를 제한한다. 예산은 endpoint(와 응답 역할)별.
+# 토큰 추정(_estimate_tokens, CONTEXT_TOKENIZER)은 SessionState가 줄마다 캐시하므로 models에 있다.
+CONTEXT_MAX_LINES = int(os.getenv("CONTEXT_MAX_LINES", "200"))           # hard cap on history lines scanned
+CONTEXT_MIN_RECENT = int(os.getenv("CONTEXT_MIN_RECENT", "4"))          # newest lines that outrank retrieved notes
+CONTEXT_RECENT_SHARE = float(os.getenv("CONTEXT_RECENT_SHARE", "0.5"))  # max budget share for those lines
+CONTEXT_CORE_BUDGET = int(os.getenv("CONTEXT_CORE_BUDGET", "600"))      # story_core in the system prefix
+CONTEXT_BUDGETS = {
+    "reply:GM": 1800,
+    "reply:PLAYER": 1400,
+    "reply:NPC": 1000,
+    "reply:ENEMY": 1000,
+    "scene": 2200,
+    "summary": 1200,
+    **json.loads(os.getenv("CONTEXT_BUDGETS", "{}")),  # e.g. {"reply:GM": 2500}
+}
+
+def _context_budget(endpoint: str, role_type: Optional[str] = None) -> int:
+    if role_type and f"{endpoint}:{role_type}" in CONTEXT_BUDGETS:
+        return CONTEXT_BUDGETS[f"{endpoint}:{role_type}"]
+    return CONTEXT_BUDGETS.get(endpoint, 1500)
+
+def _truncate_to_tokens(text: str, tokens: int, budget: int) -> str:
+    keep = max(1, len(text) * budget // max(tokens, 1))
+    return "…" + text[-keep:]
+
+def _tail_within_budget(lines: list[str], toks: list[int], budget: int, skip: int = 0) -> list[str]:
+    """Newest-first contiguous tail of lines[:len-skip] that fits budget.
+    toks는 lines의 끝부분과 정렬된 추정치. 예산을 넘는 긴 줄(장면 묘사 등)은 남은 예산만큼 잘라서 넣고 멈춘다."""
+    out: list[str] = []
+    remaining = budget
+    end = len(lines) - skip
+    offset = len(lines) - len(toks)
+    for i in range(end - 1, max(end - CONTEXT_MAX_LINES, offset) - 1, -1):
+        t = toks[i - offset]
+        if t > remaining:
+            if remaining >= 32:
+                out.append(_truncate_to_tokens(lines[i], t, remaining))
+            break
+        out.append(lines[i])
+        remaining -= t
+    out.reverse()
+    return out
+
+def _select_history(state: "SessionState", budget: int) -> list[str]:
+    return _tail_within_budget(state.history, state.history_tokens(), budget)
+
+def _select_context(state: "SessionState", budget: int, notes: List[str]) -> tuple[list[str], List[str]]:
+    """Fill budget by priority: newest CONTEXT_MIN_RECENT lines → retrieved notes (rank order) → older history."""
+    toks = state.history_tokens()
+    recent = _tail_within_budget(state.history, toks, int(budget * CONTEXT_RECENT_SHARE))[-CONTEXT_MIN_RECENT:]
+    remaining = budget - sum(_estimate_tokens(l) for l in recent)
+    kept_notes = []
+    for note in notes:
+        t = _estimate_tokens(note)
+        if t <= remaining:
+            kept_notes.append(note)
+            remaining -= t
+    older = _tail_within_budget(state.history, toks, remaining, skip=len(recent)) if len(recent) == CONTEXT_MIN_RECENT else []
+    return older + recent, kept_notes
+
+def _budget_core(core: dict, budget: int = CONTEXT_CORE_BUDGET) -> dict:
+    """Trim story_core's growing lists (newest first) to the core budget. 결정적이라 prefix 안정성은 유지."""
+    list_keys = [k for k in ("open_threads", "facts", "relationships") if isinstance(core.get(k), list)]
+    fixed = {k: v for k, v in core.items() if k not in list_keys}
+    remaining = budget - _estimate_tokens(json.dumps(fixed, ensure_ascii=False))
+    kept: Dict[str, list] = {}
+    for key in list_keys:
+        items = []
+        for item in reversed(core[key]):
+            t = _estimate_tokens(json.dumps(item, ensure_ascii=False))
+            if t > remaining:
+                break
+            items.append(item)
+            remaining -= t
+        kept[key] = items[::-1]
+    return {k: kept.get(k, v) for k, v in core.items()}
+
+# ==========================
+# Prompt assembly (prefix-stable)
+# ==========================
+# 매 턴 동일한 부분(core, outline/act, style, persona)을 항상 같은 순서·같은 바이트로 앞에 두어
+# provider 측 prompt caching이 적중하도록 하고, 조각별 json.dumps 결과는 캐시해 재직렬화를 피한다.
+_STYLE_CACHE: Dict[tuple[str, bool], str] = {}
+
+def _style_fragment(role_type: str, intro_done: bool) -> str:
+    """Serialized style block; only a handful of (role, intro) variants exist."""
+    key = (role_type, intro_done)
+    frag = _STYLE_CACHE.get(key)
+    if frag is not None:
+        return frag
+    # 장면 도입 1회만 허용하기 위한 플래그와 스타일 계산
+    keep_len = "3~7문장"
+    if role_type == "GM" and intro_done:
+        keep_len = "2~4문장"
+    elif role_type in {"NPC", "ENEMY"}:
+        keep_len = "1~3문장"
+    narration_cap = 1 if (role_type == "GM" and intro_done) else 6
+    dialogue_first = True if (role_type in {"NPC", "ENEMY"} or intro_done) else False
+    no_recap = True if intro_done else False
+    frag = _STYLE_CACHE[key] = json.dumps({
+        "keep_length": keep_len,
+        "stay_in_character": True,
+        "avoid_ooc": True,
+        "avoid_act_mentions": True,
+        "no_explicit_act_numbers": True,
+        "no_role_labels": True,
+        "plain_text_only": True,
+        "no_code_blocks": True,
+        "sensory_detail": True,
+        "offer_next_step": True,
+        "no_echo_user": True,
+        "consistent_tone": True,
+        "narration_cap": narration_cap,
+        "dialogue_first": dialogue_first,
+        "no_recap": no_recap,
+        "link_to_previous": True,
+        "question_cap": 1,
+        "avoid_exposition_reuse": True,
+    }, ensure_ascii=False)
+    return frag
+
+def _cached_fragment(state: "SessionState", key: str, build) -> str:
+    frag = state._prompt_cache.get(key)
+    if frag is None:
+        frag = state._prompt_cache[key] = build()
+    return frag
+
+def _core_fragment(state: "SessionState") -> str:
+    return _cached_fragment(state, "core", lambda: json.dumps(_budget_core(state.story_core), ensure_ascii=False))
+
+def _act_fragment(state: "SessionState", act: Optional[int]) -> str:
+    # plot_outline은 세션 생성 후 바뀌지 않으므로 무효화 불필요
+    return _cached_fragment(state, f"act:{act}", lambda: json.dumps(
+        next((a for a in state.plot_outline if a.get("act") == act), None), ensure_ascii=False,
+    ))
+
+def _persona_fragment(state: "SessionState", name: str, persona: Optional[Persona] = None) -> str:
+    """persona: 이번 턴에 쓸 (아직 세션에 반영되지 않았을 수 있는) persona. 저장된 것과 다르면 캐시하지 않고 직렬화."""
+    if persona is not None and state.personas.get(name) != persona:
+        return json.dumps(persona.model_dump(), ensure_ascii=False)
+    return _cached_fragment(state, f"persona:{name}", lambda: json.dumps(
+        state.personas[name].model_dump(), ensure_ascii=False,
+    ))
+
+def _summary_fragment(state: "SessionState", act: int) -> Optional[str]:
+    """Compacted-history summary of the act (history compaction 이후에만 존재)."""
+    node = state.summary_tree.get(str(act))
+    if not node:
+        return None
+    return _cached_fragment(state, f"summary:{act}", lambda: json.dumps(_budget_core(node["core"]), ensure_ascii=False))
+
+def _system_prefix(state: "SessionState", persona_name: str, role_type: str, intro_done: bool,
+                   persona: Optional[Persona] = None) -> str:
+    """Stable system message for /trpg/reply (json.dumps와 같은 형식으로 조각을 이어 붙임)."""
+    summary = _summary_fragment(state, state.current_act)
+    return (
+        f'{{"story_core": {_core_fragment(state)}, '
+        f'"current_act": {state.current_act}, '
+        f'"act_info": {_act_fragment(state, state.current_act)}, '
+        + (f'"act_summary": {summary}, ' if summary else "")
+        + f'"style": {_style_fragment(role_type, intro_done)}, '
+        f'"persona": {_persona_fragment(state, persona_name, persona)}}}'
+    )
+
 # ==========================
 # Schemas
 # ==========================
@@ -390,28 +719,179 @@ class TRPGRequest(BaseModel):
     situation: str
     character: str
     persona: Optional[dict] = None  # 선택: Persona 스키마
+    stream: bool = False  # true → text/event-stream 으로 토큰 단위 전송
 
 class InitStoryRequest(BaseModel):
     core: dict  # 세계관/배경 핵심 정보
 
- # Helper: create session from core (used by /trpg/init and /dev/quickstart)
-def _create_session_from_core(story_core: dict) -> tuple[str, list[dict]]:
-    system_msg = {"role": "system", "content": json.dumps({"core": story_core}, ensure_ascii=False)}
-    user_msg = {
-        "role": "user",
-        "content": "이야기를 5막 구조로 분할해줘. 각 막의 목표와 주요 사건을 JSON 배열로 간략히 정리해줘. 각 항목은 {\"act\": number, \"description\": string} 형태.",
-    }
+# ==========================
+# Outline cache (content-addressed)
+# ==========================
+# 같은 story_core + model + 프롬프트 버전이면 막 구조 생성을 재사용한다.
+# 키마다 OUTLINE_CACHE_VARIANTS개까지 서로 다른 outline을 모은다. 하나라도 있으면 그중 하나를 무작위로 바로 돌려주고,
+# 모자란 variant는 백그라운드에서 채운다 (키당 한 번에 하나씩).
+# 프롬프트를 바꾸면 OUTLINE_PROMPT_VERSION을 올려 이전 캐시를 자연스럽게 무효화한다.
+OUTLINE_PROMPT_VERSION = "v1"
+OUTLINE_PROMPT = "이야기를 5막 구조로 분할해줘. 각 막의 목표와 주요 사건을 JSON 배열로 간략히 정리해줘. 각 항목은 {\"act\": number, \"description\": string} 형태."
+OUTLINE_CACHE_DIR = Path(os.getenv("OUTLINE_CACHE_DIR", str(Path(__file__).parent / "cache" / "outlines")))
+OUTLINE_CACHE_VARIANTS = int(os.getenv("OUTLINE_CACHE_VARIANTS", "3"))        # 키당 보관할 outline 수 (0 → 캐시 끔)
+OUTLINE_CACHE_TTL = float(os.getenv("OUTLINE_CACHE_TTL", str(7 * 24 * 3600)))  # variant 유효기간(초)
+OUTLINE_CACHE_MAX = int(os.getenv("OUTLINE_CACHE_MAX", "1000"))               # 보관할 키 수 (LRU)
+
+
+def outline_key(story_core: dict, model: str = MODEL_DEFAULT, version: str = OUTLINE_PROMPT_VERSION) -> str:
+    """Canonical content hash: key order/whitespace in story_core do not matter."""
+    canon = json.dumps({"core": story_core, "model": model, "prompt": version},
+                       sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canon.encode("utf-8")).hexdigest()
+
+
+def _parse_outline(content: str) -> tuple[Optional[list[dict]], bool]:
+    """Model output → (outline, cacheable).
+    JSON 배열 {act, description} → 캐시 가능. JSON이 아닌 줄글은 예전처럼 한 줄을 한 막으로 쓰되 캐시에는 넣지 않는다.
+    빈 응답이나 형식이 틀린 JSON은 (None, False) → 기본 outline."""
+    text = (content or "").strip()
+    if text.startswith("```"):
+        text = text.strip("`").removeprefix("json").strip()
     try:
-        response = chat([system_msg, user_msg], max_tokens=300)
-        content = response.choices[0].message.content or ""
+        outline = json.loads(text)
+    except Exception:
+        lines = [s for s in text.splitlines() if s.strip()]
+        if not lines:
+            return None, False
+        return [{"act": i + 1, "description": line} for i, line in enumerate(lines)], False
+    return (outline, True) if _valid_outline(outline) else (None, False)
+
+def _valid_outline(outline) -> bool:
+    return isinstance(outline, list) and bool(outline) and all(
+        isinstance(e, dict) and isinstance(e.get("act"), int) and not isinstance(e.get("act"), bool)
+        and isinstance(e.get("description"), str) and e["description"].strip()
+        for e in outline
+    )
+
+
+class OutlineCache:
+    """Persistent outline variants per key: one JSON file per key, LRU over keys, TTL per variant."""
+
+    def __init__(self, directory: Path = OUTLINE_CACHE_DIR, variants: int = OUTLINE_CACHE_VARIANTS,
+                 ttl: float = OUTLINE_CACHE_TTL, max_keys: int = OUTLINE_CACHE_MAX):
+        self.dir = directory
+        self.variants = variants
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._keys: "OrderedDict[str, None]" = OrderedDict()   # LRU 순서 (앞쪽이 가장 오래됨)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if variants > 0:
+            try:
+                self.dir.mkdir(parents=True, exist_ok=True)
+                files = sorted(self.dir.glob("*.json"), key=lambda p: p.stat().st_mtime)
+                for p in files:
+                    self._keys[p.stem] = None
+                self._evict_overflow()
+            except Exception:
+                self.variants = 0
+
+    def _path(self, key: str) -> Path:
+        return self.dir / f"{key}.json"
+
+    def _read(self, key: str) -> list[dict]:
         try:
-            outline = json.loads(content)
+            entries = json.loads(self._path(key).read_text(encoding="utf-8"))
         except Exception:
-            outline = [
-                {"act": i + 1, "description": line}
-                for i, line in enumerate([s for s in content.splitlines() if s.strip()])
-            ]
+            return []
+        now = time.time()
+        return [e for e in entries if now - e.get("created", 0) < self.ttl and _valid_outline(e.get("outline"))]
+
+    def _evict_overflow(self) -> None:
+        while len(self._keys) > self.max_keys:
+            old, _ = self._keys.popitem(last=False)
+            self._path(old).unlink(missing_ok=True)
+            self.evictions += 1
+
+    def pick(self, key: str) -> tuple[Optional[list[dict]], int]:
+        """(a random cached outline or None, 아직 모자란 variant 수).
+        None → caller가 직접 생성. 모자란 수가 0보다 크면 caller가 백그라운드로 채운다."""
+        if self.variants <= 0:
+            return None, 0
+        entries = self._read(key) if key in self._keys else []
+        if not entries:
+            self.misses += 1
+            return None, self.variants
+        self.hits += 1
+        self._keys.move_to_end(key)
+        return random.choice(entries)["outline"], self.variants - len(entries)
+
+    def add(self, key: str, outline: list[dict]) -> None:
+        if self.variants <= 0 or not _valid_outline(outline):
+            return
+        try:
+            entries = self._read(key) if key in self._keys else []
+            entries = (entries + [{"outline": outline, "created": time.time()}])[-self.variants:]
+            p = self._path(key)
+            tmp = p.with_suffix(".json.tmp")
+            tmp.write_text(json.dumps(entries, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, p)
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            self._evict_overflow()
+        except Exception:
+            pass
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "keys": len(self._keys),
+            "variants_per_key": self.variants,
+        }
+
+outline_cache = OutlineCache()
+_outline_fills: Dict[str, asyncio.Task] = {}   # key → 백그라운드 variant 채우기 (키당 하나)
+
+
+async def _generate_outline(story_core: dict, purpose: str = "outline") -> tuple[Optional[list[dict]], bool]:
+    system_msg = {"role": "system", "content": json.dumps({"core": story_core}, ensure_ascii=False)}
+    user_msg = {"role": "user", "content": OUTLINE_PROMPT}
+    try:
+        response = await achat([system_msg, user_msg], purpose=purpose, max_tokens=300)
+        content = response.choices[0].message.content or ""
     except Exception:
+        return None, False
+    return _parse_outline(content)
+
+async def _fill_outline_variants(key: str, story_core: dict, missing: int) -> None:
+    try:
+        # 캐시할 수 없는 응답(줄글/오류)도 시도 횟수로 센다 → 모델이 계속 줄글을 내도 무한 반복하지 않음
+        for _ in range(missing):
+            outline, cacheable = await _generate_outline(story_core, purpose="outline:fill")
+            if cacheable:
+                outline_cache.add(key, outline)
+    finally:
+        _outline_fills.pop(key, None)
+
+def _schedule_outline_fill(key: str, story_core: dict, missing: int) -> None:
+    if missing <= 0 or key in _outline_fills:
+        return
+    task = asyncio.get_running_loop().create_task(_fill_outline_variants(key, story_core, missing))
+    _outline_fills[key] = task
+
+ # Helper: create session from core (used by /trpg/init and /dev/quickstart)
+async def _create_session_from_core(story_core: dict) -> tuple[str, list[dict]]:
+    key = outline_key(story_core)
+    outline, missing = outline_cache.pick(key)
+    if outline is None:
+        with stage("llm"):
+            outline, cacheable = await _generate_outline(story_core)
+        if cacheable:
+            outline_cache.add(key, outline)
+            missing -= 1
+    _schedule_outline_fill(key, story_core, missing)
+    if outline is None:
         # 모델 오류시 최소 안전한 기본값
         outline = [
             {"act": 1, "description": "도입"},
@@ -428,34 +908,107 @@ def _create_session_from_core(story_core: dict) -> tuple[str, list[dict]]:
         history=[],
         personas={},
     )
-    sessions[session_id] = state
-    save_session(session_id, state)
+    with stage("save_session"):
+        sessions.put(session_id, state)
+        await sessions.aflush(session_id)  # 다른 worker가 바로 이 sid를 찾을 수 있도록 즉시 기록
     return session_id, outline
 
 # ==========================
 # Endpoints
 # ==========================
 @app.post("/trpg/init")
-def init_story(request: InitStoryRequest):
+async def init_story(request: InitStoryRequest):
     """세션 생성 + 5막 아웃라인 작성 + 초기 상태 저장"""
     story_core = request.core
-    session_id, outline = _create_session_from_core(story_core)
+    session_id, outline = await _create_session_from_core(story_core)
     return {"session_id": session_id, "outline": outline}
 
 @app.post("/trpg/reply")
-def trpg_reply(request: TRPGRequest):
-    # 세션 로드 (디스크 → 메모리 캐시)
-    state = load_session(request.session_id) or sessions.get(request.session_id)
+async def trpg_reply(request: TRPGRequest):
+    # 세션 로드 (메모리 캐시 → miss 시 디스크)
+    with stage("load_session"):
+        state = await sessions.aget(request.session_id)
     if not state:
         return {"error": "Invalid session_id"}
-
+    if request.stream:
+        return StreamingResponse(_stream_reply(request), media_type="text/event-stream")
+    if SESSION_COALESCE_TURNS:
+        return await _coalesced_reply(request)
+    async with session_lock(request.session_id):
+        return await _reply_turn(request)
+
+async def _reply_turn(request: TRPGRequest, inputs: Optional[list[str]] = None) -> dict:
+    """One turn under the session lock: prepare → chat → finish."""
+    with stage("load_session"):
+        state = await sessions.aget(request.session_id)
+    if not state:
+        return {"error": "Invalid session_id"}
+    persona, roll_info, messages = await _prepare_reply(request, state)
+    try:
+        with stage("llm"):
+            response = await achat(messages, purpose="reply", temperature=0.8, max_tokens=180)
+        reply = response.choices[0].message.content or ""
+        reply = _normalize_reply(reply)
+    except Exception as e:
+        return {"error": str(e)}
+    with stage("finish"):
+        return await _finish_reply(request, state, persona, roll_info, reply, inputs)
+
+def _turn_key(request: TRPGRequest) -> tuple[str, str]:
+    return ((request.role or "").strip().lower(), request.character or "")
+
+# lock을 기다리는 동안 쌓인 같은 화자 턴을 한 번의 모델 호출로 처리 (_coalesced_reply)
+SESSION_COALESCE_TURNS = os.getenv("SESSION_COALESCE_TURNS", "false").lower() == "true"
+_queued_turns: Dict[str, list[tuple[TRPGRequest, asyncio.Future]]] = {}
+
+async def _coalesced_reply(request: TRPGRequest) -> dict:
+    """SESSION_COALESCE_TURNS: lock을 기다리는 동안 쌓인 같은 화자(role+character) 턴을 한 번의 모델 호출로 처리.
+    lock을 먼저 잡은 요청이 대기열을 가져가 처리하고, 나머지는 같은 결과를 받는다."""
+    sid = request.session_id
+    fut = asyncio.get_running_loop().create_future()
+    _queued_turns.setdefault(sid, []).append((request, fut))
+    async with session_lock(sid):
+        if not fut.done():
+            key = _turn_key(request)
+            queue = _queued_turns.pop(sid, [])
+            batch = [t for t in queue if _turn_key(t[0]) == key]
+            rest = [t for t in queue if _turn_key(t[0]) != key]
+            if rest:
+                _queued_turns[sid] = rest
+            if not any(f is fut for _, f in batch):
+                batch.insert(0, (request, fut))
+            inputs = [r.user_input for r, _ in batch]
+            merged = request.model_copy(update={"user_input": "\n".join(inputs)})
+            try:
+                result = await _reply_turn(merged, inputs)
+            except asyncio.CancelledError:
+                # 처리 못 한 대기자는 대기열로 돌려놓아 다음 lock 보유자가 처리
+                others = [t for t in batch if t[1] is not fut and not t[1].done()]
+                if others:
+                    _queued_turns.setdefault(sid, [])[:0] = others
+                raise
+            except Exception as e:
+                result = {"error": str(e)}
+            for _, f in batch:
+                if not f.done():
+                    f.set_result(result)
+    return fut.result()
+
+def _roll_line(roll_info: dict) -> str:
+    return f"roll: {roll_info['detail']}"
+
+async def _prepare_reply(request: TRPGRequest, state: SessionState) -> tuple[Persona, Optional[dict], list[dict]]:
+    """Retrieval, roll inference, persona and prompt assembly for one reply."""
     # 메모리 검색 (retrieval)
-    retrieved_notes = memory_query(request.session_id, request.user_input, MEMORY_TOP_K)
+    with stage("retrieval"):
+        retrieved_notes = await amemory_query(request.session_id, request.user_input, MEMORY_TOP_K)
 
     # 주사위 롤 파싱 (인터럽트하지 않고 컨텍스트로 전달)
-    roll_info = infer_roll_from_texts(request.user_input, request.character, state.story_core)
-    if roll_info:
-        state.history.append(f"roll: {roll_info['detail']}")
+    # roll 줄과 persona는 여기서 세션에 쓰지 않는다: 응답이 성공해야 _finish_reply에서 함께 기록 (실패/중단 시 버려짐)
+    with stage("infer_roll"):
+        roll_info = infer_roll_from_texts(request.user_input, request.character, state.story_core)
+    t0 = time.perf_counter()
+    roll_line = [_roll_line(roll_info)] if roll_info else []
 
     # 역할 정규화
     role_norm = (request.role or "").strip().lower()
@@ -483,53 +1036,15 @@ def trpg_reply(request: TRPGRequest):
     else:
         persona = Persona(role_type=role_type, name=speaker_name)
 
-    # 세션에 페르소나 캐시(이름 기준)
-    state.personas[persona.name] = persona
-
-    # 장면 도입 1회만 허용하기 위한 플래그와 스타일 계산
     intro_done = getattr(state, "scene_intro_done", False)
-    keep_len = "3~7문장"
-    if role_type == "GM" and intro_done:
-        keep_len = "2~4문장"
-    elif role_type in {"NPC", "ENEMY"}:
-        keep_len = "1~3문장"
-    narration_cap = 1 if (role_type == "GM" and intro_done) else 6
-    dialogue_first = True if (role_type in {"NPC", "ENEMY"} or intro_done) else False
-    no_recap = True if intro_done else False
 
-    # 시스템 컨텍스트 구성
-    act_info = next((a for a in state.plot_outline if a.get("act") == state.current_act), None)
-    system_context = {
-        "story_core": state.story_core,
-        "current_act": state.current_act,
-        "act_info": act_info,
-        "persona": persona.model_dump(),
-        "style": {
-            "keep_length": keep_len,
-            "stay_in_character": True,
-            "avoid_ooc": True,
-            "avoid_act_mentions": True,
-            "no_explicit_act_numbers": True,
-            "no_role_labels": True,
-            "plain_text_only": True,
-            "no_code_blocks": True,
-            "sensory_detail": True,
-            "offer_next_step": True,
-            "no_echo_user": True,
-            "consistent_tone": True,
-            "narration_cap": narration_cap,
-            "dialogue_first": dialogue_first,
-            "no_recap": no_recap,
-            "link_to_previous": True,
-            "question_cap": 1,
-            "avoid_exposition_reuse": True,
-        },
-        "retrieved_notes": retrieved_notes,
-        "roll": roll_info,
-    }
+    # 토큰 예산 안에서 최근 대화 → 검색 노트 → 오래된 대화 순으로 채움
+    budget = _context_budget("reply", role_type) - sum(_estimate_tokens(l) for l in roll_line)
+    history_lines, retrieved_notes = _select_context(state, budget, retrieved_notes)
+    history_lines += roll_line
 
     user_content = (
-        f"지금까지 대화:\n{chr(10).join(state.history[-20:])}\n"
+        f"지금까지 대화:\n{chr(10).join(history_lines)}\n"
         f"플레이어 입력: {request.user_input}\n"
     )
     if roll_info:
@@ -574,38 +1089,70 @@ def trpg_reply(request: TRPGRequest):
         "- 마지막 문장은 플레이어가 선택할 수 있는 다음 행동의 여지를 한 문장으로 제시한다.\n"
         "- 챕터/Act 번호는 언급하지 않는다."
     )
-    system_msg = {"role": "system", "content": json.dumps(system_context, ensure_ascii=False)}
+    # 고정 prefix(core → act → style → persona) 다음에 턴마다 바뀌는 검색 노트/주사위를 둔다
+    system_msg = {"role": "system", "content": _system_prefix(state, persona.name, role_type, intro_done, persona)}
+    turn_msg = {
+        "role": "system",
+        "content": json.dumps({"retrieved_notes": retrieved_notes, "roll": roll_info}, ensure_ascii=False),
+    }
     user_msg = {"role": "user", "content": user_content}
-
-    try:
-        response = chat([system_msg, user_msg], temperature=0.8, max_tokens=180)
-        reply = response.choices[0].message.content or ""
-        reply = _normalize_reply(reply)
-        # 첫 GM 응답 이후에는 도입을 반복하지 않도록 플래그 설정
-        if role_type == "GM" and not getattr(state, "scene_intro_done", False):
-            state.scene_intro_done = True
-    except Exception as e:
-        return {"error": str(e)}
-
-    # 장기 기억 저장 (요약/검색용)
-    try:
-        turn_text = f"Player: {request.user_input}\n{persona.name}: {reply}"
-        memory_upsert(request.session_id, [turn_text], [{"act": state.current_act, "speaker": persona.name}])
-    except Exception:
-        pass
-
-    # 히스토리 기록 & 저장
-    state.history.append(request.user_input)
-    state.history.append(f"{persona.name}: {reply}")
-    sessions[request.session_id] = state
-    save_session(request.session_id, state)
-
-    # N라인마다 핵심기억 업데이트
-    if len(state.history) % MEMORY_EVERY_N == 0:
-        core = extract_core_from(state.history)
-        if core:
-            state.story_core = merge_core(state.story_core, core)
-            save_session(request.session_id, state)
+    record_stage("prompt", time.perf_counter() - t0)
+    return persona, roll_info, [system_msg, turn_msg, user_msg]
+
+async def _stream_reply(request: TRPGRequest):
+    """SSE generator for /trpg/reply?stream: token 이벤트들 → done(최종 결과). 스트림 동안 session lock 유지."""
+    async with session_lock(request.session_id):
+        with stage("load_session"):
+            state = await sessions.aget(request.session_id)
+        if not state:
+            yield _sse("error", {"error": "Invalid session_id"})
+            return
+        persona, roll_info, messages = await _prepare_reply(request, state)
+        if roll_info:
+            yield _sse("roll", {"roll": roll_info["total"], "detail": roll_info["detail"]})
+        norm = _ReplyStreamNormalizer()
+        raw = ""
+        t0 = time.perf_counter()
+        try:
+            async for delta in achat_stream(messages, purpose="reply", temperature=0.8, max_tokens=180):
+                raw += delta
+                out = norm.feed(delta)
+                if out:
+                    yield _sse("token", {"text": out})
+            tail = norm.finish()
+            if tail:
+                yield _sse("token", {"text": tail})
+        except Exception as e:
+            yield _sse("error", {"error": str(e)})
+            return
+        record_stage("llm", time.perf_counter() - t0)
+        with stage("finish"):
+            result = await _finish_reply(request, state, persona, roll_info, _normalize_reply(raw))
+        yield _sse("done", result)
+
+async def _finish_reply(request: TRPGRequest, state: SessionState, persona: Persona, roll_info: Optional[dict], reply: str, inputs: Optional[list[str]] = None) -> dict:
+    """Post-reply bookkeeping shared by the JSON and streaming paths."""
+    # 세션에 페르소나 캐시(이름 기준) — 응답이 성공한 뒤에만
+    state.set_persona(persona)
+    # 첫 GM 응답 이후에는 도입을 반복하지 않도록 플래그 설정
+    if persona.role_type == "GM":
+        state.set_intro_done(True)
+
+    # 히스토리 기록 & 저장 (roll 줄 → 입력 → 응답 순)
+    roll_line = [_roll_line(roll_info)] if roll_info else []
+    state.add_history(*roll_line, *(inputs or [request.user_input]), f"{persona.name}: {reply}")
+    with stage("save_session"):
+        sessions.put(request.session_id, state)
+
+    # 장기 기억 저장 + N라인마다 핵심기억 업데이트 → 백그라운드 (응답 지연에 포함되지 않음)
+    turn_text = f"Player: {request.user_input}\n{persona.name}: {reply}"
+    post_turn.submit(
+        request.session_id,
+        [turn_text],
+        [{"act": state.current_act, "speaker": persona.name}],
+        summarize=state.total_lines % MEMORY_EVERY_N == 0,
+        compact=len(state.history) > HISTORY_HOT_MAX,
+    )
 
     result = {
         "speaker": persona.name,
@@ -619,10 +1166,12 @@ def trpg_reply(request: TRPGRequest):
 class SceneRequest(BaseModel):
     session_id: str
     act: int
+    stream: bool = False
 
 @app.post("/trpg/scene")
-def scene(request: SceneRequest):
-    state = load_session(request.session_id) or sessions.get(request.session_id)
+async def scene(request: SceneRequest):
+    with stage("load_session"):
+        state = await sessions.aget(request.session_id)
     if not state:
         return {"error": "Invalid session_id"}
 
@@ -630,29 +1179,67 @@ def scene(request: SceneRequest):
     if not act_info:
         return {"error": f"Act {request.act} not found in outline."}
 
-    # 새 장면 시작 → 다음 GM 응답에서만 장면 소개 1회 허용
-    state.scene_intro_done = False
+    if request.stream:
+        return StreamingResponse(_stream_scene(request, act_info), media_type="text/event-stream")
 
+    async with session_lock(request.session_id):
+        with stage("load_session"):
+            state = await sessions.aget(request.session_id)
+        if not state:
+            return {"error": "Invalid session_id"}
+        with stage("prompt"):
+            messages = _prepare_scene(state, act_info)
+        try:
+            with stage("llm"):
+                response = await achat(messages, purpose="scene", temperature=0.8, max_tokens=320)
+            reply = response.choices[0].message.content or ""
+        except Exception as e:
+            return {"error": str(e)}
+        return _finish_scene(request, state, act_info, reply)
+
+def _prepare_scene(state: SessionState, act_info: dict) -> list[dict]:
+    # 상태는 건드리지 않는다 — intro 플래그 reset은 LLM 호출이 성공한 뒤 _finish_scene에서
     system_msg = {
         "role": "system",
-        "content": json.dumps({"core": state.story_core, "act": act_info}, ensure_ascii=False),
+        "content": f'{{"core": {_core_fragment(state)}, "act": {_act_fragment(state, act_info.get("act"))}}}',
     }
     user_msg = {
         "role": "user",
-        "content": f"현재까지 대화:\n{chr(10).join(state.history[-20:])}\n이제 다음 장면을 자연스럽게 이어가줘. (챕터/Act 번호는 언급하지 말 것.)",
+        "content": f"현재까지 대화:\n{chr(10).join(_select_history(state, _context_budget('scene')))}\n이제 다음 장면을 자연스럽게 이어가줘. (챕터/Act 번호는 언급하지 말 것.)",
     }
 
-    try:
-        response = chat([system_msg, user_msg], temperature=0.8, max_tokens=320)
-        reply = response.choices[0].message.content or ""
-    except Exception as e:
-        return {"error": str(e)}
+    return [system_msg, user_msg]
+
+async def _stream_scene(request: SceneRequest, act_info: dict):
+    """SSE generator for /trpg/scene?stream."""
+    async with session_lock(request.session_id):
+        with stage("load_session"):
+            state = await sessions.aget(request.session_id)
+        if not state:
+            yield _sse("error", {"error": "Invalid session_id"})
+            return
+        with stage("prompt"):
+            messages = _prepare_scene(state, act_info)
+        reply = ""
+        t0 = time.perf_counter()
+        try:
+            async for delta in achat_stream(messages, purpose="scene", temperature=0.8, max_tokens=320):
+                reply += delta
+                yield _sse("token", {"text": delta})
+        except Exception as e:
+            yield _sse("error", {"error": str(e)})
+            return
+        record_stage("llm", time.perf_counter() - t0)
+        yield _sse("done", _finish_scene(request, state, act_info, reply))
 
-    state.history.append(f"Act {request.act} scene: {reply}")
-    state.current_act = request.act
+def _finish_scene(request: SceneRequest, state: SessionState, act_info: dict, reply: str) -> dict:
+    # 새 장면 시작 → 다음 GM 응답에서만 장면 소개 1회 허용 (장면 생성이 성공했을 때만)
+    state.set_intro_done(False)
+    state.add_history(f"Act {request.act} scene: {reply}")
+    state.set_act(request.act)
 
-    sessions[request.session_id] = state
-    save_session(request.session_id, state)
+    with stage("save_session"):
+        sessions.put(request.session_id, state)
 
     return {
         "act": request.act,
@@ -661,13 +1248,144 @@ def scene(request: SceneRequest):
     }
 
 
+# ==========================
+# Stats endpoints
+# ==========================
+
+@app.get("/stats/embeddings")
+async def embedding_stats():
+    """Embedding batcher + cache metrics (window/batch-size 튜닝용)."""
+    return {**embed_batcher.snapshot(), "cache": embed_cache.snapshot()}
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus scrape endpoint (text exposition format)."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats/llm")
+async def llm_stats():
+    """Scheduler queue depth per priority, wait percentiles and rate-limit bucket levels."""
+    return llm_scheduler.snapshot()
+
+@app.get("/stats/models")
+async def model_stats():
+    """Per-model latency/error window, breaker state and hedge counts."""
+    return router.snapshot()
+
+@app.get("/stats/outlines")
+async def outline_stats():
+    return outline_cache.snapshot()
+
+@app.get("/stats/post_turn")
+async def post_turn_stats():
+    """Background post-turn queue: depth, overflow (queue full → deferred), retries and drops."""
+    return post_turn.snapshot()
+
+@app.get("/stats/memory")
+async def memory_stats():
+    """Open memory partitions, loads/evictions and legacy-collection adoption progress."""
+    store = memory_partitions or local_memory
+    return store.snapshot() if store is not None else {"mode": "disabled"}
+
+
+# ==========================
+# Dice endpoints
+# ==========================
+ROLL_BATCH_MAX = int(os.getenv("ROLL_BATCH_MAX", "100"))
+ROLL_BATCH_MAX_REPEAT = int(os.getenv("ROLL_BATCH_MAX_REPEAT", "100000"))
+ROLL_BATCH_MAX_CELLS = int(os.getenv("ROLL_BATCH_MAX_CELLS", "5000000"))         # 표현식 하나의 repeat × 주사위 수
+ROLL_BATCH_MAX_TOTAL_CELLS = int(os.getenv("ROLL_BATCH_MAX_TOTAL_CELLS", "20000000"))  # 요청 전체 합
+ROLL_BATCH_RAW_MAX = int(os.getenv("ROLL_BATCH_RAW_MAX", "1000"))   # repeat가 이보다 크면 totals 대신 histogram
+ROLL_BATCH_HIST_BINS = 100
+
+def _roll_histogram(totals: np.ndarray) -> dict:
+    """Exact value → count when the spread is small, otherwise ROLL_BATCH_HIST_BINS equal-width bins."""
+    values, counts = np.unique(totals, return_counts=True)
+    if len(values) <= ROLL_BATCH_HIST_BINS:
+        return {"values": values.tolist(), "counts": counts.tolist()}
+    counts, edges = np.histogram(totals, bins=ROLL_BATCH_HIST_BINS)
+    return {"edges": [round(float(e), 3) for e in edges], "counts": counts.tolist()}
+
+class RollBatchRequest(BaseModel):
+    expressions: List[str]
+    repeat: int = 1   # 같은 표현식을 몇 번 굴릴지 (대량 공격/몹 판정 등)
+
+@app.post("/trpg/roll/batch")
+async def roll_batch(req: RollBatchRequest):
+    """Roll many expressions in one call. repeat > 1 rolls vectorised and returns summary stats;
+    repeat <= ROLL_BATCH_RAW_MAX면 totals 전체, 그보다 크면 histogram.
+    repeat × 주사위 수는 표현식마다, 요청 전체로 상한을 두고 굴리기 전에 확인한다."""
+    if len(req.expressions) > ROLL_BATCH_MAX:
+        return {"error": f"too many expressions (max {ROLL_BATCH_MAX})"}
+    if not 1 <= req.repeat <= ROLL_BATCH_MAX_REPEAT:
+        return {"error": f"repeat must be between 1 and {ROLL_BATCH_MAX_REPEAT}"}
+    cells: Dict[str, int] = {}
+    for expr in req.expressions:
+        try:
+            cells[expr] = dice_cells(expr) * req.repeat
+        except ValueError:
+            continue  # 아래에서 표현식별 error로 보고
+        if cells[expr] > ROLL_BATCH_MAX_CELLS:
+            return {"error": f"{expr}: repeat × dice {cells[expr]} exceeds {ROLL_BATCH_MAX_CELLS}"}
+    total_cells = sum(cells[e] for e in req.expressions if e in cells)
+    if total_cells > ROLL_BATCH_MAX_TOTAL_CELLS:
+        return {"error": f"repeat × dice over all expressions {total_cells} exceeds {ROLL_BATCH_MAX_TOTAL_CELLS}"}
+    results = []
+    for expr in req.expressions:
+        try:
+            if req.repeat == 1:
+                total, detail = roll_dice(expr)
+                results.append({"expr": expr, "total": total, "detail": detail})
+                continue
+            totals = roll_dice_many(expr, req.repeat)
+            out = {
+                "expr": expr,
+                "sum": int(totals.sum()),
+                "min": int(totals.min()),
+                "max": int(totals.max()),
+                "mean": round(float(totals.mean()), 3),
+                "std": round(float(totals.std()), 3),
+            }
+            if req.repeat <= ROLL_BATCH_RAW_MAX:
+                out["totals"] = totals.tolist()
+            else:
+                out["histogram"] = _roll_histogram(totals)
+            results.append(out)
+        except ValueError as e:
+            results.append({"expr": expr, "error": str(e)})
+    return {"results": results}
+
+class RollOddsRequest(BaseModel):
+    expr: str
+    target: Optional[int] = None
+    compare: str = "<="   # ">=", "<=", ">", "<", "="
+
+@app.post("/trpg/roll/odds")
+async def roll_odds(req: RollOddsRequest):
+    """Exact PMF/CDF/mean/variance of a dice expression and the success chance against target."""
+    try:
+        return dice_stats(req.expr, req.target, req.compare)
+    except ValueError as e:
+        return {"error": str(e)}
+
+
 # ==========================
 # Session/Persona endpoints
 # ==========================
 
 @app.get("/trpg/session/{sid}")
-def get_session(sid: str):
-    state = load_session(sid) or sessions.get(sid)
+async def get_session(sid: str):
+    if SESSION_CODEC == "binary" and sid not in sessions:
+        # 캐시에 없는 세션은 가능하면 스냅샷에서 필요한 부분만 읽고 캐시에 올리지 않는다 (store I/O는 스레드에서)
+        try:
+            with stage("load_session"):
+                view = await asyncio.to_thread(peek_session, sid)
+        except Exception:
+            view = None
+        if view is not None and sid not in sessions:  # 읽는 사이 캐시에 올라와 바뀌었으면 캐시 쪽을 쓴다
+            return view
+    with stage("load_session"):
+        state = await sessions.aget(sid)
     if not state:
         raise HTTPException(status_code=404, detail="Invalid session_id")
     return {
@@ -679,6 +1397,21 @@ def get_session(sid: str):
         "personas": {k: v.model_dump() for k, v in state.personas.items()},
     }
 
+@app.get("/trpg/session/{sid}/history")
+async def get_session_history(sid: str, before: Optional[int] = None, after: Optional[int] = None, limit: int = 50,
+                              act: Optional[int] = None, speaker: Optional[str] = None):
+    """Cursor-paginated history (archive 포함). speaker는 "이름:" 접두어, "scene", 또는 ""(접두어 없는 입력)."""
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    with stage("load_session"):
+        state = await sessions.aget(sid)
+    if not state:
+        raise HTTPException(status_code=404, detail="Invalid session_id")
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    # hot 부분은 루프에서 떠 두고(최대 HISTORY_HOT_MAX줄), archive index/seek는 스레드에서
+    archived, hot, hot_meta = state.archived_lines, list(state.history), list(state.history_meta())
+    return await asyncio.to_thread(history_page, sid, archived, hot, hot_meta, before, after, limit, act, speaker)
+
 class PersonaSetRequest(BaseModel):
     session_id: str
     character: str
@@ -686,8 +1419,13 @@ class PersonaSetRequest(BaseModel):
     persona: dict
 
 @app.post("/trpg/persona")
-def set_persona(req: PersonaSetRequest):
-    state = load_session(req.session_id) or sessions.get(req.session_id)
+async def set_persona(req: PersonaSetRequest):
+    async with session_lock(req.session_id):
+        return await _set_persona_locked(req)
+
+async def _set_persona_locked(req: PersonaSetRequest) -> dict:
+    with stage("load_session"):
+        state = await sessions.aget(req.session_id)
     if not state:
         raise HTTPException(status_code=404, detail="Invalid session_id")
     role_norm = (req.role or "").strip().lower()
@@ -700,8 +1438,9 @@ def set_persona(req: PersonaSetRequest):
     else:
         role_type = "PLAYER"
     p = Persona(role_type=role_type, name=req.character, **(req.persona or {}))
-    state.personas[p.name] = p
-    save_session(req.session_id, state)
+    state.set_persona(p)
+    with stage("save_session"):
+        sessions.put(req.session_id, state)
     return {"ok": True, "persona": p.model_dump()}
 
 
@@ -717,60 +1456,61 @@ class DevSayRequest(BaseModel):
     character: Optional[str] = None
     persona: Optional[dict] = None
 
-def ensure_dev_session(world: str = "도시 미스터리", theme: str = "기이한 실종") -> str:
+async def ensure_dev_session(world: str = "도시 미스터리", theme: str = "기이한 실종") -> str:
     global DEV_SESSION_ID
-    if DEV_SESSION_ID and (load_session(DEV_SESSION_ID) or sessions.get(DEV_SESSION_ID)):
+    if DEV_SESSION_ID and await sessions.aget(DEV_SESSION_ID):
         return DEV_SESSION_ID
-    sid, _ = _create_session_from_core({"world": world, "theme": theme})
+    sid, _ = await _create_session_from_core({"world": world, "theme": theme})
     DEV_SESSION_ID = sid
     return sid
 
 @app.post("/dev/quickstart")
-def dev_quickstart(req: DevInitRequest):
+async def dev_quickstart(req: DevInitRequest):
     if not DEV_MODE:
         return {"error": "DEV_MODE is disabled. Set DEV_MODE=true in .env to enable."}
-    sid = ensure_dev_session(req.world or "도시 미스터리", req.theme or "기이한 실종")
-    state = load_session(sid) or sessions.get(sid)
+    sid = await ensure_dev_session(req.world or "도시 미스터리", req.theme or "기이한 실종")
+    with stage("load_session"):
+        state = await sessions.aget(sid)
     return {"session_id": sid, "outline": state.plot_outline if state else []}
 
 @app.post("/dev/gm")
-def dev_gm(req: DevSayRequest):
+async def dev_gm(req: DevSayRequest):
     if not DEV_MODE:
         return {"error": "DEV_MODE disabled"}
-    sid = ensure_dev_session()
+    sid = await ensure_dev_session()
     tr = TRPGRequest(session_id=sid, user_input=req.msg, role="gm", situation="dev", character=req.character or "사회자", persona=req.persona)
-    return trpg_reply(tr)
+    return await trpg_reply(tr)
 
 @app.post("/dev/npc")
-def dev_npc(req: DevSayRequest):
+async def dev_npc(req: DevSayRequest):
     if not DEV_MODE:
         return {"error": "DEV_MODE disabled"}
-    sid = ensure_dev_session()
+    sid = await ensure_dev_session()
     tr = TRPGRequest(session_id=sid, user_input=req.msg, role="npc", situation="dev", character=req.character or "NPC", persona=req.persona)
-    return trpg_reply(tr)
+    return await trpg_reply(tr)
 
 @app.post("/dev/enemy")
-def dev_enemy(req: DevSayRequest):
+async def dev_enemy(req: DevSayRequest):
     if not DEV_MODE:
         return {"error": "DEV_MODE disabled"}
-    sid = ensure_dev_session()
+    sid = await ensure_dev_session()
     tr = TRPGRequest(session_id=sid, user_input=req.msg, role="enemy", situation="dev", character=req.character or "적", persona=req.persona)
-    return trpg_reply(tr)
+    return await trpg_reply(tr)
 
 @app.post("/dev/roll")
-def dev_roll(req: DevSayRequest):
+async def dev_roll(req: DevSayRequest):
     if not DEV_MODE:
         return {"error": "DEV_MODE disabled"}
-    sid = ensure_dev_session()
+    sid = await ensure_dev_session()
     tr = TRPGRequest(session_id=sid, user_input=req.msg, role="gm", situation="dev", character="사회자")
-    return trpg_reply(tr)
+    return await trpg_reply(tr)
 
 @app.post("/dev/scene")
-def dev_scene(act: SceneRequest):
+async def dev_scene(act: SceneRequest):
     if not DEV_MODE:
         return {"error": "DEV_MODE disabled"}
-    sid = ensure_dev_session()
-    return scene(SceneRequest(session_id=sid, act=act.act))
+    sid = await ensure_dev_session()
+    return await scene(SceneRequest(session_id=sid, act=act.act, stream=act.stream))
 
 @app.get("/dev/ui", response_class=HTMLResponse)
 def dev_ui():
@@ -0,0 +1,817 @@
+"""Embeddings (two-tier cache + micro-batcher) and long-term vector memory (Chroma partitions / local store)."""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from models import _estimate_tokens
+from scheduler import LLM_PRIORITIES, _record_llm, aclient, llm_scheduler
+
+# Optional vector store (Chroma) for long-term memory
+try:
+    import chromadb
+    from chromadb.config import Settings
+    _CHROMA_AVAILABLE = True
+except Exception:
+    _CHROMA_AVAILABLE = False
+
+try:
+    import fcntl  # embedding disk cache를 여러 worker가 함께 쓸 때 row 할당 lock (POSIX)
+except ImportError:
+    fcntl = None
+
+# ==========================
+# Memory / Embedding config
+# ==========================
+EMBED_MODEL = os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
+CHROMA_DIR = os.getenv("CHROMA_DIR", str((Path(__file__).parent / "chroma").resolve()))
+MEMORY_EVERY_N = int(os.getenv("MEMORY_EVERY_N", "6"))  # summarize every N history lines
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "4"))      # retrieved notes for context
+MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "auto").lower()  # auto(Chroma → local) | chroma | local
+
+# Memory partitioning: 세션마다(또는 해시 bucket마다) 별도 collection → 질의가 그 세션의 HNSW 그래프만 탄다.
+#   session : mem_<sid 해시> collection 하나에 세션 하나 (where 필터 없음)
+#   bucket  : mem_b<NNNN> (MEMORY_BUCKETS개) 에 session_id 필터 — collection 수를 제한하고 싶을 때
+#   global  : 예전처럼 trpg_memories 하나 + where={"session_id"}
+# collection handle은 MEMORY_PARTITION_OPEN개 / MEMORY_PARTITION_TTL초 idle 기준으로 닫는다. handle을 닫아도 chroma는
+# HNSW segment를 계속 들고 있으므로, RAM 상한은 chroma LRU segment cache(MEMORY_CACHE_BYTES, 기본 1GiB)가 지킨다.
+# 아직 없는 partition은 MEMORY_PARTITION_MISS_TTL초만 "없음"으로 기억한다 (다른 worker가 만들면 곧 보인다).
+# 예전 trpg_memories에 남은 세션 기억은 partition을 처음 열 때 옮겨 온다 (한 번에 옮기려면 migrate_memory.py).
+MEMORY_PARTITION = os.getenv("MEMORY_PARTITION", "session").lower()
+MEMORY_BUCKETS = int(os.getenv("MEMORY_BUCKETS", "64"))
+MEMORY_PARTITION_OPEN = int(os.getenv("MEMORY_PARTITION_OPEN", "256"))     # 메모리에 들고 있을 partition 수
+MEMORY_PARTITION_TTL = float(os.getenv("MEMORY_PARTITION_TTL", "900"))     # idle seconds before a partition is dropped
+MEMORY_CACHE_BYTES = int(os.getenv("MEMORY_CACHE_BYTES", str(1 << 30)))   # chroma LRU segment cache 상한, 0 → 무제한
+MEMORY_PARTITION_MISS_TTL = float(os.getenv("MEMORY_PARTITION_MISS_TTL", "5"))  # 없는 partition 재확인 간격(초)
+MEMORY_ADOPTED_MAX = int(os.getenv("MEMORY_ADOPTED_MAX", "100000"))  # legacy 확인을 마친 sid를 기억할 수 (넘치면 오래된 것부터 잊고, 다시 오면 한 번 더 확인)
+MEMORY_LEGACY_COLLECTION = "trpg_memories"
+
+
+class ChromaPartitions:
+    """Session → Chroma collection routing with an LRU of open handles and lazy adoption of legacy rows."""
+
+    def __init__(self, client, mode: str = MEMORY_PARTITION, buckets: int = MEMORY_BUCKETS,
+                 max_open: int = MEMORY_PARTITION_OPEN, ttl: float = MEMORY_PARTITION_TTL):
+        self.client = client
+        self.mode = mode if mode in ("session", "bucket", "global") else "session"
+        self.buckets = max(buckets, 1)
+        self.max_open = max_open
+        self.ttl = ttl
+        self._open: "OrderedDict[str, object]" = OrderedDict()   # name → collection
+        self._touched: Dict[str, float] = {}
+        self._missing: Dict[str, float] = {}   # name → 없다고 확인한 시각
+        self._adopted: "OrderedDict[str, None]" = OrderedDict()   # legacy 확인을 마친 sid (삽입 순, MEMORY_ADOPTED_MAX개까지)
+        self._lock = threading.Lock()   # 질의/저장은 to_thread에서 돈다
+        self._adopt_locks = [threading.Lock() for _ in range(64)]  # 이름별(striped) adoption lock
+        self.loads = 0
+        self.evictions = 0
+        self.adopted_rows = 0
+        self.legacy = None
+        if self.mode != "global":
+            try:
+                legacy = client.get_collection(MEMORY_LEGACY_COLLECTION)
+                if legacy.count() > 0:
+                    self.legacy = legacy
+            except Exception:
+                pass
+
+    def name_for(self, sid: str) -> str:
+        if self.mode == "global":
+            return MEMORY_LEGACY_COLLECTION
+        h = hashlib.sha1(sid.encode("utf-8")).hexdigest()
+        if self.mode == "bucket":
+            return f"mem_b{int(h[:8], 16) % self.buckets:04d}"
+        return f"mem_{h[:24]}"
+
+    def where(self, sid: str) -> Optional[dict]:
+        return None if self.mode == "session" else {"session_id": sid}
+
+    def get(self, sid: str, create: bool = False):
+        """Collection for sid; create=False이고 아직 없으면 None (빈 세션 질의는 chroma를 건드리지 않는다)."""
+        name = self.name_for(sid)
+        now = time.monotonic()
+        with self._lock:
+            col = self._open.get(name)
+            if col is None and (create or now - self._missing.get(name, -MEMORY_PARTITION_MISS_TTL) >= MEMORY_PARTITION_MISS_TTL):
+                col = self._load(name, create)
+                if col is None:
+                    self._missing[name] = now
+                else:
+                    self._missing.pop(name, None)
+                    self._open[name] = col
+            if col is not None:
+                self._open.move_to_end(name)
+                self._touched[name] = now
+            self._evict(now)
+        if self.legacy is not None and sid not in self._adopted:
+            with self._adopt_locks[hash(name) % len(self._adopt_locks)]:
+                if self.legacy is not None and sid not in self._adopted:
+                    col = self._adopt_legacy(sid, name, col)
+        return col
+
+    def _create(self, name: str):
+        return self.client.get_or_create_collection(name, metadata={"hnsw:space": "cosine"})
+
+    def _load(self, name: str, create: bool):
+        self.loads += 1
+        try:
+            return self.client.get_collection(name)
+        except Exception:
+            return self._create(name) if create else None
+
+    def _evict(self, now: float) -> None:
+        while self._open and (len(self._open) > self.max_open
+                              or now - self._touched.get(next(iter(self._open)), now) > self.ttl):
+            name, _ = self._open.popitem(last=False)
+            self._touched.pop(name, None)
+            self.evictions += 1
+        if len(self._missing) > self.max_open:
+            for name in [n for n, t in self._missing.items() if now - t >= MEMORY_PARTITION_MISS_TTL]:
+                del self._missing[name]
+
+    def _adopt_legacy(self, sid: str, name: str, col):
+        """Move this session's rows out of the legacy global collection (세션마다 한 번, 이름별 lock 안에서).
+        Returns the partition. legacy가 비면 더 이상 확인하지 않는다."""
+        legacy = self.legacy
+        try:
+            res = legacy.get(where={"session_id": sid}, include=["embeddings", "documents", "metadatas"])
+            ids = res.get("ids") or []
+            if ids:
+                if col is None:
+                    col = self._create(name)
+                    with self._lock:
+                        self._missing.pop(name, None)
+                        self._open[name] = col
+                col.upsert(ids=ids, embeddings=res["embeddings"], documents=res["documents"], metadatas=res["metadatas"])
+                legacy.delete(ids=ids)
+                self.adopted_rows += len(ids)
+            with self._lock:
+                self._adopted[sid] = None
+                while len(self._adopted) > MEMORY_ADOPTED_MAX:
+                    self._adopted.popitem(last=False)
+            if legacy.count() == 0:
+                self.legacy = None
+                with self._lock:
+                    self._adopted.clear()  # 더 이상 확인할 일이 없다
+        except Exception:
+            pass  # 다음에 다시 시도
+        return col
+
+    def snapshot(self) -> dict:
+        return {
+            "mode": self.mode,
+            "open": len(self._open),
+            "cache_bytes": MEMORY_CACHE_BYTES,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "legacy_pending": self.legacy is not None,
+            "adopted_rows": self.adopted_rows,
+        }
+
+
+# Initialize Chroma client (optional)
+memory_partitions: Optional[ChromaPartitions] = None
+if _CHROMA_AVAILABLE and MEMORY_BACKEND != "local":
+    try:
+        if MEMORY_CACHE_BYTES > 0:
+            chroma_client = chromadb.PersistentClient(path=CHROMA_DIR, settings=Settings(
+                chroma_segment_cache_policy="LRU", chroma_memory_limit_bytes=MEMORY_CACHE_BYTES))
+        else:
+            chroma_client = chromadb.PersistentClient(path=CHROMA_DIR)
+        memory_partitions = ChromaPartitions(chroma_client)
+    except Exception:
+        _CHROMA_AVAILABLE = False
+        memory_partitions = None
+
+# ==========================
+# Local vector memory (Chroma 미사용/실패 시)
+# ==========================
+class LocalVectorStore:
+    """Built-in per-session vector index.
+    세션마다 정규화된 float32 행렬(연속 메모리)을 유지하고 cosine top-k를 한 번의 행렬곱으로 계산.
+    디스크: {sid}.f32 (memmap으로 로드, append-only) + {sid}.docs.jsonl (row마다 문서/메타 한 줄).
+    shard는 처음 질의/저장할 때 읽고, LRU 크기(max_open)나 idle TTL을 넘으면 메모리에서 내린다 (디스크는 항상 최신).
+    파일 I/O(_load, add)는 blocking이라 async 경로에서는 스레드로 넘기고, 이미 올라온 shard의 행렬곱만 루프에서 한다.
+    _lock은 메모리 상태(LRU, 행렬)만 잠깐 잡고, _io_lock은 파일 append/truncate 순서를 맞춘다 (루프는 _io_lock을 잡지 않음).
+    """
+
+    def __init__(self, directory: Path, max_open: int = MEMORY_PARTITION_OPEN, ttl: float = MEMORY_PARTITION_TTL):
+        self.dir = directory
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.max_open = max_open
+        self.ttl = ttl
+        self._shards: "OrderedDict[str, dict]" = OrderedDict()
+        self._touched: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def _paths(self, sid: str) -> tuple[Path, Path]:
+        safe = re.sub(r"[^A-Za-z0-9_.-]", "_", sid)
+        return self.dir / f"{safe}.f32", self.dir / f"{safe}.docs.jsonl"
+
+    def _resident(self, sid: str) -> Optional[dict]:
+        """이미 메모리에 있는 shard (없으면 None). LRU/TTL 정리 포함, _lock 안에서 호출."""
+        shard = self._shards.get(sid)
+        if shard is None:
+            return None
+        now = time.monotonic()
+        self._shards.move_to_end(sid)
+        self._touched[sid] = now
+        while len(self._shards) > 1 and (len(self._shards) > self.max_open
+                                         or now - self._touched[next(iter(self._shards))] > self.ttl):
+            old, _ = self._shards.popitem(last=False)
+            self._touched.pop(old, None)
+            self.evictions += 1
+        return shard
+
+    def ensure(self, sid: str) -> dict:
+        """shard를 메모리에 올려 반환 (blocking: 파일 읽기). async 경로에서는 asyncio.to_thread로 호출."""
+        with self._lock:
+            shard = self._resident(sid)
+        if shard is not None:
+            return shard
+        with self._io_lock:
+            loaded = self._load(sid)
+        with self._lock:
+            if sid not in self._shards:
+                self._shards[sid] = loaded
+                self.loads += 1
+            return self._resident(sid)
+
+    def snapshot(self) -> dict:
+        return {"mode": "local", "open": len(self._shards), "loads": self.loads, "evictions": self.evictions}
+
+    def _load(self, sid: str) -> dict:
+        shard = {"mat": np.zeros((0, 0), dtype=np.float32), "n": 0, "dim": None, "docs": []}
+        vec_p, doc_p = self._paths(sid)
+        if not vec_p.exists() or not doc_p.exists():
+            return shard
+        docs = []
+        for line in doc_p.read_text(encoding="utf-8").splitlines():
+            try:
+                docs.append(json.loads(line))
+            except Exception:
+                break
+        if not docs:
+            return shard
+        dim = int(docs[0]["dim"])
+        rows = min(len(docs), vec_p.stat().st_size // (4 * dim))
+        # 크래시로 어긋난 꼬리는 잘라 두 파일의 row를 맞춘다
+        if rows != len(docs) or vec_p.stat().st_size != rows * 4 * dim:
+            doc_p.write_text("".join(json.dumps(d, ensure_ascii=False) + "\n" for d in docs[:rows]), encoding="utf-8")
+            with vec_p.open("r+b") as f:
+                f.truncate(rows * 4 * dim)
+        mat = np.zeros((max(rows, 16), dim), dtype=np.float32)
+        if rows:
+            mat[:rows] = np.memmap(vec_p, dtype=np.float32, mode="r", shape=(rows, dim))
+        shard.update(mat=mat, n=rows, dim=dim, docs=[d["doc"] for d in docs[:rows]])
+        return shard
+
+    def add(self, sid: str, vectors: List[List[float]], documents: List[str], metadatas: List[dict]) -> None:
+        """blocking (파일 append) → async 경로에서는 asyncio.to_thread로 호출."""
+        if not vectors:
+            return
+        vecs = np.asarray(vectors, dtype=np.float32)
+        vecs /= np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+        shard = self.ensure(sid)
+        # _io_lock: 메모리 row 순서와 파일 row 순서를 같게 유지 (같은 sid에 add가 동시에 와도)
+        with self._io_lock:
+            with self._lock:
+                if shard["dim"] is None:
+                    shard["dim"] = vecs.shape[1]
+                    shard["mat"] = np.zeros((16, vecs.shape[1]), dtype=np.float32)
+                if vecs.shape[1] != shard["dim"]:
+                    raise ValueError("embedding dimension mismatch")
+                n, m = shard["n"], len(vecs)
+                if n + m > shard["mat"].shape[0]:
+                    # capacity doubling → append는 amortized O(1), 행렬은 계속 연속 메모리
+                    grown = np.zeros((max(2 * shard["mat"].shape[0], n + m), shard["dim"]), dtype=np.float32)
+                    grown[:n] = shard["mat"][:n]
+                    shard["mat"] = grown
+                shard["mat"][n:n + m] = vecs
+                shard["docs"].extend(documents)
+                shard["n"] = n + m
+                dim = shard["dim"]
+            vec_p, doc_p = self._paths(sid)
+            with vec_p.open("ab") as f:
+                f.write(vecs.tobytes())
+            with doc_p.open("a", encoding="utf-8") as f:
+                f.write("".join(
+                    json.dumps({"dim": dim, "doc": d, "meta": md}, ensure_ascii=False) + "\n"
+                    for d, md in zip(documents, metadatas)
+                ))
+
+    def _top_k(self, shard: dict, vector: List[float], k: int) -> List[str]:
+        with self._lock:
+            n, mat, docs = shard["n"], shard["mat"], shard["docs"]
+        if not n or k <= 0:
+            return []
+        q = np.asarray(vector, dtype=np.float32)
+        q /= max(float(np.linalg.norm(q)), 1e-12)
+        scores = mat[:n] @ q
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [docs[i] for i in top]
+
+    def query(self, sid: str, vector: List[float], k: int) -> List[str]:
+        """blocking (shard가 없으면 파일에서 로드)."""
+        return self._top_k(self.ensure(sid), vector, k)
+
+    def query_resident(self, sid: str, vector: List[float], k: int) -> Optional[List[str]]:
+        """루프에서 바로 부를 수 있는 질의: shard가 메모리에 없으면 None (→ ensure를 스레드로)."""
+        with self._lock:
+            shard = self._resident(sid)
+        if shard is None:
+            return None
+        return self._top_k(shard, vector, k)
+
+local_memory: Optional[LocalVectorStore] = None
+if memory_partitions is None and MEMORY_BACKEND != "chroma":
+    try:
+        local_memory = LocalVectorStore(Path(CHROMA_DIR) / "local")
+    except Exception:
+        local_memory = None
+
+# --- Embedding/Memory helpers ---
+# --- Embedding cache (content-addressed: sha256(model + text)) ---
+# 1) in-process LRU (float32 벡터)
+# 2) on-disk: segment마다 {model}-{seg}-{dim}.f32 (row-major float32, memmap) + .keys (row마다 64자 key + "\n")
+# 여러 worker가 같은 디렉터리를 쓴다: row 번호는 .keys 파일 크기에서 fcntl lock 안에서 정하고, 벡터를 먼저 쓰고
+# key를 나중에 쓴다 (key가 보이면 벡터도 있다). 파일은 자르지 않는다. 잘린 key 줄은 읽을 때 건너뛴다.
+# segment가 차면 다음 segment로 넘어가고, EMBED_DISK_SEGMENTS개를 넘는 가장 오래된 segment를 통째로 지운다.
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))            # in-memory entries
+EMBED_CACHE_DIR = Path(os.getenv("EMBED_CACHE_DIR", str(Path(__file__).parent / "cache" / "embeddings")))
+EMBED_DISK_CACHE_MAX = int(os.getenv("EMBED_DISK_CACHE_MAX", "200000"))  # rows on disk, 0 → disk tier off
+EMBED_DISK_SEGMENTS = int(os.getenv("EMBED_DISK_SEGMENTS", "4"))         # disk tier를 나누는 segment 수 (eviction 단위)
+_EMBED_KEY_ROW = 65  # sha256 hex + "\n"
+
+def _embed_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+@contextmanager
+def _flocked(fd: int, mode: int):
+    if fcntl is None:
+        yield  # lock이 없는 플랫폼: 단일 프로세스 가정
+        return
+    fcntl.flock(fd, mode)
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+class EmbeddingCache:
+    """Two-tier embedding cache with hit/miss/eviction counters."""
+
+    def __init__(self, model: str = EMBED_MODEL, size: int = EMBED_CACHE_SIZE,
+                 directory: Path = EMBED_CACHE_DIR, disk_max: int = EMBED_DISK_CACHE_MAX,
+                 segments: int = EMBED_DISK_SEGMENTS):
+        self.model = model
+        self.size = size
+        self.disk_max = disk_max
+        self.segments = max(1, segments)
+        self._seg_rows = max(1, -(-disk_max // self.segments))
+        self._mem: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._index: Dict[str, tuple[int, int]] = {}        # key → (segment, row)
+        self._seg_keys: Dict[int, List[str]] = {}           # segment → 이 프로세스가 아는 key들 (segment 삭제 시 정리)
+        self._scanned: Dict[int, int] = {}                  # segment → .keys에서 읽은 바이트 수
+        self._mmaps: Dict[int, np.memmap] = {}
+        self._active = 0
+        self._refreshed = 0.0
+        self._dim: Optional[int] = None
+        self.hits_mem = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self.rotations = 0
+        self._disk_lock = threading.Lock()   # disk tier 상태(_index 등)는 to_thread 작업들이 함께 만진다
+        self._dir = directory
+        self._prefix = re.sub(r"[^A-Za-z0-9_.-]", "_", model)
+        if disk_max > 0:
+            try:
+                directory.mkdir(parents=True, exist_ok=True)
+                self._refresh()
+            except Exception:
+                self.disk_max = 0
+
+    def _paths(self, seg: int) -> tuple[Path, Path]:
+        base = self._dir / f"{self._prefix}-{seg:06d}-{self._dim}"
+        return base.with_suffix(".keys"), base.with_suffix(".f32")
+
+    def _list_segments(self) -> List[int]:
+        found: Dict[int, int] = {}
+        for p in self._dir.glob(f"{self._prefix}-*-*.keys"):
+            try:
+                seg, dim = p.stem[len(self._prefix) + 1:].split("-")
+                found[int(seg)] = int(dim)
+            except ValueError:
+                continue
+        if self._dim is None and found:
+            self._dim = found[max(found)]
+        return sorted(seg for seg, dim in found.items() if dim == self._dim)
+
+    def _forget(self, seg: int) -> None:
+        keys = self._seg_keys.pop(seg, [])
+        for k in keys:
+            if self._index.get(k, (None,))[0] == seg:
+                del self._index[k]
+        self._scanned.pop(seg, None)
+        self._mmaps.pop(seg, None)
+        self.disk_evictions += len(keys)
+
+    def _refresh(self) -> None:
+        """Pick up segments/rows written by other workers and forget deleted segments."""
+        self._refreshed = time.monotonic()
+        live = self._list_segments()
+        for seg in [s for s in self._seg_keys if s not in live]:
+            self._forget(seg)
+        for seg in live:
+            keys_path, _ = self._paths(seg)
+            try:
+                with keys_path.open("rb") as f, _flocked(f.fileno(), fcntl.LOCK_SH if fcntl else 0):
+                    f.seek(self._scanned.get(seg, 0))
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            start = self._scanned.get(seg, 0) // _EMBED_KEY_ROW
+            usable = len(data) - len(data) % _EMBED_KEY_ROW
+            known = self._seg_keys.setdefault(seg, [])
+            for i in range(0, usable, _EMBED_KEY_ROW):
+                line = data[i:i + _EMBED_KEY_ROW]
+                if line[-1:] != b"\n" or not re.fullmatch(rb"[0-9a-f]{64}", line[:64]):
+                    continue  # 쓰다 죽은 row
+                key = line[:64].decode("ascii")
+                self._index[key] = (seg, start + i // _EMBED_KEY_ROW)
+                known.append(key)
+            self._scanned[seg] = self._scanned.get(seg, 0) + usable
+        if live:
+            self._active = max(self._active, live[-1])
+
+    def _disk_get(self, key: str) -> Optional[np.ndarray]:
+        if self._dim is None or self.disk_max <= 0:
+            return None
+        loc = self._index.get(key)
+        if loc is None and time.monotonic() - self._refreshed > 1.0:
+            try:
+                self._refresh()  # 다른 worker가 쓴 row (miss는 어차피 API 호출이므로 초당 한 번 정도는 싸다)
+            except Exception:
+                pass
+            loc = self._index.get(key)
+        if loc is None:
+            return None
+        seg, row = loc
+        try:
+            mm = self._mmaps.get(seg)
+            if mm is None or row >= mm.shape[0]:
+                rows = self._paths(seg)[1].stat().st_size // (4 * self._dim)
+                if row >= rows:
+                    return None
+                mm = self._mmaps[seg] = np.memmap(self._paths(seg)[1], dtype=np.float32, mode="r", shape=(rows, self._dim))
+            return np.array(mm[row])
+        except FileNotFoundError:
+            self._forget(seg)  # 다른 worker가 segment를 돌려 지움
+            return None
+
+    def _disk_put(self, key: str, vec: np.ndarray) -> None:
+        if self.disk_max <= 0 or key in self._index:
+            return
+        try:
+            if self._dim is None:
+                self._dim = vec.shape[0]
+            if vec.shape[0] != self._dim:
+                return
+            seg = self._active
+            while True:
+                keys_path, vec_path = self._paths(seg)
+                # 알고 있는 segment는 만들지 않는다 → 다른 worker가 돌려 지운 segment를 되살리지 않음
+                try:
+                    kfd = os.open(keys_path, os.O_RDWR | (0 if seg in self._seg_keys else os.O_CREAT), 0o644)
+                except FileNotFoundError:
+                    self._refresh()
+                    seg = max(seg + 1, self._active)
+                    continue
+                try:
+                    with _flocked(kfd, fcntl.LOCK_EX if fcntl else 0):
+                        row = -(-os.fstat(kfd).st_size // _EMBED_KEY_ROW)  # 잘린 마지막 줄은 건너뛴다
+                        if row < self._seg_rows:
+                            vfd = os.open(vec_path, os.O_WRONLY | os.O_CREAT, 0o644)
+                            try:
+                                os.pwrite(vfd, vec.tobytes(), row * 4 * self._dim)
+                            finally:
+                                os.close(vfd)
+                            os.pwrite(kfd, (key + "\n").encode("ascii"), row * _EMBED_KEY_ROW)
+                            break
+                finally:
+                    os.close(kfd)
+                # 가득 참 → 다음 segment (다른 worker가 이미 돌렸으면 그 segment에 이어 쓴다)
+                self._refresh()
+                seg = max(seg + 1, self._active)
+            self._index[key] = (seg, row)
+            self._seg_keys.setdefault(seg, []).append(key)
+            if seg != self._active:
+                self._active = seg
+                self.rotations += 1
+                self._prune(seg)
+        except Exception:
+            pass
+
+    def _prune(self, active: int) -> None:
+        """Delete segments older than the newest `segments` (열려 있는 memmap은 inode가 남아 계속 읽힌다)."""
+        for seg in self._list_segments():
+            if seg > active - self.segments:
+                break
+            for p in self._paths(seg):
+                p.unlink(missing_ok=True)
+            self._forget(seg)
+
+    def _mem_put(self, key: str, vec: np.ndarray) -> None:
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.size:
+            self._mem.popitem(last=False)
+            self.evictions += 1
+
+    # --- 루프에서 부르는 쪽 (메모리만) / 스레드에서 부르는 쪽 (disk, _disk_lock 아래) ---
+    @property
+    def disk_enabled(self) -> bool:
+        return self.disk_max > 0
+
+    def mem_get(self, text: str) -> Optional[List[float]]:
+        key = _embed_key(self.model, text)
+        vec = self._mem.get(key)
+        if vec is None:
+            return None
+        self._mem.move_to_end(key)
+        self.hits_mem += 1
+        return vec.tolist()
+
+    def mem_put(self, text: str, vec: np.ndarray) -> None:
+        self._mem_put(_embed_key(self.model, text), vec)
+
+    def disk_get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Disk lookups for memory misses (blocking; to_thread에서). 메모리 승격은 호출 측이 루프에서 한다."""
+        with self._disk_lock:
+            out = [self._disk_get(_embed_key(self.model, t)) for t in texts]
+            found = sum(v is not None for v in out)
+            self.hits_disk += found
+            self.misses += len(out) - found
+        return out
+
+    def disk_put_many(self, items: List[tuple[str, np.ndarray]]) -> None:
+        """Append to the disk tier (blocking; flock을 기다릴 수 있으므로 루프 밖에서)."""
+        with self._disk_lock:
+            for text, vec in items:
+                self._disk_put(_embed_key(self.model, text), vec)
+
+    def get(self, text: str) -> Optional[List[float]]:
+        """Blocking two-tier lookup (동기 경로용)."""
+        vec = self.mem_get(text)
+        if vec is not None:
+            return vec
+        if not self.disk_enabled:
+            self.misses += 1
+            return None
+        (found,) = self.disk_get_many([text])
+        if found is None:
+            return None
+        self.mem_put(text, found)
+        return found.tolist()
+
+    def put(self, text: str, embedding: List[float]) -> None:
+        vec = np.asarray(embedding, dtype=np.float32)
+        self.mem_put(text, vec)
+        if self.disk_enabled:
+            self.disk_put_many([(text, vec)])
+
+    def snapshot(self) -> dict:
+        lookups = self.hits_mem + self.hits_disk + self.misses
+        return {
+            "hits_mem": self.hits_mem,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits_mem + self.hits_disk) / lookups, 4) if lookups else 0.0,
+            "mem_entries": len(self._mem),
+            "disk_entries": len(self._index),
+            "disk_segments": len(self._seg_keys),
+            "disk_evictions": self.disk_evictions,
+            "disk_rotations": self.rotations,
+        }
+
+embed_cache = EmbeddingCache()
+
+# --- Embedding micro-batcher ---
+# 동시에 들어온 호출들의 텍스트를 짧은 window 동안(또는 EMBED_BATCH_MAX개까지) 모아 한 번의 API 요청으로 보낸다.
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))  # 0 → 즉시 전송 (batching off)
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "256"))               # texts per request
+
+_BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048)
+
+class EmbeddingBatcher:
+    """Cross-request embedding batcher with per-caller latency / batch-size metrics."""
+
+    def __init__(self, window_ms: float = EMBED_BATCH_WINDOW_MS, max_batch: int = EMBED_BATCH_MAX):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._pending: list[tuple[List[str], asyncio.Future, float, str]] = []
+        self._pending_texts = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._inflight: set[asyncio.Task] = set()
+        self.batches = 0
+        self.texts = 0
+        self.callers = 0
+        self.errors = 0
+        self.batch_size_hist = {b: 0 for b in _BATCH_SIZE_BUCKETS}
+        self._latencies: "deque[float]" = deque(maxlen=2048)  # recent per-caller latency (s)
+
+    async def embed(self, texts: List[str], priority: str = "interactive") -> List[List[float]]:
+        if len(texts) > self.max_batch > 0:
+            # 한 호출이 max_batch보다 크면 나눠 보낸다 → API 요청 하나는 항상 max_batch 이하
+            parts = await asyncio.gather(*(self.embed(texts[i:i + self.max_batch], priority)
+                                           for i in range(0, len(texts), self.max_batch)))
+            return [v for part in parts for v in part]
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        if self._pending and self._pending_texts + len(texts) > self.max_batch:
+            self._flush()  # 이 호출까지 합치면 max_batch를 넘는다 → 모인 것부터 보낸다
+        self._pending.append((texts, fut, time.perf_counter(), priority))
+        self._pending_texts += len(texts)
+        if self.window <= 0 or self._pending_texts >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await fut
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._pending_texts = self._pending, [], 0
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, batch: list[tuple[List[str], asyncio.Future, float, str]]) -> None:
+        texts = [t for ts, _, _, _ in batch for t in ts]
+        # 배치 우선순위 = 섞여 있는 호출 중 가장 높은 것 (검색 질의가 저장용 임베딩 뒤에 밀리지 않게)
+        priority = min((p for _, _, _, p in batch), key=lambda p: LLM_PRIORITIES.index(p) if p in LLM_PRIORITIES else 0)
+        try:
+            async with llm_scheduler.slot(priority, sum(_estimate_tokens(t) for t in texts)):
+                t0 = time.perf_counter()
+                res = await aclient.embeddings.create(model=EMBED_MODEL, input=texts)
+                _record_llm(EMBED_MODEL, "embedding", time.perf_counter() - t0, getattr(res, "usage", None))
+            vecs = [d.embedding for d in res.data]
+            if len(vecs) != len(texts):
+                raise RuntimeError("embedding count mismatch")
+        except Exception as e:
+            self.errors += 1
+            for _, fut, _, _ in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self._record(len(texts), len(batch))
+        now = time.perf_counter()
+        i = 0
+        for ts, fut, t0, _ in batch:
+            if not fut.done():
+                fut.set_result(vecs[i:i + len(ts)])
+            self._latencies.append(now - t0)
+            i += len(ts)
+
+    def _record(self, n_texts: int, n_callers: int) -> None:
+        self.batches += 1
+        self.texts += n_texts
+        self.callers += n_callers
+        bucket = next((b for b in _BATCH_SIZE_BUCKETS if n_texts <= b), _BATCH_SIZE_BUCKETS[-1])
+        self.batch_size_hist[bucket] += 1
+
+    def snapshot(self) -> dict:
+        lat = sorted(self._latencies)
+        pct = lambda q: round(lat[min(len(lat) - 1, int(q * len(lat)))] * 1000, 2) if lat else None
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "texts": self.texts,
+            "callers": self.callers,
+            "errors": self.errors,
+            "avg_batch_texts": round(self.texts / self.batches, 2) if self.batches else 0,
+            "avg_batch_callers": round(self.callers / self.batches, 2) if self.batches else 0,
+            "batch_size_hist": {f"le_{b}": n for b, n in self.batch_size_hist.items()},
+            "caller_latency_ms": {"p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99), "samples": len(lat)},
+        }
+
+embed_batcher = EmbeddingBatcher()
+
+_embed_disk_writes: set[asyncio.Task] = set()
+
+async def _acached(texts: List[str]) -> tuple[list, List[str]]:
+    """Async cache lookup: 메모리 tier는 inline, 메모리 miss만 disk tier를 스레드에서 확인."""
+    cached = [embed_cache.mem_get(t) for t in texts]
+    missing = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+    if not missing:
+        return cached, missing
+    if not embed_cache.disk_enabled:
+        embed_cache.misses += len(missing)
+        return cached, missing
+    found = dict(zip(missing, await asyncio.to_thread(embed_cache.disk_get_many, missing)))
+    for t, v in found.items():
+        if v is not None:
+            embed_cache.mem_put(t, v)
+    cached = [v if v is not None else (found[t].tolist() if found.get(t) is not None else None)
+              for t, v in zip(texts, cached)]
+    return cached, [t for t in missing if found[t] is None]
+
+def _afill_cached(texts: List[str], cached: list, missing: List[str], vecs: List[List[float]]) -> List[List[float]]:
+    """Store fresh vectors: 메모리 tier는 바로, disk tier는 백그라운드 스레드로 (응답을 기다리게 하지 않음)."""
+    fresh = dict(zip(missing, vecs))
+    items = [(t, np.asarray(v, dtype=np.float32)) for t, v in fresh.items()]
+    for t, vec in items:
+        embed_cache.mem_put(t, vec)
+    if items and embed_cache.disk_enabled:
+        task = asyncio.get_running_loop().create_task(asyncio.to_thread(embed_cache.disk_put_many, items))
+        _embed_disk_writes.add(task)
+        task.add_done_callback(_embed_disk_writes.discard)
+    return [v if v is not None else fresh[t] for t, v in zip(texts, cached)]
+
+async def aembed_texts(texts: List[str], priority: str = "interactive") -> List[List[float]]:
+    """Return OpenAI embeddings for a list of texts; goes through the shared micro-batcher.
+    priority: 검색 질의는 interactive, 메모리 저장용은 memory."""
+    if not texts:
+        return []
+    try:
+        cached, missing = await _acached(texts)
+        vecs = await embed_batcher.embed(missing, priority) if missing else []
+        return _afill_cached(texts, cached, missing, vecs)
+    except Exception:
+        return []
+
+def _memory_enabled() -> bool:
+    return memory_partitions is not None or local_memory is not None
+
+def _store_upsert(session_id: str, chunks: List[str], vecs: List[List[float]], metadicts: List[dict]) -> None:
+    metas = [{"session_id": session_id, **m} for m in metadicts]
+    if memory_partitions is not None:
+        ids = [f"{session_id}:{uuid.uuid4()}" for _ in chunks]
+        memory_partitions.get(session_id, create=True).upsert(ids=ids, embeddings=vecs, documents=chunks, metadatas=metas)
+    elif local_memory is not None:
+        local_memory.add(session_id, vecs, chunks, metas)
+
+def _store_query(session_id: str, qvec: List[float], k: int) -> List[str]:
+    if memory_partitions is not None:
+        col = memory_partitions.get(session_id)
+        if col is None:
+            return []
+        where = memory_partitions.where(session_id)
+        res = col.query(query_embeddings=[qvec], n_results=k, **({"where": where} if where else {}))
+        return (res.get("documents") or [[]])[0]
+    if local_memory is not None:
+        return local_memory.query(session_id, qvec, k)
+    return []
+
+# Async variants: embedding은 공유 풀 클라이언트, store 호출(Chroma, local 파일 I/O)은 스레드로 넘겨 이벤트 루프를 막지 않음
+# (local store는 이미 메모리에 올라온 shard의 행렬곱만 루프에서 바로 처리)
+async def _amemory_upsert_strict(session_id: str, chunks: List[str], metadicts: List[dict]) -> None:
+    """amemory_upsert that raises on failure (used by the post-turn pipeline for retries)."""
+    if not _memory_enabled() or not chunks:
+        return
+    vecs = await aembed_texts(chunks, priority="memory")
+    if not vecs:
+        raise RuntimeError("embedding failed")
+    await asyncio.to_thread(_store_upsert, session_id, chunks, vecs, metadicts)
+
+async def amemory_upsert(session_id: str, chunks: List[str], metadicts: List[dict]) -> None:
+    try:
+        await _amemory_upsert_strict(session_id, chunks, metadicts)
+    except Exception:
+        # fail silently in dev
+        pass
+
+async def amemory_query(session_id: str, query: str, k: int = MEMORY_TOP_K) -> List[str]:
+    if not _memory_enabled() or not query.strip():
+        return []
+    try:
+        qvecs = await aembed_texts([query])
+        if not qvecs:
+            return []
+        if memory_partitions is None and local_memory is not None:
+            res = local_memory.query_resident(session_id, qvecs[0], k)
+            if res is not None:
+                return res
+        return await asyncio.to_thread(_store_query, session_id, qvecs[0], k)
+    except Exception:
+        return []
@@ -0,0 +1,142 @@
+"""Prometheus text-format metrics, per-request stage timings and the Server-Timing middleware."""
+import bisect
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+# ==========================
+# Metrics (Prometheus text format) + Server-Timing
+# ==========================
+# 관측은 dict 조회 + bisect 한 번이라 요청 경로 비용은 무시할 수준이고, 텍스트 렌더링은 /metrics 스크랩 때만 한다.
+# 요청 안에서 stage()로 잰 구간은 Server-Timing 헤더로도 내려간다 (브라우저 devtools에서 바로 보임).
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metrics:
+    def __init__(self, buckets: tuple = METRICS_BUCKETS):
+        self.buckets = buckets
+        self._hist: Dict[str, Dict[tuple, list]] = {}      # name → labels → [bucket counts..., sum, count]
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._help: Dict[str, str] = {}
+
+    def describe(self, name: str, text: str) -> None:
+        self._help[name] = text
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self._hist.setdefault(name, {})
+        h = series.get(key)
+        if h is None:
+            h = series[key] = [0] * (len(self.buckets) + 2)
+        h[bisect.bisect_left(self.buckets, seconds)] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self._counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+    @staticmethod
+    def _labels(key: tuple, extra: str = "") -> str:
+        parts = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in key]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        out: list[str] = []
+        for name, series in self._counters.items():
+            if name in self._help:
+                out.append(f"# HELP {name} {self._help[name]}")
+            out.append(f"# TYPE {name} counter")
+            for key, v in series.items():
+                out.append(f"{name}{self._labels(key)} {v}")
+        for name, series in self._hist.items():
+            if name in self._help:
+                out.append(f"# HELP {name} {self._help[name]}")
+            out.append(f"# TYPE {name} histogram")
+            for key, h in series.items():
+                cum = 0
+                for b, n in zip(self.buckets, h):
+                    cum += n
+                    le = self._labels(key, 'le="%s"' % b)
+                    out.append(f"{name}_bucket{le} {cum}")
+                le = self._labels(key, 'le="+Inf"')
+                out.append(f"{name}_bucket{le} {h[-1]}")
+                out.append(f"{name}_sum{self._labels(key)} {h[-2]}")
+                out.append(f"{name}_count{self._labels(key)} {h[-1]}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.describe("trpg_request_seconds", "HTTP request latency by route")
+metrics.describe("trpg_stage_seconds", "Latency of one stage inside a request")
+metrics.describe("trpg_llm_seconds", "Model call latency (excluding scheduler wait)")
+metrics.describe("trpg_llm_tokens_total", "Tokens reported by the API")
+metrics.describe("trpg_llm_errors_total", "Failed model calls")
+metrics.describe("trpg_llm_fallbacks_total", "Calls answered by a model other than the first choice")
+
+_stage_timings: ContextVar[Optional[dict]] = ContextVar("_stage_timings", default=None)  # stage → 초, "_scope" → ASGI scope
+
+
+def record_stage(name: str, seconds: float) -> None:
+    if not METRICS_ENABLED:
+        return
+    timings = _stage_timings.get()
+    endpoint = "background"
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+        endpoint = getattr(timings["_scope"].get("route"), "path", None) or "unmatched"
+    metrics.observe("trpg_stage_seconds", seconds, endpoint=endpoint, stage=name)
+
+
+@contextmanager
+def stage(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - t0)
+
+
+def _server_timing(timings: dict, total: float) -> bytes:
+    parts = [f"{k};dur={v * 1000:.1f}" for k, v in timings.items() if not k.startswith("_")]
+    parts.append(f"app;dur={total * 1000:.1f}")
+    return ", ".join(parts).encode("latin-1")
+
+
+class TimingMiddleware:
+    """Pure ASGI middleware: per-route latency histogram + Server-Timing header.
+    스트리밍 응답은 헤더가 먼저 나가므로 그 시점까지의 stage만 헤더에 담기고, 히스토그램은 스트림 종료 시점으로 기록."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+        t0 = time.perf_counter()
+        timings: dict = {"_scope": scope}
+        token = _stage_timings.set(timings)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", _server_timing(timings, time.perf_counter() - t0)))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _stage_timings.reset(token)
+            route = scope.get("route")
+            metrics.observe("trpg_request_seconds", time.perf_counter() - t0,
+                            endpoint=getattr(route, "path", None) or "unmatched",
+                            method=scope.get("method", ""), status=status)
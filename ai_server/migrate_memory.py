@@ -0,0 +1,90 @@
+"""One-shot migration of the global `trpg_memories` Chroma collection into per-session (or bucket) partitions.
+
+    python migrate_memory.py --dry-run        # 세션별 row 수만 집계
+    python migrate_memory.py                  # MEMORY_PARTITION(session|bucket)에 맞춰 옮긴다
+    python migrate_memory.py --drop-legacy    # 다 옮긴 뒤 빈 trpg_memories collection 삭제
+
+서버를 멈춘 상태에서 실행한다. legacy collection을 page 단위로 읽어 session_id별로 partition에 upsert(같은 id)하고,
+옮긴 row는 legacy에서 지운다. 중간에 끊겨도 다시 실행하면 남은 row만 옮긴다.
+서버도 partition을 처음 열 때 그 세션 분을 옮기므로(lazy), 이 도구는 한 번에 끝내고 싶을 때 쓴다.
+"""
+import argparse
+import os
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+os.environ.setdefault("OPENAI_API_KEY", "migrate-offline")  # import만 하면 되므로 API 키는 필요 없다
+os.environ.setdefault("MEMORY_BACKEND", "chroma")
+sys.path.insert(0, str(Path(__file__).parent))
+import main  # noqa: E402,F401  (.env.trpg 로드 — 서버와 같은 설정으로 연다)
+import memory  # noqa: E402
+
+
+def main_cli(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--page", type=int, default=1000, help="rows read from the legacy collection per request")
+    ap.add_argument("--dry-run", action="store_true")
+    ap.add_argument("--drop-legacy", action="store_true", help="delete trpg_memories once it is empty")
+    args = ap.parse_args(argv)
+
+    parts = memory.memory_partitions
+    if parts is None:
+        print("chroma is not available (MEMORY_BACKEND / chromadb install)", file=sys.stderr)
+        return 1
+    if parts.mode == "global":
+        print("MEMORY_PARTITION=global: nothing to migrate", file=sys.stderr)
+        return 1
+    try:
+        legacy = parts.client.get_collection(memory.MEMORY_LEGACY_COLLECTION)
+    except Exception:
+        print(f"no {memory.MEMORY_LEGACY_COLLECTION} collection: nothing to migrate")
+        return 0
+    parts.legacy = None  # 여기서 페이지 단위로 옮기므로 partition별 lazy adoption은 끈다
+
+    t0 = time.perf_counter()
+    per_session: dict[str, int] = defaultdict(int)
+    offset = 0
+    while True:
+        # 실제 실행에서는 옮긴 row를 지우므로 offset은 옮길 수 없는(session_id 없는) row 수만큼만 늘어난다
+        res = legacy.get(limit=args.page, offset=offset, include=["embeddings", "documents", "metadatas"])
+        ids = res.get("ids") or []
+        if not ids:
+            break
+        groups: dict[str, list[int]] = defaultdict(list)
+        for i, md in enumerate(res["metadatas"]):
+            groups[(md or {}).get("session_id") or ""].append(i)
+        for sid, rows in groups.items():
+            per_session[sid] += len(rows)
+            if args.dry_run:
+                continue
+            if sid:
+                col = parts.get(sid, create=True)
+                col.upsert(ids=[ids[i] for i in rows], embeddings=[res["embeddings"][i] for i in rows],
+                           documents=[res["documents"][i] for i in rows], metadatas=[res["metadatas"][i] for i in rows])
+        if args.dry_run:
+            offset += len(ids)
+            continue
+        moved = [ids[i] for sid, rows in groups.items() if sid for i in rows]
+        if moved:
+            legacy.delete(ids=moved)
+        offset += len(groups.get("", []))
+
+    rows = sum(n for sid, n in per_session.items() if sid)
+    if per_session.get(""):
+        print(f"{per_session['']} row(s) without session_id stay in {memory.MEMORY_LEGACY_COLLECTION}", file=sys.stderr)
+    verb = "would move" if args.dry_run else "moved"
+    print(f"{verb} {rows} row(s) for {len([s for s in per_session if s])} session(s) "
+          f"into {parts.mode} partitions in {time.perf_counter() - t0:.1f}s")
+    if args.drop_legacy and not args.dry_run:
+        if legacy.count() == 0:
+            parts.client.delete_collection(memory.MEMORY_LEGACY_COLLECTION)
+            print(f"dropped {memory.MEMORY_LEGACY_COLLECTION}")
+        else:
+            print(f"{memory.MEMORY_LEGACY_COLLECTION} is not empty; kept", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,95 @@
+"""One-shot migration of stored session snapshots between the JSON and binary codecs.
+
+    python migrate_sessions.py                        # SESSION_STORE의 JSON 스냅샷을 모두 binary로
+    python migrate_sessions.py --dry-run              # 쓰지 않고 변환 전후 크기만 보고
+    python migrate_sessions.py --backup sessions.bak  # (file store) 원본 스냅샷/journal을 복사해 둔 뒤 변환
+    python migrate_sessions.py --to json              # 되돌리기
+
+서버(모든 worker)를 멈춘 상태에서 실행한다. 세션마다 load_session으로 스냅샷 + journal을 합친 뒤
+새 포맷으로 스냅샷을 다시 쓰고(journal은 스냅샷에 접혀 비워진다), 다시 읽어 원래 상태와 같은지 확인한다.
+변환이 끝나면 SESSION_CODEC=binary로 서버를 띄운다. 이미 목표 포맷인 세션은 건너뛴다.
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+os.environ.setdefault("OPENAI_API_KEY", "migrate-offline")  # import만 하면 되므로 API 키는 필요 없다
+sys.path.insert(0, str(Path(__file__).parent))
+import main  # noqa: E402,F401  (.env.trpg 로드 — 서버와 같은 설정으로 연다)
+import stores  # noqa: E402
+
+
+def _dump(state: "stores.SessionState") -> dict:
+    return {**state.model_dump(), "_seq": state._seq}
+
+
+def _backup(sid: str, dest: Path) -> None:
+    dest.mkdir(parents=True, exist_ok=True)
+    for p in (stores._sess_path(sid), stores._snap_path(sid), stores._journal_path(sid)):
+        if p.exists():
+            shutil.copy2(p, dest / p.name)
+
+
+def migrate(sid: str, to: str, dry_run: bool, backup: Path | None) -> tuple[str, int, int]:
+    """Returns (result, bytes before, bytes after)."""
+    found = stores.session_store.read(sid)
+    if found is None:
+        return "missing", 0, 0
+    raw, lines, _ = found
+    before = len(raw if isinstance(raw, bytes) else raw.encode("utf-8")) + sum(len(l.encode("utf-8")) + 1 for l in lines)
+    if stores.is_binary_snapshot(raw) == (to == "binary") and not lines:
+        return "skipped", before, before
+    state = stores.load_session(sid)
+    if state is None:
+        return "unreadable", before, 0
+    payload = _dump(state)
+    data = stores.encode_session_payload(payload, codec=to, indent=stores.session_store.indent)
+    if stores.decode_session_payload(data) != payload:
+        return "roundtrip-mismatch", before, 0
+    after = len(data if isinstance(data, bytes) else data.encode("utf-8"))
+    if dry_run:
+        return "dry-run", before, after
+    if backup is not None and isinstance(stores.session_store, stores.FileSessionStore):
+        _backup(sid, backup)
+    stores.session_store.snapshot(sid, data)
+    check = stores.load_session(sid)
+    if check is None or _dump(check) != payload:
+        return "verify-failed", before, after
+    return "migrated", before, after
+
+
+def main_cli(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--to", choices=("binary", "json"), default="binary")
+    ap.add_argument("--dry-run", action="store_true")
+    ap.add_argument("--backup", type=Path, help="copy original files here first (file store only)")
+    ap.add_argument("--sid", action="append", help="only these session ids (repeatable)")
+    args = ap.parse_args(argv)
+
+    sids = args.sid or stores.session_store.sids()
+    counts: dict[str, int] = {}
+    total_before = total_after = 0
+    t0 = time.perf_counter()
+    for sid in sids:
+        try:
+            result, before, after = migrate(sid, args.to, args.dry_run, args.backup)
+        except Exception as e:
+            result, before, after = f"error: {e}", 0, 0
+        counts[result] = counts.get(result, 0) + 1
+        total_before += before
+        total_after += after if after else before
+        if result not in ("migrated", "skipped", "dry-run"):
+            print(f"{sid}: {result}", file=sys.stderr)
+    elapsed = time.perf_counter() - t0
+    print(f"{len(sids)} session(s) in {elapsed:.1f}s ({stores.SESSION_STORE} store → {args.to}): "
+          + ", ".join(f"{k} {v}" for k, v in sorted(counts.items())))
+    if total_before:
+        print(f"size {total_before / 1024:.1f} KiB → {total_after / 1024:.1f} KiB ({total_after / total_before:.0%})")
+    return 0 if all(k in ("migrated", "skipped", "dry-run") for k in counts) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
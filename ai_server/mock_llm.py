@@ -0,0 +1,180 @@
+"""Offline mock of the OpenAI chat-completions / embeddings API for load testing.
+
+    python mock_llm.py --port 9000 --latency-median 0.8 --latency-sigma 0.5 --error-rate 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=mock uvicorn main:app
+
+- 지연: 로그정규분포 (median, sigma). 스트리밍이면 첫 토큰까지 그만큼 기다린 뒤 chunk마다 --token-delay
+- 오류: --error-rate 비율로 429/500 (429 비중은 --rate-limit-share)
+- 응답 내용: 프롬프트를 보고 막 구조 요청 → JSON 배열, 요약 요청 → core JSON, 그 외 → 한국어 서술
+- 임베딩: 텍스트 해시로 만든 결정적 단위벡터 (같은 텍스트 → 같은 벡터)
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+import uuid
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+MOCK_LATENCY_MEDIAN = float(os.getenv("MOCK_LATENCY_MEDIAN", "0.8"))        # chat 응답 지연 median(초)
+MOCK_LATENCY_SIGMA = float(os.getenv("MOCK_LATENCY_SIGMA", "0.5"))          # lognormal sigma (꼬리 두께)
+MOCK_EMBED_LATENCY_MEDIAN = float(os.getenv("MOCK_EMBED_LATENCY_MEDIAN", "0.05"))
+MOCK_TOKEN_DELAY = float(os.getenv("MOCK_TOKEN_DELAY", "0.02"))             # 스트리밍 chunk 간격(초)
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+MOCK_RATE_LIMIT_SHARE = float(os.getenv("MOCK_RATE_LIMIT_SHARE", "0.5"))    # 오류 중 429 비율 (나머지는 500)
+MOCK_EMBED_DIM = int(os.getenv("MOCK_EMBED_DIM", "1536"))
+
+app = FastAPI()
+stats = {"chat": 0, "stream": 0, "embeddings": 0, "errors": 0}
+
+_NARRATION = [
+    "복도 끝에서 희미한 불빛이 깜박인다.",
+    "차가운 바람이 창틈으로 스며들고, 어딘가에서 발소리가 멈춘다.",
+    "상대는 잠시 말을 잃은 채 당신을 바라본다.",
+    "바닥에 떨어진 종이에는 알아볼 수 없는 기호가 적혀 있다.",
+    "멀리서 사이렌 소리가 들리더니 곧 잦아든다.",
+    "문고리는 생각보다 쉽게 돌아간다.",
+]
+
+
+def _sample_latency(median: float) -> float:
+    if median <= 0:
+        return 0.0
+    return random.lognormvariate(np.log(median), MOCK_LATENCY_SIGMA)
+
+
+def _maybe_error() -> JSONResponse | None:
+    if MOCK_ERROR_RATE <= 0 or random.random() >= MOCK_ERROR_RATE:
+        return None
+    stats["errors"] += 1
+    if random.random() < MOCK_RATE_LIMIT_SHARE:
+        return JSONResponse({"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}},
+                            status_code=429, headers={"retry-after": "1"})
+    return JSONResponse({"error": {"message": "Internal error (mock)", "type": "server_error"}}, status_code=500)
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 2)
+
+
+def _reply_for(messages: list[dict]) -> str:
+    prompt = "\n".join(str(m.get("content") or "") for m in messages)
+    if "막 구조" in prompt:
+        return json.dumps([{"act": i, "description": f"{i}막: 단서를 따라 도시의 이면으로 들어간다"} for i in range(1, 6)],
+                          ensure_ascii=False)
+    if "JSON으로 요약" in prompt or "JSON만 출력" in prompt:
+        return json.dumps({"facts": ["주인공은 낡은 편지를 발견했다"], "relationships": ["주인공 ↔ 상인: 경계"],
+                           "open_threads": ["편지의 발신인"]}, ensure_ascii=False)
+    return " ".join(random.sample(_NARRATION, 3))
+
+
+def _usage(messages: list[dict], content: str) -> dict:
+    p = sum(_estimate_tokens(str(m.get("content") or "")) for m in messages)
+    c = _estimate_tokens(content)
+    return {"prompt_tokens": p, "completion_tokens": c, "total_tokens": p + c}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "mock")
+    messages = body.get("messages") or []
+    err = _maybe_error()
+    if err is not None:
+        await asyncio.sleep(_sample_latency(MOCK_LATENCY_MEDIAN) / 4)
+        return err
+    content = _reply_for(messages)
+    cid = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    created = int(time.time())
+
+    if body.get("stream"):
+        stats["stream"] += 1
+
+        async def gen():
+            await asyncio.sleep(_sample_latency(MOCK_LATENCY_MEDIAN))   # time to first token
+            pieces = [content[i:i + 4] for i in range(0, len(content), 4)]
+            for i, piece in enumerate(pieces):
+                delta = {"content": piece} if i else {"role": "assistant", "content": piece}
+                chunk = {"id": cid, "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                if MOCK_TOKEN_DELAY > 0:
+                    await asyncio.sleep(MOCK_TOKEN_DELAY)
+            done = {"id": cid, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            yield f"data: {json.dumps(done)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(gen(), media_type="text/event-stream")
+
+    stats["chat"] += 1
+    await asyncio.sleep(_sample_latency(MOCK_LATENCY_MEDIAN))
+    return {
+        "id": cid,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": _usage(messages, content),
+    }
+
+
+def _fake_embedding(text: str, dim: int) -> list[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    v = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return (v / np.linalg.norm(v)).tolist()
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body.get("input") or []
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    err = _maybe_error()
+    if err is not None:
+        return err
+    stats["embeddings"] += 1
+    await asyncio.sleep(_sample_latency(MOCK_EMBED_LATENCY_MEDIAN))
+    dim = int(body.get("dimensions") or MOCK_EMBED_DIM)
+    tokens = sum(_estimate_tokens(t) for t in inputs)
+    return {
+        "object": "list",
+        "data": [{"object": "embedding", "index": i, "embedding": _fake_embedding(t, dim)} for i, t in enumerate(inputs)],
+        "model": body.get("model", "mock-embedding"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=9000)
+    ap.add_argument("--latency-median", type=float, default=MOCK_LATENCY_MEDIAN)
+    ap.add_argument("--latency-sigma", type=float, default=MOCK_LATENCY_SIGMA)
+    ap.add_argument("--embed-latency-median", type=float, default=MOCK_EMBED_LATENCY_MEDIAN)
+    ap.add_argument("--token-delay", type=float, default=MOCK_TOKEN_DELAY)
+    ap.add_argument("--error-rate", type=float, default=MOCK_ERROR_RATE)
+    ap.add_argument("--rate-limit-share", type=float, default=MOCK_RATE_LIMIT_SHARE)
+    ap.add_argument("--embed-dim", type=int, default=MOCK_EMBED_DIM)
+    args = ap.parse_args()
+    MOCK_LATENCY_MEDIAN = args.latency_median
+    MOCK_LATENCY_SIGMA = args.latency_sigma
+    MOCK_EMBED_LATENCY_MEDIAN = args.embed_latency_median
+    MOCK_TOKEN_DELAY = args.token_delay
+    MOCK_ERROR_RATE = args.error_rate
+    MOCK_RATE_LIMIT_SHARE = args.rate_limit_share
+    MOCK_EMBED_DIM = args.embed_dim
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,191 @@
+"""Session state model (journal mutators/replay) and the pure helpers it depends on."""
+import os
+import re
+from typing import Literal
+
+from pydantic import BaseModel, PrivateAttr
+
+# ==========================
+# Models
+# ==========================
+class Persona(BaseModel):
+    role_type: Literal["GM", "PLAYER", "NPC", "ENEMY"]
+    name: str
+    traits: list[str] = []
+    stats: dict = {}
+    speech_style: str = ""
+    goals: list[str] = []
+
+class SessionState(BaseModel):
+    story_core: dict
+    plot_outline: list[dict]
+    current_act: int
+    history: list[str]
+    personas: dict[str, Persona] = {}
+    scene_intro_done: bool = False
+    # Compaction: history는 hot tail만 유지. 앞부분은 archive segment로 내려가고 요약 트리로 남는다.
+    archived_lines: int = 0   # history[0]의 절대 인덱스
+    archived_act: int = 0     # history[0] 시점의 act
+    summary_tree: dict[str, dict] = {}  # act → {"core": {...}, "scenes": [{"start", "end", "core"}]}
+
+    # Journal bookkeeping (직렬화 대상 아님): 아직 디스크에 쓰지 않은 delta와 적용된 마지막 seq
+    _ops: list[dict] = PrivateAttr(default_factory=list)
+    _seq: int = PrivateAttr(default=0)
+    _journal_records: int = PrivateAttr(default=0)
+    _snapshotted: bool = PrivateAttr(default=False)
+    # 직렬화된 프롬프트 조각 캐시 (core / act:N / persona:NAME). 관련 delta가 적용될 때만 무효화.
+    _prompt_cache: dict[str, str] = PrivateAttr(default_factory=dict)
+    _line_tokens: list[int] = PrivateAttr(default_factory=list)  # history와 같은 길이의 토큰 추정치
+    _line_meta: list[tuple[int, str]] = PrivateAttr(default_factory=list)  # history와 같은 길이의 (act, speaker), lazy
+    _version: int = PrivateAttr(default=0)  # 마지막으로 읽거나 쓴 session store version (다른 worker 변경 감지용)
+
+    # --- Mutators: 상태 변경은 모두 여기를 거쳐 journal delta로 기록된다 ---
+    def add_history(self, *lines: str) -> None:
+        if lines:
+            self._record({"op": "history", "lines": list(lines)})
+
+    def set_act(self, act: int) -> None:
+        if act != self.current_act:
+            self._record({"op": "act", "value": act})
+
+    def set_intro_done(self, done: bool) -> None:
+        if done != self.scene_intro_done:
+            self._record({"op": "intro", "value": done})
+
+    def set_persona(self, persona: Persona) -> None:
+        if self.personas.get(persona.name) != persona:
+            self._record({"op": "persona", "name": persona.name, "persona": persona.model_dump()})
+
+    def merge_story_core(self, src: dict) -> None:
+        if src:
+            self._record({"op": "core_merge", "src": src})
+
+    def compact(self, count: int, act: int, nodes: list[dict]) -> None:
+        """Drop the first count lines (already archived) and fold their summaries into summary_tree."""
+        if count > 0:
+            self._record({"op": "compact", "count": count, "act": act, "nodes": nodes})
+
+    @property
+    def total_lines(self) -> int:
+        return self.archived_lines + len(self.history)
+
+    def apply_op(self, op: dict) -> None:
+        kind = op.get("op")
+        if kind == "history":
+            self.history.extend(op["lines"])
+            self.history_tokens()
+        elif kind == "act":
+            self.current_act = op["value"]
+        elif kind == "intro":
+            self.scene_intro_done = op["value"]
+        elif kind == "persona":
+            self.personas[op["name"]] = Persona(**op["persona"])
+            self._prompt_cache.pop(f"persona:{op['name']}", None)
+        elif kind == "core_merge":
+            self.story_core = merge_core(self.story_core, op["src"])
+            self._prompt_cache.pop("core", None)
+        elif kind == "compact":
+            n = op["count"]
+            del self.history[:n]
+            del self._line_tokens[:n]
+            del self._line_meta[:n]
+            self.archived_lines += n
+            self.archived_act = op["act"]
+            for node in op["nodes"]:
+                act = self.summary_tree.setdefault(str(node["act"]), {"core": {}, "scenes": []})
+                act["scenes"].append({k: node[k] for k in ("start", "end", "core")})
+                act["core"] = merge_core(act["core"], node["core"])
+                self._prompt_cache.pop(f"summary:{node['act']}", None)
+
+    def history_tokens(self) -> list[int]:
+        """Per-line token estimates, computed once per appended line."""
+        toks = self._line_tokens
+        if len(toks) < len(self.history):
+            toks.extend(_estimate_tokens(line) for line in self.history[len(toks):])
+        return toks
+
+    def history_meta(self) -> list[tuple[int, str]]:
+        """Per-line (act, speaker) for the hot history; 새로 붙은 줄만 계산한다."""
+        meta = self._line_meta
+        if len(meta) < len(self.history):
+            act = meta[-1][0] if meta else self.archived_act
+            for line in self.history[len(meta):]:
+                act, speaker = _line_act_speaker(line, act)
+                meta.append((act, speaker))
+        return meta
+
+    def replace_with(self, other: "SessionState") -> None:
+        """Take over another state's contents in place (다른 worker가 쓴 최신 상태로 교체; 객체 identity는 유지).
+        아직 쓰지 않은 _ops는 호출 측이 처리한다."""
+        for name in type(self).model_fields:
+            setattr(self, name, getattr(other, name))
+        self._seq = other._seq
+        self._journal_records = other._journal_records
+        self._snapshotted = other._snapshotted
+        self._version = other._version
+        self._prompt_cache = other._prompt_cache
+        self._line_tokens = other._line_tokens
+        self._line_meta = other._line_meta
+
+    def _record(self, op: dict) -> None:
+        self._seq += 1
+        op = {"seq": self._seq, **op}
+        self.apply_op(op)
+        self._ops.append(op)
+
+
+# ==========================
+# Token estimate
+# ==========================
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "heuristic").lower()  # heuristic | tiktoken
+
+_tokenizer = None
+if CONTEXT_TOKENIZER == "tiktoken":
+    try:
+        import tiktoken
+        _tokenizer = tiktoken.get_encoding("o200k_base")
+    except Exception:
+        _tokenizer = None
+
+def _estimate_tokens(text: str) -> int:
+    """Token estimate. 기본은 휴리스틱: ASCII 약 4자당 1토큰, 한글 등 비ASCII는 글자당 1토큰."""
+    if _tokenizer is not None:
+        return len(_tokenizer.encode(text, disallowed_special=()))
+    n = len(text)
+    wide = (len(text.encode("utf-8")) - n) // 2  # 3-byte 문자(한글) 수 근사
+    return (n - wide + 3) // 4 + wide + 1
+
+# ==========================
+# History line helpers
+# ==========================
+_SCENE_LINE_RE = re.compile(r"^Act (\d+) scene:")
+_SPEAKER_RE = re.compile(r"^([^:\n]{1,40}):")
+
+def _line_act_speaker(line: str, act: int) -> tuple[int, str]:
+    """(act, speaker) of one history line given the act in effect before it.
+    "Act N scene:" → ("scene", act N), "이름: ..." → 이름, 접두어 없는 플레이어 입력 → ""."""
+    m = _SCENE_LINE_RE.match(line)
+    if m:
+        return int(m.group(1)), "scene"
+    m = _SPEAKER_RE.match(line)
+    return act, m.group(1).strip() if m else ""
+
+def merge_core(dst: dict, src: dict) -> dict:
+    def merge_list(a, b):
+        a = a or []
+        b = b or []
+        seen = set(a)
+        out = list(a)
+        for x in b:
+            if x not in seen:
+                out.append(x)
+                seen.add(x)
+        return out
+    dst = dst or {}
+    src = src or {}
+    return {
+        **dst,
+        "facts": merge_list(dst.get("facts"), src.get("facts")),
+        "relationships": merge_list(dst.get("relationships"), src.get("relationships")),
+        "open_threads": merge_list(dst.get("open_threads"), src.get("open_threads")),
+    }
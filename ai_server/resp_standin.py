@@ -0,0 +1,194 @@
+"""In-memory Redis-protocol stand-in for local development / testing of SESSION_STORE=redis.
+
+    python resp_standin.py --port 6390
+    SESSION_STORE=redis SESSION_REDIS_URL=redis://127.0.0.1:6390/0 uvicorn main:app --workers 4
+
+RedisSessionStore가 쓰는 명령만 구현한다:
+PING, AUTH, SELECT, GET, SET (NX/XX/PX/EX), DEL, EXISTS, INCR, RPUSH, LRANGE, LLEN, KEYS,
+MULTI, EXEC, DISCARD, WATCH, UNWATCH, FLUSHALL.
+단일 이벤트 루프에서 명령을 하나씩 처리하므로 MULTI/EXEC 블록은 자연히 원자적이다. WATCH는 key별 수정 횟수로
+구현한다 (만료도 수정으로 친다). 데이터는 프로세스 메모리에만 있다.
+"""
+import argparse
+import asyncio
+import fnmatch
+import time
+
+
+class RespStandin:
+    def __init__(self):
+        self.data: dict[bytes, object] = {}
+        self.expires: dict[bytes, float] = {}   # key → time.monotonic() 만료 시각
+        self.revs: dict[bytes, int] = {}        # key → 수정 횟수 (WATCH)
+
+    def _changed(self, key: bytes) -> None:
+        self.revs[key] = self.revs.get(key, 0) + 1
+
+    def _expire(self, keys) -> None:
+        now = time.monotonic()
+        for k in keys:
+            at = self.expires.get(k)
+            if at is not None and at <= now:
+                del self.expires[k]
+                self.data.pop(k, None)
+                self._changed(k)
+
+    def rev(self, key: bytes) -> int:
+        self._expire([key])
+        return self.revs.get(key, 0)
+
+    # --- encoding ---
+    @staticmethod
+    def _enc(v) -> bytes:
+        if v is None:
+            return b"$-1\r\n"
+        if isinstance(v, Exception):
+            return b"-ERR %s\r\n" % str(v).encode()
+        if isinstance(v, bool):
+            return b":%d\r\n" % int(v)
+        if isinstance(v, int):
+            return b":%d\r\n" % v
+        if isinstance(v, str):
+            return b"+%s\r\n" % v.encode()
+        if isinstance(v, bytes):
+            return b"$%d\r\n%s\r\n" % (len(v), v)
+        if isinstance(v, list):
+            return b"*%d\r\n" % len(v) + b"".join(RespStandin._enc(x) for x in v)
+        raise TypeError(type(v))
+
+    # --- commands ---
+    def run(self, cmd: list[bytes]):
+        name = cmd[0].upper().decode()
+        args = cmd[1:]
+        d = self.data
+        self._expire(list(self.expires) if name == "KEYS" else args if name in ("DEL", "EXISTS") else args[:1])
+        if name == "PING":
+            return "PONG"
+        if name in ("AUTH", "SELECT"):
+            return "OK"
+        if name == "GET":
+            v = d.get(args[0])
+            if isinstance(v, list):
+                return ValueError("WRONGTYPE")
+            return str(v).encode() if isinstance(v, int) else v
+        if name == "SET":
+            opts = [a.upper() for a in args[2:]]
+            if (b"NX" in opts and args[0] in d) or (b"XX" in opts and args[0] not in d):
+                return None
+            d[args[0]] = args[1]
+            self.expires.pop(args[0], None)
+            for unit, scale in ((b"PX", 0.001), (b"EX", 1.0)):
+                if unit in opts:
+                    self.expires[args[0]] = time.monotonic() + int(args[2 + opts.index(unit) + 1]) * scale
+            self._changed(args[0])
+            return "OK"
+        if name == "DEL":
+            removed = [k for k in args if d.pop(k, None) is not None]
+            for k in removed:
+                self.expires.pop(k, None)
+                self._changed(k)
+            return len(removed)
+        if name == "EXISTS":
+            return sum(1 for k in args if k in d)
+        if name == "INCR":
+            v = d.get(args[0], 0)
+            try:
+                v = int(v) + 1
+            except (TypeError, ValueError):
+                return ValueError("value is not an integer")
+            d[args[0]] = v
+            self._changed(args[0])
+            return v
+        if name == "RPUSH":
+            lst = d.setdefault(args[0], [])
+            if not isinstance(lst, list):
+                return ValueError("WRONGTYPE")
+            lst.extend(args[1:])
+            self._changed(args[0])
+            return len(lst)
+        if name == "LRANGE":
+            lst = d.get(args[0], [])
+            start, stop = int(args[1]), int(args[2])
+            n = len(lst)
+            start = max(start + n if start < 0 else start, 0)
+            stop = stop + n if stop < 0 else stop
+            return list(lst[start:stop + 1])
+        if name == "LLEN":
+            return len(d.get(args[0], []))
+        if name == "KEYS":
+            pattern = args[0].decode("utf-8")
+            return [k for k in d if fnmatch.fnmatchcase(k.decode("utf-8", "replace"), pattern)]
+        if name == "FLUSHALL":
+            for k in d:
+                self._changed(k)
+            d.clear()
+            self.expires.clear()
+            return "OK"
+        return ValueError(f"unknown command '{name}'")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        queued: list | None = None
+        watched: dict[bytes, int] = {}   # 이 연결이 WATCH한 key → 그때의 수정 횟수
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.startswith(b"*"):
+                    cmd = line.split()   # inline command (redis-cli 스타일)
+                else:
+                    cmd = []
+                    for _ in range(int(line[1:-2])):
+                        size = int((await reader.readline())[1:-2])
+                        cmd.append((await reader.readexactly(size + 2))[:-2])
+                if not cmd:
+                    continue
+                name = cmd[0].upper()
+                if name == b"MULTI":
+                    queued = []
+                    reply = "OK"
+                elif name == b"EXEC":
+                    if queued is None:
+                        reply = ValueError("EXEC without MULTI")
+                    elif any(self.rev(k) != r for k, r in watched.items()):
+                        reply = None   # WATCH한 key가 바뀜 → 트랜잭션 취소 (nil)
+                    else:
+                        reply = [self.run(c) for c in queued]
+                    queued = None
+                    watched.clear()
+                elif name == b"DISCARD":
+                    queued = None
+                    watched.clear()
+                    reply = "OK"
+                elif name == b"WATCH" and queued is None:
+                    watched.update((k, self.rev(k)) for k in cmd[1:])
+                    reply = "OK"
+                elif name == b"UNWATCH" and queued is None:
+                    watched.clear()
+                    reply = "OK"
+                elif queued is not None:
+                    queued.append(cmd)
+                    reply = "QUEUED"
+                else:
+                    reply = self.run(cmd)
+                writer.write(self._enc(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host: str, port: int):
+    standin = RespStandin()
+    server = await asyncio.start_server(standin.handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=6390)
+    args = ap.parse_args()
+    asyncio.run(serve(args.host, args.port))
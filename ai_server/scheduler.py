@@ -0,0 +1,460 @@
+"""OpenAI client, client-side LLM scheduler (rate limit + priority) and latency-aware model routing."""
+import asyncio
+import heapq
+import json
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+import httpx
+import numpy as np
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from metrics import metrics
+from models import _estimate_tokens
+
+# ==========================
+# OpenAI client
+# ==========================
+api_key = os.getenv("OPENAI_API_KEY")
+MODEL_DEFAULT = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")  # ChatGPT UI에서는 4.1-mini가 4o-mini를 대체
+MODEL_FALLBACK = os.getenv("OPENAI_MODEL_FALLBACK", "gpt-5 -mini")
+
+# Async 경로용 동시성/커넥션 풀 설정
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "64"))  # in-flight model calls per worker
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "100"))              # pooled HTTP connections
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None  # 예: mock_llm.py → http://127.0.0.1:9000/v1
+
+# Shared async client: one pooled HTTP connection pool for every request on this worker
+aclient = AsyncOpenAI(
+    api_key=api_key,
+    base_url=OPENAI_BASE_URL,
+    timeout=OPENAI_TIMEOUT,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_POOL_SIZE,
+            max_keepalive_connections=OPENAI_POOL_SIZE,
+        ),
+    ),
+)
+
+# ==========================
+# LLM scheduler (client-side rate limit + priority)
+# ==========================
+# 모든 async OpenAI 호출은 llm_scheduler.slot()을 거친다.
+#   - 동시 호출 수 OPENAI_MAX_CONCURRENCY
+#   - token bucket: 분당 요청 수(OPENAI_RPM), 분당 추정 토큰 수(OPENAI_TPM). 0이면 제한 없음
+#   - 대기열은 우선순위 순: interactive(reply/scene/검색) > summary > memory(임베딩 저장)
+# 토큰 수는 호출 전에 추정해서 차감하고, 응답의 usage로 사후 보정한다.
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "0"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "0"))
+LLM_PRIORITIES = ("interactive", "summary", "memory")
+
+
+class TokenBucket:
+    """capacity = 1분치, 초당 rate/60씩 채워진다. 잔량은 음수(사후 보정으로 생긴 빚)가 될 수 있다."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.last = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_for(self, n: float, now: float) -> float:
+        """Seconds until n tokens are available (0 → available now). capacity보다 큰 요청은 가득 찰 때 허용."""
+        self._refill(now)
+        need = min(n, self.capacity)
+        return 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def take(self, n: float) -> None:
+        self.tokens -= n
+
+
+class LLMScheduler:
+    def __init__(self, concurrency: int = OPENAI_MAX_CONCURRENCY, rpm: float = OPENAI_RPM, tpm: float = OPENAI_TPM):
+        self.concurrency = concurrency
+        self.rpm = TokenBucket(rpm) if rpm > 0 else None
+        self.tpm = TokenBucket(tpm) if tpm > 0 else None
+        self.in_flight = 0
+        self._heap: list[tuple[int, int, float, asyncio.Future]] = []
+        self._seq = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.granted = {p: 0 for p in LLM_PRIORITIES}
+        self.throttled = 0            # rate limit 때문에 대기열 머리가 기다린 횟수
+        self.max_depth = 0
+        self._waits = {p: deque(maxlen=1024) for p in LLM_PRIORITIES}
+
+    def _dispatch(self) -> None:
+        self._timer = None
+        while self._heap and self.in_flight < self.concurrency:
+            _, _, tokens, fut = self._heap[0]
+            if fut.done():            # 대기 중 취소됨
+                heapq.heappop(self._heap)
+                continue
+            now = time.monotonic()
+            wait = max(self.rpm.wait_for(1, now) if self.rpm else 0.0,
+                       self.tpm.wait_for(tokens, now) if self.tpm else 0.0)
+            if wait > 0:
+                self.throttled += 1
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._heap)
+            if self.rpm:
+                self.rpm.take(1)
+            if self.tpm:
+                self.tpm.take(tokens)
+            self.in_flight += 1
+            fut.set_result(None)
+
+    async def acquire(self, priority: str = "interactive", tokens: float = 0) -> None:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        rank = LLM_PRIORITIES.index(priority) if priority in LLM_PRIORITIES else 0
+        self._seq += 1
+        heapq.heappush(self._heap, (rank, self._seq, tokens, fut))
+        self.max_depth = max(self.max_depth, len(self._heap))
+        t0 = time.perf_counter()
+        if self._timer is None:
+            self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()    # 슬롯을 받은 직후 취소됨
+            raise
+        self.granted[LLM_PRIORITIES[rank]] += 1
+        self._waits[LLM_PRIORITIES[rank]].append(time.perf_counter() - t0)
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        if self._timer is None:
+            self._dispatch()
+
+    def settle(self, estimated: float, actual: Optional[int]) -> None:
+        """Correct the TPM bucket with the real usage once a response arrives."""
+        if self.tpm and actual is not None:
+            self.tpm.take(actual - estimated)
+
+    @asynccontextmanager
+    async def slot(self, priority: str = "interactive", tokens: float = 0):
+        await self.acquire(priority, tokens)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self) -> dict:
+        depth = {p: 0 for p in LLM_PRIORITIES}
+        for rank, _, _, fut in self._heap:
+            if not fut.done():
+                depth[LLM_PRIORITIES[rank]] += 1
+        waits = {}
+        for p, w in self._waits.items():
+            xs = sorted(w)
+            pct = lambda q: round(xs[min(len(xs) - 1, int(q * len(xs)))] * 1000, 2) if xs else None
+            waits[p] = {"p50_ms": pct(0.5), "p95_ms": pct(0.95), "max_ms": round(xs[-1] * 1000, 2) if xs else None}
+        return {
+            "in_flight": self.in_flight,
+            "concurrency": self.concurrency,
+            "queue_depth": depth,
+            "max_queue_depth": self.max_depth,
+            "granted": dict(self.granted),
+            "wait": waits,
+            "throttled": self.throttled,
+            "rpm_tokens": round(self.rpm.tokens, 1) if self.rpm else None,
+            "tpm_tokens": round(self.tpm.tokens, 1) if self.tpm else None,
+        }
+
+llm_scheduler = LLMScheduler()
+_PURPOSE_PRIORITY = {"summary": "summary", "memory": "memory", "outline:fill": "summary"}  # 그 외 purpose는 interactive
+
+
+def _estimate_call_tokens(messages: list[dict], params: dict) -> float:
+    prompt = sum(_estimate_tokens(str(m.get("content") or "")) for m in messages)
+    return prompt + int(params.get("max_tokens") or 256)
+
+# ==========================
+# Model routing (latency/error aware)
+# ==========================
+# 모델별 최근 지연/오류를 추적해서
+#   - 연속 실패나 높은 오류율이면 circuit breaker를 열어 잠시 건너뛰고 (cooldown 후 probe 1회)
+#   - 기본 모델이 대안보다 ROUTER_SWITCH_FACTOR배 이상 느리면 대안을 먼저 쓰고
+#   - 응답이 그 모델의 p{ROUTER_HEDGE_PCT} 지연을 넘기면 다음 모델로 같은 요청을 한 번 더 보내 먼저 온 쪽을 쓴다 (hedging)
+ROUTER_MODELS = [m.strip() for m in os.getenv("OPENAI_MODELS", "").split(",") if m.strip()]  # 추가 후보 모델
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "200"))                 # 모델별 최근 표본 수
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "20"))        # 통계를 믿기 시작하는 표본 수
+ROUTER_SWITCH_FACTOR = float(os.getenv("ROUTER_SWITCH_FACTOR", "2.0"))
+ROUTER_BREAKER_FAILS = int(os.getenv("ROUTER_BREAKER_FAILS", "5"))     # 연속 실패 → open
+ROUTER_BREAKER_ERROR_RATE = float(os.getenv("ROUTER_BREAKER_ERROR_RATE", "0.5"))
+ROUTER_BREAKER_COOLDOWN = float(os.getenv("ROUTER_BREAKER_COOLDOWN", "30"))
+ROUTER_HEDGE = os.getenv("ROUTER_HEDGE", "true").lower() == "true"
+ROUTER_HEDGE_PCT = float(os.getenv("ROUTER_HEDGE_PCT", "95"))
+ROUTER_HEDGE_MIN_MS = float(os.getenv("ROUTER_HEDGE_MIN_MS", "500"))
+# 호출 목적별 timeout(초). 재시도 포함 한 모델 시도 전체에 적용.
+OPENAI_TIMEOUTS: Dict[str, float] = {
+    "reply": 20.0,
+    "scene": 30.0,
+    "summary": 45.0,
+    "outline": 30.0,
+    "outline:fill": 30.0,
+    **json.loads(os.getenv("OPENAI_TIMEOUTS", "{}")),
+}
+
+
+class ModelStats:
+    """Rolling latency/outcome window and circuit breaker for one model."""
+
+    def __init__(self, window: int = ROUTER_WINDOW):
+        self.latencies: deque = deque(maxlen=window)
+        self.outcomes: deque = deque(maxlen=window)   # True = success
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.calls = 0
+        self.failures = 0
+        self.breaker_trips = 0
+
+    def available(self, now: float) -> bool:
+        if self.opened_at is None:
+            return True
+        return now - self.opened_at >= ROUTER_BREAKER_COOLDOWN and not self.probing
+
+    def begin(self, now: float) -> None:
+        self.calls += 1
+        if self.opened_at is not None and now - self.opened_at >= ROUTER_BREAKER_COOLDOWN:
+            self.probing = True   # half-open: 이 호출 결과로 닫거나 다시 연다
+
+    def success(self, latency: Optional[float] = None) -> None:
+        if latency is not None:   # 스트림은 결과(outcome)만 기록
+            self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self, now: float) -> None:
+        self.failures += 1
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        if (self.probing or self.consecutive_failures >= ROUTER_BREAKER_FAILS
+                or (len(self.outcomes) >= ROUTER_MIN_SAMPLES and self.error_rate() >= ROUTER_BREAKER_ERROR_RATE)):
+            if self.opened_at is None or self.probing:
+                self.breaker_trips += 1
+            self.opened_at = now
+            self.probing = False
+
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self.latencies) < ROUTER_MIN_SAMPLES:
+            return None
+        return float(np.percentile(np.fromiter(self.latencies, dtype=np.float64), q))
+
+
+class ModelRouter:
+    def __init__(self, models: list[str]):
+        self.models = list(dict.fromkeys(m for m in models if m))
+        self.stats: Dict[str, ModelStats] = {m: ModelStats() for m in self.models}
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _stats(self, model: str) -> ModelStats:
+        if model not in self.stats:
+            self.stats[model] = ModelStats()
+        return self.stats[model]
+
+    def order(self, model: Optional[str] = None) -> list[str]:
+        """Models to try, best first. 모든 breaker가 열려 있으면 선호 순서 그대로 시도한다."""
+        prefs = list(dict.fromkeys([model or self.models[0], *self.models]))
+        now = time.monotonic()
+        ready = [m for m in prefs if self._stats(m).available(now)] or prefs
+        primary = ready[0]
+        p50 = self._stats(primary).percentile(50)
+        if p50 is not None and len(ready) > 1:
+            faster = [(s, m) for m in ready[1:] if (s := self._stats(m).percentile(50)) is not None
+                      and s * ROUTER_SWITCH_FACTOR < p50]
+            if faster:
+                best = min(faster)[1]
+                ready = [best, *[m for m in ready if m != best]]
+        return ready
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        if not ROUTER_HEDGE:
+            return None
+        p = self._stats(model).percentile(ROUTER_HEDGE_PCT)
+        return None if p is None else max(p, ROUTER_HEDGE_MIN_MS / 1000)
+
+    def snapshot(self) -> dict:
+        out = {"hedges": self.hedges, "hedge_wins": self.hedge_wins, "models": {}}
+        now = time.monotonic()
+        for m, s in self.stats.items():
+            pct = lambda q: None if (v := s.percentile(q)) is None else round(v * 1000, 1)
+            out["models"][m] = {
+                "calls": s.calls,
+                "failures": s.failures,
+                "error_rate": round(s.error_rate(), 4),
+                "p50_ms": pct(50),
+                "p95_ms": pct(95),
+                "breaker": "closed" if s.opened_at is None else ("half-open" if s.available(now) or s.probing else "open"),
+                "breaker_trips": s.breaker_trips,
+            }
+        return out
+
+router = ModelRouter([MODEL_DEFAULT, MODEL_FALLBACK, *ROUTER_MODELS])
+
+
+def _call_timeout(purpose: str) -> float:
+    return float(OPENAI_TIMEOUTS.get(purpose, OPENAI_TIMEOUT))
+
+
+async def _attempt(m: str, messages: list[dict], params: dict, timeout: float, purpose: str = "default",
+                   started: Optional[asyncio.Event] = None):
+    """One routed call on one model; records latency/outcome (hedge에서 취소된 호출은 기록하지 않음).
+    scheduler 대기 시간은 모델 지연에 넣지 않는다."""
+    tokens = _estimate_call_tokens(messages, params)
+    async with llm_scheduler.slot(_PURPOSE_PRIORITY.get(purpose, "interactive"), tokens):
+        if started is not None:
+            started.set()
+        stats = router._stats(m)
+        stats.begin(time.monotonic())
+        t0 = time.perf_counter()
+        try:
+            r = await asyncio.wait_for(aclient.chat.completions.create(model=m, messages=messages, **params), timeout)
+        except asyncio.CancelledError:
+            stats.probing = False
+            raise
+        except Exception:
+            stats.failure(time.monotonic())
+            metrics.inc("trpg_llm_errors_total", model=m, purpose=purpose)
+            raise
+        elapsed = time.perf_counter() - t0
+        stats.success(elapsed)
+        usage = getattr(r, "usage", None)
+        llm_scheduler.settle(tokens, getattr(usage, "total_tokens", None))
+        _record_llm(m, purpose, elapsed, usage)
+        return r
+
+
+def _record_llm(model: str, purpose: str, seconds: float, usage=None) -> None:
+    metrics.observe("trpg_llm_seconds", seconds, model=model, purpose=purpose)
+    if usage is not None:
+        for kind in ("prompt_tokens", "completion_tokens"):
+            n = getattr(usage, kind, None)
+            if n:
+                metrics.inc("trpg_llm_tokens_total", n, model=model, kind=kind.split("_")[0])
+
+
+async def _hedged(order: list[str], messages: list[dict], params: dict, timeout: float, tried: set,
+                  purpose: str = "default") -> tuple[str, object]:
+    """Call order[0]; if it is slower than its hedge delay, race it against the next model. Returns (model, response).
+    hedge 타이머는 첫 호출이 scheduler 슬롯을 받은 뒤부터 잰다 (대기열 적체가 hedge를 부추기지 않도록)."""
+    started = asyncio.Event()
+    first = asyncio.create_task(_attempt(order[0], messages, params, timeout, purpose, started))
+    tried.add(order[0])
+    tasks = [first]
+    # 호출자가 취소(클라이언트 끊김/timeout)되어도 남은 시도가 scheduler 슬롯과 토큰을 쥐고 있지 않도록 전부 정리
+    try:
+        delay = router.hedge_delay(order[0])
+        if delay is None or len(order) < 2:
+            return order[0], await first
+        waiter = asyncio.create_task(started.wait())
+        tasks.append(waiter)
+        await asyncio.wait({first, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        if not first.done():
+            await asyncio.wait({first}, timeout=delay)
+        if first.done():
+            return order[0], first.result()
+        router.hedges += 1
+        second = asyncio.create_task(_attempt(order[1], messages, params, timeout, purpose))
+        tasks.append(second)
+        tried.add(order[1])
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    if t is second:
+                        router.hedge_wins += 1
+                        return order[1], t.result()
+                    return order[0], t.result()
+                error = t.exception()
+        raise error
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+
+
+# ==========================
+# Utility
+# ==========================
+
+async def achat(messages: list[dict], model: Optional[str] = None, purpose: str = "default", **kwargs):
+    """OpenAI Chat API 래퍼. 공유 풀 클라이언트 사용, llm_scheduler로 동시 호출/rate limit/우선순위 제어.
+    purpose별 timeout, 느린 첫 시도는 다음 모델로 hedge, 실패하면 남은 모델 순서대로 Fallback."""
+    params = {"temperature": 0.7, **kwargs}
+    timeout = _call_timeout(purpose)
+    order = router.order(model)
+    tried: set = set()
+    error: Optional[BaseException] = None
+    try:
+        m, r = await _hedged(order, messages, params, timeout, tried, purpose)
+        if m != order[0]:
+            metrics.inc("trpg_llm_fallbacks_total", purpose=purpose)
+        return r
+    except Exception as e:
+        error = e
+    for m in order:
+        if m in tried:
+            continue
+        try:
+            r = await _attempt(m, messages, params, timeout, purpose)
+        except Exception as e:
+            error = e
+            continue
+        metrics.inc("trpg_llm_fallbacks_total", purpose=purpose)
+        return r
+    raise error
+
+async def achat_stream(messages: list[dict], model: Optional[str] = None, purpose: str = "default", **kwargs):
+    """Streaming chat: 텍스트 델타를 도착하는 대로 yield. 스트림 시작 전 실패 시에만 다음 모델로 Fallback.
+    스트림은 첫 응답까지의 시간에만 timeout을 건다 (hedge 없음). 스트림이 끝날 때까지 scheduler 슬롯을 잡는다."""
+    params = {"temperature": 0.7, **kwargs}
+    timeout = _call_timeout(purpose)
+    priority = _PURPOSE_PRIORITY.get(purpose, "interactive")
+    tokens = _estimate_call_tokens(messages, params)
+    error: Optional[BaseException] = None
+    for m in router.order(model):
+        async with llm_scheduler.slot(priority, tokens):
+            stats = router._stats(m)
+            stats.begin(time.monotonic())
+            t0 = time.perf_counter()
+            try:
+                stream = await asyncio.wait_for(
+                    aclient.chat.completions.create(model=m, messages=messages, stream=True, **params), timeout)
+            except Exception as e:
+                stats.failure(time.monotonic())
+                metrics.inc("trpg_llm_errors_total", model=m, purpose=purpose)
+                error = e
+                continue
+            stats.success()
+            if error is not None:
+                metrics.inc("trpg_llm_fallbacks_total", purpose=purpose)
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+            _record_llm(m, f"{purpose}:stream", time.perf_counter() - t0)
+            return
+    raise error
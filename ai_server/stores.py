@@ -0,0 +1,1112 @@
+"""Session persistence (codec, file/SQLite/Redis stores, CAS writes), write-back SessionCache and per-session locks."""
+import asyncio
+import bisect
+import json
+import os
+import socket
+import sqlite3
+import struct
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from metrics import record_stage
+from models import Persona, SessionState
+
+# ==========================
+# Session persistence (snapshot + append-only journal, pluggable store)
+# ==========================
+# 세션 하나 = 스냅샷(전체 SessionState + "_seq") + 스냅샷 이후 delta journal(JSON lines, seq 증가) + version.
+# 스냅샷 포맷은 SESSION_CODEC로 고른다 (json | binary, 아래 codec 참고). 읽을 때는 magic으로 판별한다.
+# 저장소 구현은 SESSION_STORE로 고른다:
+#   file   : {sid}.json 또는 {sid}.snap(binary) / {sid}.journal (기본, 단일 worker)
+#   sqlite : SESSION_SQLITE_PATH 하나에 WAL 모드로. 여러 worker가 같은 파일을 공유
+#   redis  : SESSION_REDIS_URL (Redis 프로토콜 서버; 개발용은 resp_standin.py)
+# 공유 저장소(sqlite/redis)에서는 쓰기마다 version이 올라가고, SessionCache가 version으로 다른 worker의 변경을 감지한다.
+# compaction archive segment({sid}.archive/)는 저장소와 상관없이 SESS_DIR 아래 파일로 남는다.
+SESS_DIR = Path(__file__).parent / "sessions"
+SESS_DIR.mkdir(parents=True, exist_ok=True)
+SESSION_SNAPSHOT_EVERY = int(os.getenv("SESSION_SNAPSHOT_EVERY", "256"))  # journal records before compaction
+SESSION_FSYNC = os.getenv("SESSION_FSYNC", "true").lower() == "true"
+SESSION_STORE = os.getenv("SESSION_STORE", "file").lower()
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", str(SESS_DIR / "sessions.sqlite3"))
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://127.0.0.1:6379/0")
+SESSION_REDIS_PREFIX = os.getenv("SESSION_REDIS_PREFIX", "trpg:sess:")
+
+def _sess_path(sid: str) -> Path:
+    return SESS_DIR / f"{sid}.json"
+
+def _snap_path(sid: str) -> Path:
+    return SESS_DIR / f"{sid}.snap"
+
+def _journal_path(sid: str) -> Path:
+    return SESS_DIR / f"{sid}.journal"
+
+# --- Binary snapshot codec ---
+#   b"TRPS" | u8 version | u8 flags(bit0 = zlib) | u16 reserved | u32 header_len | header(JSON) | body
+# header에는 section별 [offset, length](body 기준)와 history chunk 목록 [첫 줄 index, offset, length]가 있다.
+# section(meta / personas / summary_tree)과 chunk(SESSION_CODEC_CHUNK 줄짜리 JSON 배열)는 각각 따로 압축되므로
+# meta·personas·history tail만 필요하면 나머지는 풀지 않는다. journal은 포맷과 상관없이 JSON lines 그대로.
+SESSION_CODEC = os.getenv("SESSION_CODEC", "json").lower()                 # json | binary (새로 쓰는 스냅샷)
+SESSION_CODEC_LEVEL = int(os.getenv("SESSION_CODEC_LEVEL", "1"))           # zlib level, 0 → 압축 안 함
+SESSION_CODEC_CHUNK = int(os.getenv("SESSION_CODEC_CHUNK", "256"))         # history lines per chunk
+_CODEC_MAGIC = b"TRPS"
+_CODEC_VERSION = 1
+_CODEC_HEAD = struct.Struct("<4sBBHI")
+_CODEC_ZLIB = 0x01
+_CODEC_SECTIONS = ("personas", "summary_tree")   # 나머지 작은 필드(+ "_seq")는 모두 meta
+
+def _compact_json(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def encode_snapshot(payload: dict, level: int = SESSION_CODEC_LEVEL, chunk: int = SESSION_CODEC_CHUNK) -> bytes:
+    """Encode a snapshot payload (model_dump + "_seq") into the binary container."""
+    flags = _CODEC_ZLIB if level > 0 else 0
+    body = bytearray()
+
+    def put(raw: bytes) -> list[int]:
+        if flags & _CODEC_ZLIB:
+            raw = zlib.compress(raw, level)
+        body.extend(raw)
+        return [len(body) - len(raw), len(raw)]
+
+    history = payload.get("history") or []
+    meta = {k: v for k, v in payload.items() if k != "history" and k not in _CODEC_SECTIONS}
+    sections = {"meta": put(_compact_json(meta))}
+    for name in _CODEC_SECTIONS:
+        sections[name] = put(_compact_json(payload.get(name) or {}))
+    chunk = max(chunk, 1)
+    chunks = [[i, *put(_compact_json(history[i:i + chunk]))] for i in range(0, len(history), chunk)]
+    head = _compact_json({"sections": sections, "history_len": len(history), "chunks": chunks})
+    return _CODEC_HEAD.pack(_CODEC_MAGIC, _CODEC_VERSION, flags, 0, len(head)) + head + bytes(body)
+
+def is_binary_snapshot(raw) -> bool:
+    return isinstance(raw, (bytes, bytearray, memoryview)) and bytes(raw[:4]) == _CODEC_MAGIC
+
+
+class SessionBlob:
+    """Lazy view over an encoded snapshot. header만 먼저 읽고, section/chunk는 처음 필요할 때 푼다."""
+
+    def __init__(self, raw):
+        mv = memoryview(raw)
+        magic, version, flags, _, hlen = _CODEC_HEAD.unpack_from(mv)
+        if magic != _CODEC_MAGIC:
+            raise ValueError("not a binary session snapshot")
+        if version > _CODEC_VERSION:
+            raise ValueError(f"unsupported snapshot version {version}")
+        self.version = version
+        self._zlib = bool(flags & _CODEC_ZLIB)
+        start = _CODEC_HEAD.size
+        self._header = json.loads(bytes(mv[start:start + hlen]))
+        self._body = mv[start + hlen:]
+        self._sections: dict[str, object] = {}
+
+    def _raw(self, off: int, length: int) -> bytes:
+        raw = self._body[off:off + length]
+        return zlib.decompress(raw) if self._zlib else bytes(raw)
+
+    def _section(self, name: str):
+        if name not in self._sections:
+            self._sections[name] = json.loads(self._raw(*self._header["sections"][name]))
+        return self._sections[name]
+
+    def meta(self) -> dict:
+        return self._section("meta")
+
+    def personas(self) -> dict:
+        return self._section("personas")
+
+    def summary_tree(self) -> dict:
+        return self._section("summary_tree")
+
+    @property
+    def history_len(self) -> int:
+        return self._header["history_len"]
+
+    def history(self, start: int = 0, end: Optional[int] = None) -> list[str]:
+        """history[start:end], decoding only the chunks that overlap it."""
+        start, end, _ = slice(start, end).indices(self.history_len)
+        chunks = self._header["chunks"]
+        i = max(bisect.bisect_right([c[0] for c in chunks], start) - 1, 0)
+        out: list[str] = []
+        for first, off, length in chunks[i:]:
+            if first >= end:
+                break
+            out.extend(json.loads(self._raw(off, length))[max(start - first, 0):end - first])
+        return out
+
+    def history_tail(self, n: int) -> list[str]:
+        return self.history(max(self.history_len - n, 0)) if n > 0 else []  # n > 길이면 전체 (음수 start는 뒤에서 세므로 clamp)
+
+    def payload(self) -> dict:
+        return {**self.meta(), "personas": self.personas(), "summary_tree": self.summary_tree(),
+                "history": self.history()}
+
+
+def encode_session_payload(payload: dict, codec: str = SESSION_CODEC, indent: Optional[int] = None):
+    """Snapshot payload → 저장소에 넘길 값 (binary면 bytes, json이면 str)."""
+    if codec == "binary":
+        return encode_snapshot(payload)
+    return json.dumps(payload, ensure_ascii=False, indent=indent)
+
+def decode_session_payload(raw) -> dict:
+    if is_binary_snapshot(raw):
+        return SessionBlob(raw).payload()
+    return json.loads(raw)
+
+
+class SessionConflict(Exception):
+    """The stored version moved past the one a write expected (다른 worker가 먼저 씀)."""
+
+
+class SessionStore(ABC):
+    """Backend behind load_session/save_session.
+    read → (snapshot, journal lines, version); append/snapshot → 쓰기 후 version.
+    expect가 주어지면 compare-and-swap: 저장된 version이 다르면 아무것도 쓰지 않고 SessionConflict.
+    token은 쓰기와 함께 원자적으로 남는 식별자 — 응답을 잃은 쓰기가 실제로 적용됐는지 last_write로 확인한다.
+    acquire/release는 worker 간 세션 lease (턴 하나 동안 한 worker만 세션을 만진다).
+    snapshot 값은 JSON str 또는 binary codec bytes 그대로 오간다 (판별은 decode_session_payload)."""
+    shared = False   # True → 여러 worker가 같은 저장소를 본다
+    indent: Optional[int] = None
+
+    @abstractmethod
+    def read(self, sid: str) -> Optional[tuple[object, List[str], int]]:
+        ...
+
+    @abstractmethod
+    def append(self, sid: str, text: str, expect: Optional[int] = None, token: Optional[str] = None) -> int:
+        ...
+
+    @abstractmethod
+    def snapshot(self, sid: str, data, expect: Optional[int] = None, token: Optional[str] = None) -> int:
+        ...
+
+    def version(self, sid: str) -> int:
+        return 0
+
+    def last_write(self, sid: str) -> tuple[int, Optional[str]]:
+        """(version, token of the write that produced it)."""
+        return self.version(sid), None
+
+    def acquire(self, sid: str, owner: str, ttl: float) -> bool:
+        return True   # 단일 worker 저장소: asyncio lock으로 충분
+
+    def release(self, sid: str, owner: str) -> None:
+        pass
+
+    @abstractmethod
+    def sids(self) -> List[str]:
+        """All stored session ids (migration/관리 도구용)."""
+
+
+class FileSessionStore(SessionStore):
+    indent = 2
+
+    def read(self, sid: str) -> Optional[tuple[object, List[str], int]]:
+        # 포맷을 바꾸는 도중 죽었으면 둘 다 있을 수 있다 → 나중에 쓴 쪽
+        found = [p for p in (_snap_path(sid), _sess_path(sid)) if p.exists()]
+        if not found:
+            return None
+        p = max(found, key=lambda p: p.stat().st_mtime_ns)
+        j = _journal_path(sid)
+        lines = j.read_text(encoding="utf-8").splitlines() if j.exists() else []
+        data = p.read_bytes() if p.suffix == ".snap" else p.read_text(encoding="utf-8")
+        return data, lines, 0
+
+    def append(self, sid: str, text: str, expect: Optional[int] = None, token: Optional[str] = None) -> int:
+        # 한 번의 flush에 모인 delta들을 한 번에 쓰고 fsync 1회 (group commit)
+        with _journal_path(sid).open("a", encoding="utf-8") as f:
+            f.write(text)
+            _fsync(f)
+        return 0
+
+    def snapshot(self, sid: str, data, expect: Optional[int] = None, token: Optional[str] = None) -> int:
+        # tmp에 쓰고 원자적 교체 후 journal 비움. 중간에 죽어도 seq로 중복 적용을 막는다.
+        binary = isinstance(data, (bytes, bytearray))
+        p, other = (_snap_path(sid), _sess_path(sid)) if binary else (_sess_path(sid), _snap_path(sid))
+        tmp = p.with_suffix(p.suffix + ".tmp")
+        with (tmp.open("wb") if binary else tmp.open("w", encoding="utf-8")) as f:
+            f.write(data)
+            _fsync(f)
+        os.replace(tmp, p)
+        other.unlink(missing_ok=True)
+        with _journal_path(sid).open("w", encoding="utf-8") as f:
+            _fsync(f)
+        return 0
+
+    def sids(self) -> List[str]:
+        return sorted({p.stem for pattern in ("*.json", "*.snap") for p in SESS_DIR.glob(pattern) if p.is_file()})
+
+
+class SQLiteSessionStore(SessionStore):
+    """One SQLite file in WAL mode; worker마다 자기 connection을 연다."""
+    shared = True
+
+    def __init__(self, path: str = SESSION_SQLITE_PATH):
+        self._lock = threading.Lock()   # flush는 to_thread에서 돌 수 있으므로 connection 접근 직렬화
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={'FULL' if SESSION_FSYNC else 'NORMAL'}")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, snapshot TEXT, version INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY AUTOINCREMENT, sid TEXT NOT NULL, line TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS journal_sid ON journal (sid, id);
+            CREATE TABLE IF NOT EXISTS leases (sid TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);
+            """
+        )
+        if "token" not in {r[1] for r in self._conn.execute("PRAGMA table_info(sessions)")}:
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN token TEXT")
+
+    def _check(self, sid: str, expect: Optional[int]) -> None:
+        # BEGIN IMMEDIATE 안에서 호출 → 읽은 version과 쓰기 사이에 다른 writer가 끼어들 수 없다
+        if expect is None:
+            return
+        row = self._conn.execute("SELECT version FROM sessions WHERE sid = ?", (sid,)).fetchone()
+        if (row[0] if row else 0) != expect:
+            raise SessionConflict(sid)
+
+    def _bump(self, sid: str, token: Optional[str]) -> int:
+        return self._conn.execute(
+            "INSERT INTO sessions (sid, version, token) VALUES (?, 1, ?) "
+            "ON CONFLICT (sid) DO UPDATE SET version = version + 1, token = excluded.token RETURNING version",
+            (sid, token),
+        ).fetchone()[0]
+
+    def read(self, sid: str) -> Optional[tuple[object, List[str], int]]:
+        with self._lock:
+            row = self._conn.execute("SELECT snapshot, version FROM sessions WHERE sid = ?", (sid,)).fetchone()
+            if row is None or row[0] is None:
+                return None
+            lines = [r[0] for r in self._conn.execute("SELECT line FROM journal WHERE sid = ? ORDER BY id", (sid,))]
+        return row[0], lines, row[1]
+
+    def append(self, sid: str, text: str, expect: Optional[int] = None, token: Optional[str] = None) -> int:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._check(sid, expect)
+                self._conn.executemany("INSERT INTO journal (sid, line) VALUES (?, ?)",
+                                       [(sid, l) for l in text.splitlines() if l])
+                v = self._bump(sid, token)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return v
+
+    def snapshot(self, sid: str, data, expect: Optional[int] = None, token: Optional[str] = None) -> int:
+        # binary 스냅샷은 BLOB으로 저장된다 (컬럼 affinity와 상관없이 bytes 그대로 돌아옴)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._check(sid, expect)
+                v = self._bump(sid, token)
+                self._conn.execute("UPDATE sessions SET snapshot = ? WHERE sid = ?", (data, sid))
+                self._conn.execute("DELETE FROM journal WHERE sid = ?", (sid,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return v
+
+    def version(self, sid: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM sessions WHERE sid = ?", (sid,)).fetchone()
+        return row[0] if row else 0
+
+    def last_write(self, sid: str) -> tuple[int, Optional[str]]:
+        with self._lock:
+            row = self._conn.execute("SELECT version, token FROM sessions WHERE sid = ?", (sid,)).fetchone()
+        return (row[0], row[1]) if row else (0, None)
+
+    def acquire(self, sid: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT owner, expires FROM leases WHERE sid = ?", (sid,)).fetchone()
+                if row is not None and row[0] != owner and row[1] > now:
+                    self._conn.execute("ROLLBACK")
+                    return False
+                self._conn.execute("INSERT OR REPLACE INTO leases (sid, owner, expires) VALUES (?, ?, ?)",
+                                   (sid, owner, now + ttl))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return True
+
+    def release(self, sid: str, owner: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE sid = ? AND owner = ?", (sid, owner))
+
+    def sids(self) -> List[str]:
+        with self._lock:
+            return [r[0] for r in self._conn.execute("SELECT sid FROM sessions WHERE snapshot IS NOT NULL ORDER BY sid")]
+
+
+class RespError(Exception):
+    pass
+
+
+_RESP_READ_ONLY = {"GET", "LRANGE", "LLEN", "EXISTS", "KEYS", "PING"}
+
+
+class RespClient:
+    """Minimal blocking Redis-protocol (RESP2) client: pipelined commands over one socket.
+    끊긴 연결에서 다시 보내는 것은 읽기 전용 명령뿐이다. 쓰기(RPUSH/INCR/MULTI…EXEC)는 서버가 이미 적용했을 수
+    있으므로 재전송하지 않고 예외를 올린다 (CAS 계층이 처리). 대신 보내기 전에 서버가 닫은 연결을 감지해 새로 연다."""
+
+    def __init__(self, url: str = SESSION_REDIS_URL, timeout: float = 5.0):
+        u = urllib.parse.urlparse(url)
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 6379
+        self.password = u.password
+        self.db = int((u.path or "/0").lstrip("/") or 0)
+        self.timeout = timeout
+        self._sock: Optional[socket.socket] = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> None:
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile("rb")
+        setup = ([["AUTH", self.password]] if self.password else []) + ([["SELECT", str(self.db)]] if self.db else [])
+        if setup:
+            self._roundtrip(setup)
+
+    def close(self) -> None:
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock = None
+                self._file = None
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for a in args:
+            b = a if isinstance(a, bytes) else str(a).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(b), b))
+        return b"".join(out)
+
+    def _read(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            return RespError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = self._file.read(n + 2)
+            return data[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [self._read() for _ in range(n)]
+        raise RespError(f"bad reply: {line!r}")
+
+    def _roundtrip(self, commands: list) -> list:
+        self._sock.sendall(b"".join(self._encode(c) for c in commands))
+        replies = [self._read() for _ in commands]
+        for r in replies:
+            if isinstance(r, RespError):
+                raise r
+        return replies
+
+    def _ensure(self) -> None:
+        """Connect, or reconnect if the server already closed the idle socket (보내기 전이라 안전)."""
+        if self._sock is not None:
+            try:
+                self._sock.setblocking(False)
+                try:
+                    closed = self._sock.recv(1, socket.MSG_PEEK) == b""
+                except (BlockingIOError, InterruptedError):
+                    closed = False
+                finally:
+                    self._sock.settimeout(self.timeout)
+            except OSError:
+                closed = True
+            if closed:
+                self.close()
+        if self._sock is None:
+            self._connect()
+
+    def execute(self, *commands) -> list:
+        read_only = all(str(c[0]).upper() in _RESP_READ_ONLY for c in commands)
+        with self._lock:
+            for attempt in (0, 1):
+                sent = False
+                try:
+                    self._ensure()
+                    sent = True
+                    return self._roundtrip(list(commands))
+                except (OSError, ConnectionError):
+                    self.close()
+                    if attempt or (sent and not read_only):
+                        raise
+
+    def transact(self, watch: list, reads: list, build) -> Optional[list]:
+        """WATCH keys, run reads, then MULTI/build(replies)/EXEC on the same connection.
+        build가 None을 돌려주거나 WATCH한 key가 그 사이 바뀌면 None. EXEC를 보낸 뒤에는 재시도하지 않는다."""
+        with self._lock:
+            try:
+                self._ensure()
+                replies = self._roundtrip([["WATCH", *watch], *reads])[1:]
+                commands = build(replies)
+                if commands is None:
+                    self._roundtrip([["UNWATCH"]])
+                    return None
+                *_, result = self._roundtrip([["MULTI"], *commands, ["EXEC"]])
+                return result
+            except (OSError, ConnectionError):
+                self.close()
+                raise
+
+
+class RedisSessionStore(SessionStore):
+    """Keys: {prefix}{sid}:snap (string), :journal (list), :ver (counter), :token (마지막 쓰기), :lease (owner, PX).
+    쓰기는 MULTI/EXEC로 원자적이고, expect가 있으면 :ver를 WATCH해서 compare-and-swap."""
+    shared = True
+
+    def __init__(self, url: str = SESSION_REDIS_URL, prefix: str = SESSION_REDIS_PREFIX):
+        self.client = RespClient(url)
+        self.prefix = prefix
+
+    def _keys(self, sid: str) -> tuple[str, str, str]:
+        base = f"{self.prefix}{sid}"
+        return f"{base}:snap", f"{base}:journal", f"{base}:ver"
+
+    def read(self, sid: str) -> Optional[tuple[object, List[str], int]]:
+        snap, journal, ver = self._keys(sid)
+        s, lines, v = self.client.execute(["GET", snap], ["LRANGE", journal, 0, -1], ["GET", ver])
+        if s is None:
+            return None
+        data = s if is_binary_snapshot(s) else s.decode("utf-8")
+        return data, [l.decode("utf-8") for l in lines], int(v or 0)
+
+    def _write(self, sid: str, commands: list, expect: Optional[int], token: Optional[str]) -> int:
+        ver = self._keys(sid)[2]
+        commands = [*commands, ["SET", f"{self.prefix}{sid}:token", token or ""]]
+        if expect is None:
+            *_, result = self.client.execute(["MULTI"], *commands, ["INCR", ver], ["EXEC"])
+            return int(result[-1])
+        # WATCH한 version이 EXEC 전에 바뀌면 EXEC가 nil → 충돌
+        result = self.client.transact(
+            [ver], [["GET", ver]],
+            lambda replies: [*commands, ["INCR", ver]] if int(replies[0] or 0) == expect else None,
+        )
+        if result is None:
+            raise SessionConflict(sid)
+        return int(result[-1])
+
+    def append(self, sid: str, text: str, expect: Optional[int] = None, token: Optional[str] = None) -> int:
+        _, journal, _ = self._keys(sid)
+        lines = [l for l in text.splitlines() if l]
+        return self._write(sid, [["RPUSH", journal, *lines]], expect, token)
+
+    def snapshot(self, sid: str, data, expect: Optional[int] = None, token: Optional[str] = None) -> int:
+        snap, journal, _ = self._keys(sid)
+        return self._write(sid, [["SET", snap, data], ["DEL", journal]], expect, token)
+
+    def version(self, sid: str) -> int:
+        (v,) = self.client.execute(["GET", self._keys(sid)[2]])
+        return int(v or 0)
+
+    def last_write(self, sid: str) -> tuple[int, Optional[str]]:
+        v, token = self.client.execute(["GET", self._keys(sid)[2]], ["GET", f"{self.prefix}{sid}:token"])
+        return int(v or 0), (token.decode("utf-8") if token else None)
+
+    def acquire(self, sid: str, owner: str, ttl: float) -> bool:
+        (ok,) = self.client.execute(["SET", f"{self.prefix}{sid}:lease", owner, "NX", "PX", int(ttl * 1000)])
+        return ok is not None or self._renew(sid, owner, ttl)
+
+    def _renew(self, sid: str, owner: str, ttl: float) -> bool:
+        # 이미 내 lease면 (재진입/만료 직전) TTL만 갱신
+        key = f"{self.prefix}{sid}:lease"
+        result = self.client.transact(
+            [key], [["GET", key]],
+            lambda replies: [["SET", key, owner, "PX", int(ttl * 1000)]] if replies[0] == owner.encode() else None,
+        )
+        return result is not None
+
+    def release(self, sid: str, owner: str) -> None:
+        key = f"{self.prefix}{sid}:lease"
+        self.client.transact([key], [["GET", key]],
+                             lambda replies: [["DEL", key]] if replies[0] == owner.encode() else None)
+
+    def sids(self) -> List[str]:
+        (keys,) = self.client.execute(["KEYS", f"{self.prefix}*:snap"])
+        return sorted(k.decode("utf-8")[len(self.prefix):-len(":snap")] for k in keys)
+
+
+def _make_session_store(kind: str = SESSION_STORE) -> SessionStore:
+    if kind == "sqlite":
+        return SQLiteSessionStore()
+    if kind == "redis":
+        return RedisSessionStore()
+    return FileSessionStore()
+
+session_store = _make_session_store()
+
+def _replay_journal(lines: List[str], state: SessionState) -> None:
+    """Apply journal records newer than the snapshot. 잘린 마지막 줄(크래시)은 무시하고 다음 저장 때 스냅샷으로 정리.
+    스냅샷 이후 record는 저장된 순서대로 모두 적용한다. seq가 겹치거나 거꾸로 가면(CAS 이전에 두 worker가
+    같은 base에서 append한 journal) 버리지 않고 적용한 뒤 스냅샷으로 seq를 다시 매기게 한다."""
+    snap_seq = state._seq
+    for line in lines:
+        try:
+            op = json.loads(line)
+        except Exception:
+            state._snapshotted = False  # torn tail → force compaction
+            break
+        state._journal_records += 1
+        seq = op.get("seq", 0)
+        if seq <= snap_seq:
+            continue  # already folded into the snapshot
+        if seq <= state._seq:
+            state._snapshotted = False  # seq 충돌 → 다음 저장은 스냅샷
+        state.apply_op(op)
+        state._seq = max(state._seq, seq)
+
+def load_session(sid: str) -> Optional[SessionState]:
+    try:
+        found = session_store.read(sid)
+        if found is None:
+            return None
+        raw, lines, version = found
+        data = decode_session_payload(raw)
+        seq = int(data.pop("_seq", 0))
+        # pydantic이 중첩 모델을 복원할 수 있도록 변환
+        if "personas" in data and isinstance(data["personas"], dict):
+            data["personas"] = {
+                k: Persona(**v) if not isinstance(v, Persona) else v
+                for k, v in data["personas"].items()
+            }
+        state = SessionState(**data)
+        state._seq = seq
+        state._snapshotted = True
+        state._version = version
+        _replay_journal(lines, state)
+        return state
+    except Exception:
+        return None
+
+def _persist_plan(state: SessionState) -> Optional[tuple[str, object]]:
+    """Drain pending deltas into a write plan (루프에서 호출; 실제 I/O는 _write_plan).
+    ("append", lines) 또는 journal이 길어졌으면 ("snapshot", payload)."""
+    ops, state._ops = state._ops, []
+    if state._snapshotted and not ops:
+        return None
+    if not state._snapshotted or state._journal_records + len(ops) > SESSION_SNAPSHOT_EVERY:
+        state._snapshotted = True
+        state._journal_records = 0
+        return ("snapshot", {**state.model_dump(), "_seq": state._seq})
+    state._journal_records += len(ops)
+    return ("append", "".join(json.dumps(op, ensure_ascii=False) + "\n" for op in ops))
+
+def _fsync(f) -> None:
+    if SESSION_FSYNC:
+        f.flush()
+        os.fsync(f.fileno())
+
+def _write_plan(sid: str, plan: Optional[tuple[str, object]], expect: Optional[int] = None,
+                token: Optional[str] = None) -> Optional[int]:
+    """Execute a write plan against the session store; returns the store version after the write."""
+    if plan is None:
+        return None
+    kind, data = plan
+    if kind == "append":
+        return session_store.append(sid, data, expect, token)
+    return session_store.snapshot(sid, encode_session_payload(data, indent=session_store.indent), expect, token)
+
+def _rebase_ops(state: SessionState, ops: List[dict]) -> None:
+    """Re-record ops on top of state (seq는 state 기준으로 새로 매긴다)."""
+    for op in ops:
+        state._record({k: v for k, v in op.items() if k != "seq"})
+
+def _write_cas(sid: str, plan: Optional[tuple[str, object]], ops: List[dict],
+               expect: int) -> tuple[Optional[int], Optional[SessionState]]:
+    """Write a plan expecting the store to still be at `expect` (스레드에서 실행).
+    공유 저장소에서 다른 worker가 먼저 썼으면 최신 상태를 다시 읽어 ops를 그 위에 다시 적용하고 재시도한다.
+    → (쓰기 후 version, 다시 읽어 만든 state 또는 None)."""
+    if not session_store.shared:
+        return _write_plan(sid, plan), None
+    rebased = None
+    for _ in range(SESSION_CAS_RETRIES):
+        token = uuid.uuid4().hex
+        try:
+            return _write_plan(sid, plan, expect, token), rebased
+        except SessionConflict:
+            pass
+        except Exception:
+            # 응답을 잃었을 수 있다 (연결 끊김 등): 이 쓰기가 적용됐으면 성공으로, 아니면 그대로 실패로 올린다
+            try:
+                version, last = session_store.last_write(sid)
+            except Exception:
+                last = None
+            if last != token:
+                raise
+            return version, rebased
+        rebased = load_session(sid)
+        if rebased is None:
+            raise SessionConflict(sid)
+        _rebase_ops(rebased, ops)
+        expect = rebased._version
+        plan = _persist_plan(rebased)
+    raise SessionConflict(sid)
+
+def peek_session(sid: str, tail: int = 30) -> Optional[dict]:
+    """Read-only view (meta, personas, history tail) without building a SessionState.
+    binary 스냅샷이면 history 전체를 풀지 않는다. JSON 스냅샷이거나 journal에 history/act/intro/persona 외의
+    record(core_merge, compact)가 있으면 None → 호출 측이 load_session으로 처리."""
+    found = session_store.read(sid)
+    if found is None or not is_binary_snapshot(found[0]):
+        return None
+    raw, lines, _ = found
+    blob = SessionBlob(raw)
+    meta, personas = dict(blob.meta()), dict(blob.personas())
+    seq = int(meta.get("_seq", 0))
+    extra: list[str] = []
+    for line in lines:
+        try:
+            op = json.loads(line)
+        except Exception:
+            break  # torn tail: load_session과 같이 무시
+        if op.get("seq", 0) <= seq:
+            continue
+        kind = op.get("op")
+        if kind == "history":
+            extra.extend(op["lines"])
+        elif kind == "act":
+            meta["current_act"] = op["value"]
+        elif kind == "intro":
+            meta["scene_intro_done"] = op["value"]
+        elif kind == "persona":
+            personas[op["name"]] = op["persona"]
+        else:
+            return None
+        seq = op["seq"]
+    recent = (blob.history_tail(max(tail - len(extra), 0)) + extra)[-tail:] if tail > 0 else []
+    return {
+        "story_core": meta.get("story_core", {}),
+        "outline": meta.get("plot_outline", []),
+        "current_act": meta.get("current_act"),
+        "scene_intro_done": meta.get("scene_intro_done", False),
+        "recent_history": recent,
+        "personas": personas,
+    }
+
+def save_session(sid: str, state: SessionState) -> None:
+    try:
+        version = _write_plan(sid, _persist_plan(state))
+    except Exception:
+        state._snapshotted = False  # 유실된 delta는 다음 저장 때 스냅샷으로 복구
+        raise
+    if version is not None:
+        state._version = version
+
+# ==========================
+# Session cache (write-back)
+# ==========================
+SESSION_CACHE_MAX = int(os.getenv("SESSION_CACHE_MAX", "512"))          # sessions kept in memory
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "1800"))       # idle seconds before eviction
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "2"))  # <=0 → write-through
+SESSION_VALIDATE_INTERVAL = float(os.getenv("SESSION_VALIDATE_INTERVAL", "1"))  # 공유 저장소 version 확인 간격(초); lease를 잡으면 즉시 확인
+SESSION_CAS_RETRIES = int(os.getenv("SESSION_CAS_RETRIES", "5"))        # 공유 저장소 version 충돌 시 재시도 횟수
+SESSION_LEASE_TTL = float(os.getenv("SESSION_LEASE_TTL", "120"))        # worker 간 세션 lease 만료(초), 턴 최대 길이보다 길게
+
+class SessionCache:
+    """In-memory session cache in front of load_session/save_session.
+    - hot session은 메모리에서 바로 반환 (디스크 재읽기 없음)
+    - put()은 dirty 표시만 하고, 타이머(_session_flush_loop) 또는 eviction 시 디스크에 기록
+    - 크기 초과 시 LRU 순, idle TTL 초과 시 제거. dirty 세션은 _evicted로 옮겨 스레드에서 기록한다
+      (eviction이 요청 경로에서 일어나도 fsync/DB I/O가 이벤트 루프를 막지 않음; 기록 전 다시 요청되면 되살린다)
+    - 공유 저장소(sqlite/redis)는 여러 worker가 같은 세션을 만질 수 있으므로
+      - put/mark_dirty 즉시 백그라운드로 기록 (write-through; 턴 끝의 session_lock 해제 전에 기록 완료를 기다림)
+      - 기록은 읽었던 version에 대한 compare-and-swap. 충돌하면 최신 상태를 다시 읽어 아직 안 쓴 ops를 다시 적용
+      - hit 때 store version을 확인하고, 다른 worker가 썼으면 다시 읽는다. dirty 세션도 그대로 믿지 않고
+        최신 상태 위에 ops를 다시 얹는다 → sticky routing 없이 어느 worker로 가도 된다
+    """
+
+    def __init__(self, max_size: int = SESSION_CACHE_MAX, ttl: float = SESSION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[str, SessionState]" = OrderedDict()  # LRU 순서 (앞쪽이 가장 오래됨)
+        self._touched: Dict[str, float] = {}
+        self._dirty: set[str] = set()
+        self._validated: Dict[str, float] = {}
+        self._evicted: Dict[str, SessionState] = {}   # dirty인 채로 밀려나 아직 기록 중/대기 중인 세션
+        self._evict_task: Optional[asyncio.Task] = None
+        self._writing: Dict[str, list] = {}   # sid → [asyncio.Lock, users]: 같은 세션의 기록은 한 번에 하나
+        self._tasks: set[asyncio.Task] = set()
+        self.invalidations = 0
+        self.conflicts = 0
+
+    def __contains__(self, sid: str) -> bool:
+        # 밀려나 기록을 기다리는 세션도 이 worker의 메모리가 최신본이다
+        return sid in self._items or sid in self._evicted
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _cached(self, sid: str) -> Optional[SessionState]:
+        if sid in self._evicted:
+            # 기록이 끝나기 전에 다시 요청됨 → 그대로 되살린다 (진행 중인 기록이 실패해도 dirty로 다시 잡힘)
+            self._items[sid] = self._evicted.pop(sid)
+            self._dirty.add(sid)
+        return self._items.get(sid)
+
+    def _should_validate(self, sid: str) -> bool:
+        if not session_store.shared or sid in self._writing:
+            return False  # 기록 중: 끝나면 version이 맞춰지거나 충돌 처리에서 다시 읽는다
+        now = time.monotonic()
+        if now - self._validated.get(sid, 0.0) < SESSION_VALIDATE_INTERVAL:
+            return False
+        self._validated[sid] = now
+        return True
+
+    def _admit(self, sid: str, state: SessionState) -> SessionState:
+        self._items[sid] = state
+        self._touch(sid)
+        self._evict_overflow()
+        return state
+
+    async def aget(self, sid: str) -> Optional[SessionState]:
+        """Cached state; store version check / miss load run in a thread (요청 경로에서 쓰는 쪽)."""
+        state = self._cached(sid)
+        if state is not None:
+            if self._should_validate(sid):
+                seen = state._version
+                try:
+                    version = await asyncio.to_thread(session_store.version, sid)
+                    fresh = None if version == seen else await asyncio.to_thread(load_session, sid)
+                except Exception:
+                    fresh = None
+                # await 사이에 이 worker가 기록했거나 entry가 바뀌었으면 fresh는 이미 낡았을 수 있다 → 다음 확인으로 미룸
+                current = self._cached(sid)
+                if current is None:
+                    current = state
+                if fresh is not None and current is state and state._version == seen and sid not in self._writing:
+                    current = self._take_fresh(sid, state, fresh)
+                state = current
+            return self._admit(sid, state)
+        fresh = await asyncio.to_thread(load_session, sid)
+        state = self._cached(sid)  # await 사이에 다른 요청이 먼저 올렸을 수 있다
+        if state is None:
+            if fresh is None:
+                return None
+            state = fresh
+        return self._admit(sid, state)
+
+    def get(self, sid: str) -> Optional[SessionState]:
+        """Blocking variant of aget for scripts/tools (이벤트 루프 밖)."""
+        state = self._cached(sid)
+        if state is not None and self._should_validate(sid):
+            try:
+                fresh = None if session_store.version(sid) == state._version else load_session(sid)
+            except Exception:
+                fresh = None
+            if fresh is not None:
+                state = self._take_fresh(sid, state, fresh)
+        if state is None:
+            state = load_session(sid)
+            if state is None:
+                return None
+        return self._admit(sid, state)
+
+    def _take_fresh(self, sid: str, state: SessionState, fresh: SessionState) -> SessionState:
+        """다른 worker가 쓴 최신 상태를 반영한다."""
+        self.invalidations += 1
+        if state._ops:
+            # 아직 쓰지 않은 변경이 있으면 최신 상태 위에 다시 적용 (객체는 그대로 → 들고 있는 참조도 유효)
+            pending, state._ops = state._ops, []
+            state.replace_with(fresh)
+            _rebase_ops(state, pending)
+            return state
+        self._dirty.discard(sid)
+        self._items[sid] = fresh
+        return fresh
+
+    def put(self, sid: str, state: SessionState) -> None:
+        self._items[sid] = state
+        self._touch(sid)
+        self.mark_dirty(sid)
+        self._evict_overflow()
+
+    def mark_dirty(self, sid: str) -> None:
+        if sid not in self._items:
+            return
+        self._dirty.add(sid)
+        # write-through(SESSION_FLUSH_INTERVAL <= 0)이거나 공유 저장소면 바로 기록 — 루프 안에서는 스레드로
+        if (SESSION_FLUSH_INTERVAL <= 0 or session_store.shared) and not self._spawn(self.aflush(sid)):
+            self.flush(sid)  # 이벤트 루프 밖
+
+    def _spawn(self, coro) -> bool:
+        try:
+            task = asyncio.get_running_loop().create_task(coro)
+        except RuntimeError:
+            coro.close()
+            return False
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    # --- 기록: 루프에서 delta를 plan으로 뽑고, I/O(+충돌 시 재적용)는 _write_cas ---
+    def _failed(self, sid: str, state: SessionState, ops: List[dict]) -> None:
+        state._ops[:0] = ops          # 충돌 재적용에 쓸 수 있도록 되돌려 둔다
+        state._snapshotted = False    # 유실된 delta는 다음 저장 때 스냅샷으로 복구
+        if self._items.get(sid) is state:
+            self._dirty.add(sid)
+
+    def _landed(self, sid: str, state: SessionState, version: Optional[int], rebased: Optional[SessionState]) -> None:
+        if rebased is not None:
+            # 다른 worker의 변경 위에 다시 적용해 기록됨 → 그 결과로 갈아끼우고, 기록 중에 붙은 ops는 그 위에 다시 얹는다
+            self.conflicts += 1
+            pending, state._ops = state._ops, []
+            state.replace_with(rebased)
+            _rebase_ops(state, pending)
+            if state._ops and self._items.get(sid) is state:
+                self._dirty.add(sid)
+        if version is not None:
+            state._version = version
+
+    def _write(self, sid: str, state: SessionState) -> bool:
+        ops = list(state._ops)
+        plan = _persist_plan(state)
+        if plan is None:
+            return True
+        try:
+            result = _write_cas(sid, plan, ops, state._version)
+        except Exception:
+            self._failed(sid, state, ops)
+            return False
+        self._landed(sid, state, *result)
+        return True
+
+    async def _awrite(self, sid: str, state: SessionState) -> bool:
+        entry = self._writing.setdefault(sid, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                ops = list(state._ops)
+                plan = _persist_plan(state)
+                if plan is None:
+                    return True
+                try:
+                    result = await asyncio.to_thread(_write_cas, sid, plan, ops, state._version)
+                except Exception:
+                    self._failed(sid, state, ops)
+                    return False
+                self._landed(sid, state, *result)
+                return True
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._writing.pop(sid, None)
+
+    def flush(self, sid: str) -> None:
+        state = self._items.get(sid)
+        self._dirty.discard(sid)
+        if state is None:
+            return
+        self._write(sid, state)
+
+    def flush_all(self) -> None:
+        for sid in list(self._dirty):
+            self.flush(sid)
+        for sid, state in list(self._evicted.items()):
+            if self._write(sid, state):
+                self._evicted.pop(sid, None)
+
+    async def aflush(self, sid: str) -> None:
+        """Write one session now, off the loop (이미 기록 중이면 그것이 끝난 뒤 남은 delta를 기록)."""
+        if sid in self._evicted:
+            await self._await_evicted()
+        state = self._items.get(sid)
+        if state is None:
+            return
+        self._dirty.discard(sid)
+        await self._awrite(sid, state)
+
+    async def aflush_all(self) -> None:
+        """Timer flush: drain deltas on the loop (state는 루프에서만 변경됨), write in a thread."""
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)  # 진행 중인 write-through
+        await self._await_evicted()  # eviction 기록과 같은 세션을 동시에 쓰지 않도록 먼저 끝낸다
+        for sid in list(self._dirty):
+            state = self._items.get(sid)
+            self._dirty.discard(sid)
+            if state is not None:
+                await self._awrite(sid, state)
+        await self._await_evicted()
+
+    async def _await_evicted(self) -> None:
+        if self._evict_task is not None and not self._evict_task.done():
+            await asyncio.shield(self._evict_task)
+        elif self._evicted:
+            await self._flush_evicted()
+
+    async def _flush_evicted(self) -> None:
+        """Write evicted dirty sessions off the loop. 실패한 것은 남겨 두고 다음 flush 주기에 다시 시도."""
+        failed: set[str] = set()
+        while True:
+            pending = [sid for sid in self._evicted if sid not in failed]
+            if not pending:
+                return
+            sid = pending[0]
+            state = self._evicted[sid]
+            if not await self._awrite(sid, state):
+                failed.add(sid)
+            elif self._evicted.get(sid) is state:
+                del self._evicted[sid]
+
+    def _schedule_evicted_flush(self) -> None:
+        if self._evict_task is not None and not self._evict_task.done():
+            return  # 실행 중인 task가 새로 들어온 것까지 처리한다
+        try:
+            self._evict_task = asyncio.get_running_loop().create_task(self._flush_evicted())
+        except RuntimeError:
+            self.flush_all()  # 이벤트 루프 밖 (스크립트/종료 후): 바로 기록
+
+    def expire(self) -> None:
+        """Evict sessions idle longer than ttl (flushing dirty ones first)."""
+        cutoff = time.monotonic() - self.ttl
+        for sid in list(self._items):
+            if self._touched.get(sid, 0) > cutoff:
+                break  # LRU 순서이므로 이후는 모두 최근 사용
+            self._drop(sid)
+
+    def _touch(self, sid: str) -> None:
+        self._items.move_to_end(sid)
+        self._touched[sid] = time.monotonic()
+
+    def _drop(self, sid: str) -> None:
+        state = self._items.pop(sid, None)
+        self._touched.pop(sid, None)
+        self._validated.pop(sid, None)
+        if sid in self._dirty:
+            self._dirty.discard(sid)
+            if state is not None:
+                self._evicted[sid] = state
+                self._schedule_evicted_flush()
+
+    def _evict_overflow(self) -> None:
+        while len(self._items) > self.max_size:
+            self._drop(next(iter(self._items)))
+
+sessions = SessionCache()
+
+# ==========================
+# Per-session concurrency
+# ==========================
+# 같은 session_id의 턴은 직렬화, 다른 세션은 완전 병렬. 대기자가 없으면 lock 항목을 지워 테이블이 커지지 않음.
+# 공유 저장소면 worker 간에도 직렬화: asyncio lock 다음에 저장소 lease(SQLite leases 행 / Redis SET NX PX)를 잡고,
+# 턴의 변경을 기록한 뒤에 놓는다 → 다른 worker는 이 턴이 반영된 상태에서 다음 턴을 시작한다.
+
+_session_locks: Dict[str, asyncio.Lock] = {}
+_session_lock_users: Dict[str, int] = {}
+_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+async def _acquire_lease(sid: str) -> None:
+    delay = 0.02
+    while not await asyncio.to_thread(session_store.acquire, sid, _WORKER_ID, SESSION_LEASE_TTL):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    sessions._validated.pop(sid, None)  # lease를 잡은 뒤 첫 조회는 store version을 반드시 확인
+
+async def _release_lease(sid: str) -> None:
+    try:
+        await sessions.aflush(sid)
+    finally:
+        try:
+            await asyncio.to_thread(session_store.release, sid, _WORKER_ID)
+        except Exception:
+            pass  # 못 놓으면 SESSION_LEASE_TTL 뒤 만료
+
+@asynccontextmanager
+async def session_lock(sid: str):
+    lock = _session_locks.setdefault(sid, asyncio.Lock())
+    _session_lock_users[sid] = _session_lock_users.get(sid, 0) + 1
+    try:
+        t0 = time.perf_counter()
+        async with lock:
+            if not session_store.shared:
+                record_stage("lock", time.perf_counter() - t0)
+                yield
+                return
+            await _acquire_lease(sid)
+            record_stage("lock", time.perf_counter() - t0)
+            try:
+                yield
+            finally:
+                await _release_lease(sid)
+    finally:
+        n = _session_lock_users[sid] - 1
+        if n:
+            _session_lock_users[sid] = n
+        else:
+            _session_lock_users.pop(sid, None)
+            _session_locks.pop(sid, None)
+
+async def _session_flush_loop():
+    interval = SESSION_FLUSH_INTERVAL if SESSION_FLUSH_INTERVAL > 0 else 5.0
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            sessions.expire()
+            await sessions.aflush_all()
+        except Exception:
+            pass
+
+# ==========================
+# Archive segments (compaction cold storage)
+# ==========================
+# compaction이 hot history 앞부분을 {sid}.archive/{start:09d}.jsonl로 내려보낸다 (불변, 줄마다 JSON 문자열 하나).
+def _archive_dir(sid: str) -> Path:
+    return SESS_DIR / f"{sid}.archive"
+
+def _write_archive_segment(sid: str, start: int, lines: list[str]) -> None:
+    """Write raw lines [start, start+len) as an immutable segment. 같은 start로 다시 써도 결과 동일(idempotent)."""
+    d = _archive_dir(sid)
+    d.mkdir(parents=True, exist_ok=True)
+    p = d / f"{start:09d}.jsonl"
+    tmp = p.with_suffix(".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        f.write("".join(json.dumps(l, ensure_ascii=False) + "\n" for l in lines))
+        _fsync(f)
+    os.replace(tmp, p)
+
+def load_archived_lines(sid: str, start: int, end: int) -> list[str]:
+    """Read archived raw lines in [start, end) from cold segments."""
+    out: list[str] = []
+    d = _archive_dir(sid)
+    if not d.exists():
+        return out
+    for p in sorted(d.glob("*.jsonl")):
+        seg_start = int(p.stem)
+        if seg_start >= end:
+            break
+        with p.open("r", encoding="utf-8") as f:
+            for i, line in enumerate(f, seg_start):
+                if i >= end:
+                    break
+                if i >= start:
+                    out.append(json.loads(line))
+    return out
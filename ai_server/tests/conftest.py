@@ -0,0 +1,40 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 모듈들이 import 시점에 env를 읽으므로 먼저 설정: API 키 없이 import, 캐시/메모리는 임시 디렉터리로
+_TMP = Path(tempfile.mkdtemp(prefix="trpg-test-"))
+os.environ.setdefault("OPENAI_API_KEY", "test-offline")
+os.environ.setdefault("MEMORY_BACKEND", "local")
+os.environ.setdefault("CHROMA_DIR", str(_TMP / "chroma"))
+os.environ.setdefault("EMBED_CACHE_DIR", str(_TMP / "embeddings"))
+os.environ.setdefault("DICE_KEYWORDS_DIR", str(_TMP / "dice_keywords"))
+os.environ.setdefault("SESSION_FSYNC", "false")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pytest  # noqa: E402
+
+import stores  # noqa: E402
+from models import Persona, SessionState  # noqa: E402
+
+
+@pytest.fixture
+def sess_dir(tmp_path, monkeypatch):
+    """File session store under tmp_path (snapshots, journals, archive segments)."""
+    d = tmp_path / "sessions"
+    d.mkdir()
+    monkeypatch.setattr(stores, "SESS_DIR", d)
+    monkeypatch.setattr(stores, "session_store", stores.FileSessionStore())
+    return d
+
+
+def make_state(lines: int = 0, act: int = 1) -> SessionState:
+    state = SessionState(
+        story_core={"world": "항구 도시", "facts": ["안개가 짙다"]},
+        plot_outline=[{"act": i, "description": f"act{i}"} for i in range(1, 4)],
+        current_act=act,
+        history=[f"민수: 대사 {i}" for i in range(lines)],
+    )
+    state.set_persona(Persona(role_type="PLAYER", name="민수", traits=["신중함"]))
+    return state
@@ -0,0 +1,139 @@
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import pytest
+
+import stores
+from conftest import make_state
+
+STANDIN = Path(__file__).resolve().parent.parent / "resp_standin.py"
+
+
+@pytest.fixture(scope="module")
+def redis_url():
+    """resp_standin.py on a free port (RedisSessionStore가 쓰는 명령만 구현한 in-memory 서버)."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    proc = subprocess.Popen([sys.executable, str(STANDIN), "--port", str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            break
+        except OSError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                proc.kill()
+                pytest.skip("resp_standin.py did not start")
+            time.sleep(0.05)
+    yield f"redis://127.0.0.1:{port}/0"
+    proc.terminate()
+    proc.wait(timeout=5)
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def store(request, sess_dir, monkeypatch):
+    if request.param == "sqlite":
+        st = stores.SQLiteSessionStore(str(sess_dir / "sessions.sqlite3"))
+    else:
+        st = stores.RedisSessionStore(request.getfixturevalue("redis_url"), prefix=f"test:{uuid.uuid4().hex}:")
+    monkeypatch.setattr(stores, "session_store", st)
+    return st
+
+
+def test_versions_advance_per_write(store):
+    assert store.version("s") == 0
+    state = make_state(1)
+    stores.save_session("s", state)
+    assert state._version == store.version("s") == 1
+    state.add_history("민수: 둘")
+    stores.save_session("s", state)
+    assert state._version == 2
+    assert stores.load_session("s")._version == 2
+
+
+def test_stale_append_and_snapshot_conflict(store):
+    stores.save_session("s", make_state(1))
+    v = store.version("s")
+    store.append("s", '{"seq": 90, "op": "history", "lines": ["A: 1"]}\n', expect=v)
+
+    with pytest.raises(stores.SessionConflict):
+        store.append("s", '{"seq": 91, "op": "history", "lines": ["B: 1"]}\n', expect=v)
+    with pytest.raises(stores.SessionConflict):
+        store.snapshot("s", '{"history": []}', expect=v)
+    # 충돌한 쓰기는 아무것도 남기지 않는다
+    assert store.version("s") == v + 1
+    assert stores.load_session("s").history[-1] == "A: 1"
+
+
+def test_last_write_token_identifies_the_write(store):
+    stores.save_session("s", make_state(1))
+    v = store.append("s", '{"seq": 90, "op": "act", "value": 2}\n', expect=store.version("s"), token="tok-1")
+    assert store.last_write("s") == (v, "tok-1")
+
+
+def test_write_cas_rebases_on_other_workers_write(store):
+    stores.save_session("s", make_state(1))
+    a = stores.load_session("s")
+    b = stores.load_session("s")
+
+    a.add_history("A: 먼저")
+    stores.save_session("s", a)
+
+    b.add_history("B: 나중")
+    ops = list(b._ops)
+    version, rebased = stores._write_cas("s", stores._persist_plan(b), ops, b._version)
+    assert rebased is not None
+    assert rebased.history[-2:] == ["A: 먼저", "B: 나중"]
+    assert version == store.version("s") == 3
+    assert stores.load_session("s").history == rebased.history
+
+
+def test_write_cas_gives_up_after_retries(store, monkeypatch):
+    monkeypatch.setattr(stores, "SESSION_CAS_RETRIES", 2)
+    stores.save_session("s", make_state(1))
+    b = stores.load_session("s")
+    real_append = store.append
+
+    def racing_append(sid, text, expect=None, token=None):
+        # 매 시도 직전에 다른 worker가 먼저 쓴다 (이미 스냅샷에 접힌 seq라 replay에는 영향 없음)
+        real_append(sid, '{"seq": 0, "op": "intro", "value": true}\n')
+        return real_append(sid, text, expect, token)
+
+    monkeypatch.setattr(store, "append", racing_append)
+    b.add_history("B: 1")
+    ops = list(b._ops)
+    with pytest.raises(stores.SessionConflict):
+        stores._write_cas("s", stores._persist_plan(b), ops, b._version)
+
+
+def test_cache_write_through_resolves_conflict(store):
+    worker1 = stores.SessionCache()
+    worker2 = stores.SessionCache()
+    stores.save_session("s", make_state(1))
+    a = worker1.get("s")
+    b = worker2.get("s")
+
+    a.add_history("A: 1")
+    worker1.mark_dirty("s")   # 공유 저장소: 이벤트 루프 밖이면 바로 기록
+    b.add_history("B: 1")
+    worker2.mark_dirty("s")
+
+    assert worker2.conflicts == 1
+    assert b.history[-2:] == ["A: 1", "B: 1"]
+    assert stores.load_session("s").history == b.history
+
+
+def test_lease_is_exclusive_per_owner(store):
+    assert store.acquire("s", "w1", 30)
+    assert store.acquire("s", "w1", 30)   # 재진입
+    assert not store.acquire("s", "w2", 30)
+    store.release("s", "w2")              # 남의 lease는 놓을 수 없다
+    assert not store.acquire("s", "w2", 30)
+    store.release("s", "w1")
+    assert store.acquire("s", "w2", 30)
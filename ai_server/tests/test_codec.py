@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import stores
+from conftest import make_state
+
+
+def _payload(lines: int) -> dict:
+    state = make_state(lines)
+    state.compact(min(lines, 3), 1, [{"act": 1, "start": 0, "end": 3, "core": {"facts": ["부두"]}}] if lines else [])
+    return {**state.model_dump(), "_seq": state._seq}
+
+
+@pytest.mark.parametrize("level", [0, 1, 9])
+@pytest.mark.parametrize("lines", [0, 1, 7, 64, 65, 300])
+def test_round_trip(level, lines):
+    payload = _payload(lines)
+    blob = stores.encode_snapshot(payload, level=level, chunk=16)
+    assert stores.is_binary_snapshot(blob)
+    view = stores.SessionBlob(blob)
+    assert view.payload() == payload
+    assert view.history_len == len(payload["history"])
+    assert view.meta()["_seq"] == payload["_seq"]
+    assert view.personas() == payload["personas"]
+    assert view.summary_tree() == payload["summary_tree"]
+
+
+def test_history_slices_match_list_slices():
+    payload = _payload(100)
+    history = payload["history"]
+    view = stores.SessionBlob(stores.encode_snapshot(payload, chunk=8))
+    n = len(history)
+    for start in (0, 1, 7, 8, 9, 50, n - 1, n, n + 5, -3):
+        for end in (None, 0, 8, 16, 17, n - 1, n, n + 5, -1):
+            assert view.history(start, end) == history[start:end], (start, end)
+    for k in (0, 1, 8, 9, n, n + 10):
+        assert view.history_tail(k) == (history[-k:] if k else [])
+
+
+def test_tail_decodes_only_overlapping_chunks(monkeypatch):
+    view = stores.SessionBlob(stores.encode_snapshot(_payload(200), chunk=10))
+    seen = []
+    raw = view._raw
+    monkeypatch.setattr(view, "_raw", lambda off, length: seen.append(off) or raw(off, length))
+    view.history_tail(15)
+    assert len(seen) == 2
+
+
+def test_chunk_is_clamped_to_one():
+    payload = _payload(5)
+    assert stores.SessionBlob(stores.encode_snapshot(payload, chunk=0)).payload() == payload
+
+
+def test_decode_session_payload_accepts_both_codecs():
+    payload = _payload(20)
+    text = stores.encode_session_payload(payload, codec="json", indent=2)
+    blob = stores.encode_session_payload(payload, codec="binary")
+    assert isinstance(text, str) and isinstance(blob, bytes)
+    assert stores.decode_session_payload(text) == payload
+    assert stores.decode_session_payload(blob) == payload
+    assert stores.decode_session_payload(memoryview(blob)) == payload
+    assert not stores.is_binary_snapshot(text)
+    assert not stores.is_binary_snapshot(text.encode("utf-8"))
+
+
+def test_rejects_foreign_or_newer_blobs():
+    blob = bytearray(stores.encode_snapshot(_payload(3)))
+    with pytest.raises(ValueError):
+        stores.SessionBlob(b"JUNK" + bytes(blob[4:]))
+    blob[4] = stores._CODEC_VERSION + 1
+    with pytest.raises(ValueError):
+        stores.SessionBlob(bytes(blob))
+
+
+def test_binary_is_smaller_than_json_for_long_history():
+    payload = _payload(2000)
+    assert len(stores.encode_snapshot(payload)) < len(json.dumps(payload, ensure_ascii=False).encode("utf-8")) // 2
@@ -0,0 +1,147 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import dice
+import main
+
+
+@pytest.mark.parametrize("expr", [
+    "d20", "2d6+1", "3d4-2", "4d6kh3", "4d6k3", "4d6dl1", "4d6d1", "2d20kl1", "5d10dh2",
+    "2d6+1d4+3", "6d10>=7", "3d6!", "d%", "2D6 + 1", "-d4+10", f"{dice.DICE_MAX_COUNT}d{dice.DICE_MAX_SIDES}",
+])
+def test_parse_valid(expr):
+    assert dice.parse_dice(expr) is not None
+
+
+@pytest.mark.parametrize("expr", [
+    "", "   ", "d", "2d", "5", "1+2", "2d6+", "2d6++1", "2d6 1d4x", "0d6", "d0", "3d6kh4", "3d6q",
+    f"{dice.DICE_MAX_COUNT + 1}d6", f"d{dice.DICE_MAX_SIDES + 1}", "2d6>=", "abc", None,
+])
+def test_parse_invalid(expr):
+    assert dice.parse_dice(expr) is None
+
+
+def test_parse_normalises_modifiers():
+    (t,) = dice.parse_dice("4d6k3")
+    assert (t.keep, t.keep_n) == ("kh", 3)
+    (t,) = dice.parse_dice("4d6d1")
+    assert (t.keep, t.keep_n) == ("dl", 1)
+    (t,) = dice.parse_dice("d%")
+    assert (t.count, t.sides) == (1, 100)
+    (t,) = dice.parse_dice("1d1!")
+    assert not t.explode   # d1 폭발은 끝나지 않으므로 끈다
+
+
+@pytest.mark.parametrize("expr,lo,hi", [
+    ("2d6+1", 3, 13), ("3d4-2", 1, 10), ("4d6kh3", 3, 18), ("2d20kl1", 1, 20),
+    ("6d10>=7", 0, 6), ("-d4+10", 6, 9), ("d%", 1, 100), ("1d1!", 1, 1),
+])
+def test_roll_dice_in_range(expr, lo, hi):
+    for _ in range(200):
+        total, detail = dice.roll_dice(expr)
+        assert lo <= total <= hi
+        assert detail.endswith(f"= {total}")
+
+
+def test_roll_dice_large_count_uses_numpy_path_and_hides_detail():
+    n = max(dice.DICE_NUMPY_MIN, dice.DICE_DETAIL_MAX + 1)
+    total, detail = dice.roll_dice(f"{n}d6")
+    assert n <= total <= 6 * n
+    assert detail.startswith(f"[{n}d6]")
+
+
+def test_exploding_dice_can_exceed_faces():
+    assert max(dice.roll_dice("d2!")[0] for _ in range(500)) > 2
+    assert dice.roll_dice_many("d2!", 5000).max() > 2
+
+
+def test_roll_dice_rejects_invalid():
+    with pytest.raises(ValueError):
+        dice.roll_dice("2d")
+    with pytest.raises(ValueError):
+        dice.roll_dice_many("nope", 3)
+    with pytest.raises(ValueError):
+        dice.dice_cells("d0")
+
+
+def test_roll_dice_many_chunks_rows(monkeypatch):
+    monkeypatch.setattr(dice, "DICE_CHUNK_CELLS", 7)
+    totals = dice.roll_dice_many("3d6+2", 1001)
+    assert totals.shape == (1001,)
+    assert totals.min() >= 5 and totals.max() <= 20
+    assert dice.dice_cells("3d6+2d4-1") == 5
+
+
+def test_distribution_matches_known_values():
+    stats = dice.dice_stats("2d6", target=7, compare="<=")
+    assert stats["mean"] == pytest.approx(7.0)
+    assert stats["success"] == pytest.approx(21 / 36)
+    lo, pmf = dice.dice_distribution("4d6kh3")
+    assert lo == 3 and pmf.sum() == pytest.approx(1.0)
+    assert float(np.dot(np.arange(lo, lo + len(pmf)), pmf)) == pytest.approx(12.2446, abs=1e-4)
+
+
+# --- /trpg/roll/batch caps ---
+def _batch(expressions, repeat=1):
+    return asyncio.run(main.roll_batch(main.RollBatchRequest(expressions=expressions, repeat=repeat)))
+
+
+def test_batch_expression_count_cap(monkeypatch):
+    monkeypatch.setattr(main, "ROLL_BATCH_MAX", 3)
+    assert "error" in _batch(["d6"] * 4)
+    assert len(_batch(["d6"] * 3)["results"]) == 3
+
+
+@pytest.mark.parametrize("repeat", [0, -1, 11])
+def test_batch_repeat_bounds(monkeypatch, repeat):
+    monkeypatch.setattr(main, "ROLL_BATCH_MAX_REPEAT", 10)
+    assert "error" in _batch(["d6"], repeat)
+
+
+def test_batch_cell_caps_checked_before_rolling(monkeypatch):
+    monkeypatch.setattr(main, "ROLL_BATCH_MAX_CELLS", 1000)
+    monkeypatch.setattr(main, "ROLL_BATCH_MAX_TOTAL_CELLS", 1500)
+    rolled = []
+    monkeypatch.setattr(main, "roll_dice_many", lambda expr, n: rolled.append(expr) or dice.roll_dice_many(expr, n))
+
+    assert "error" in _batch(["d6", "11d6"], repeat=100)     # 표현식 하나가 1100 > 1000
+    assert "error" in _batch(["8d6", "8d6"], repeat=100)     # 합계 1600 > 1500
+    assert not rolled
+    out = _batch(["10d6", "5d6"], repeat=100)                # 1000 + 500
+    assert [r["expr"] for r in out["results"]] == ["10d6", "5d6"]
+
+
+def test_batch_reports_invalid_expression_per_item():
+    out = _batch(["d6", "bogus"], repeat=2)["results"]
+    assert "totals" in out[0] and out[1] == {"expr": "bogus", "error": "Invalid dice expression: bogus"}
+
+
+def test_batch_switches_to_histogram(monkeypatch):
+    monkeypatch.setattr(main, "ROLL_BATCH_RAW_MAX", 10)
+    raw = _batch(["2d6"], repeat=10)["results"][0]
+    assert len(raw["totals"]) == 10
+    hist = _batch(["2d6"], repeat=11)["results"][0]
+    assert "totals" not in hist and sum(hist["histogram"]["counts"]) == 11
+    wide = _batch(["d1000"], repeat=5000)["results"][0]["histogram"]
+    assert len(wide["edges"]) == main.ROLL_BATCH_HIST_BINS + 1
+
+
+def test_percent_target_extraction():
+    assert dice._extract_percent_target("관찰 판정 (35)") == 35
+    assert dice._extract_percent_target("[70%] 설득") == 70
+    assert dice._extract_percent_target("check 목표 45") == 45
+    assert dice._extract_percent_target("그냥 걷는다 (35)") == 35
+    assert dice._extract_percent_target("판정 (150)") is None
+    assert dice._extract_percent_target("숫자 없음") is None
+
+
+def test_infer_roll_priority():
+    explicit = dice.infer_roll_from_texts("단검으로 찌른다 2d6+1", "d100")
+    assert explicit["expr"] == "2d6+1"
+    hinted = dice.infer_roll_from_texts("단검으로 찌른다", "d100")
+    assert hinted["expr"] == "d100"
+    contextual = dice.infer_roll_from_texts("단검으로 찌른다")
+    assert contextual["expr"] == "d4"
+    assert dice.infer_roll_from_texts("조용히 앉아 있는다") is None
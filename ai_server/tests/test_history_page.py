@@ -0,0 +1,130 @@
+import pytest
+
+import main
+import stores
+from conftest import make_state
+from models import _line_act_speaker
+
+SPEAKERS = ["사회자", "민수", "지아"]
+
+
+def _lines(n: int) -> list[str]:
+    out = []
+    for i in range(n):
+        if i % 25 == 0:
+            out.append(f"Act {i // 25 + 1} scene: 장면 {i}")
+        elif i % 7 == 0:
+            out.append(f"플레이어 입력 {i}")   # 접두어 없는 줄 → speaker ""
+        else:
+            out.append(f"{SPEAKERS[i % 3]}: 대사 {i}")
+    return out
+
+
+def _rows(lines: list[str]) -> list[dict]:
+    rows, act = [], 0
+    for i, line in enumerate(lines):
+        act, speaker = _line_act_speaker(line, act)
+        rows.append({"index": i, "act": act, "speaker": speaker, "text": line})
+    return rows
+
+
+@pytest.fixture
+def session(sess_dir, monkeypatch):
+    """120 lines: [0, 50) and [50, 90) archived in two segments, [90, 120) hot."""
+    monkeypatch.setattr(main, "history_indexes", main.HistoryIndexCache())
+    lines = _lines(120)
+    stores._write_archive_segment("s", 0, lines[:50])
+    stores._write_archive_segment("s", 50, lines[50:90])
+    state = make_state(0)
+    state.add_history(*lines)
+    state.compact(90, _rows(lines)[89]["act"], [])
+    return state, _rows(lines)
+
+
+def _page(state, **kw):
+    return main.history_page("s", state.archived_lines, state.history, state.history_meta(), **kw)
+
+
+def _matching(rows, act=None, speaker=None):
+    return [r for r in rows if (act is None or r["act"] == act) and (speaker is None or r["speaker"] == speaker)]
+
+
+def test_latest_page(session):
+    state, rows = session
+    page = _page(state, limit=10)
+    assert page["items"] == rows[-10:]
+    assert page["prev_cursor"] == 110 and page["next_cursor"] is None
+    assert page["total_lines"] == page["matched"] == 120
+
+
+@pytest.mark.parametrize("before", [1, 5, 50, 51, 85, 90, 95, 120])
+def test_before_cursor(session, before):
+    state, rows = session
+    page = _page(state, before=before, limit=10)
+    assert page["items"] == rows[max(before - 10, 0):before]
+    assert page["prev_cursor"] == (before - 10 if before > 10 else None)
+    assert page["next_cursor"] == (before - 1 if before < 120 else None)
+
+
+@pytest.mark.parametrize("after", [-1, 0, 39, 49, 80, 89, 100, 109])
+def test_after_cursor(session, after):
+    state, rows = session
+    page = _page(state, after=after, limit=10)
+    assert page["items"] == rows[after + 1:after + 11]
+    assert page["prev_cursor"] == (after + 1 if after >= 0 else None)
+    assert page["next_cursor"] == (after + 10 if after + 11 < 120 else None)
+
+
+def test_edges_are_empty(session):
+    state, _ = session
+    first = _page(state, before=0)
+    assert first["items"] == [] and first["prev_cursor"] is None and first["next_cursor"] == -1
+    last = _page(state, after=119)
+    assert last["items"] == [] and last["next_cursor"] is None and last["prev_cursor"] == 120
+
+
+@pytest.mark.parametrize("act,speaker", [(None, None), (2, None), (None, "민수"), (3, "지아"), (None, ""),
+                                         (None, "scene"), (9, None), (None, "없는 사람")])
+def test_walks_cover_every_match_in_order(session, act, speaker):
+    state, rows = session
+    want = _matching(rows, act, speaker)
+
+    got, page = [], _page(state, limit=7, act=act, speaker=speaker)
+    while True:
+        got[:0] = page["items"]
+        assert page["matched"] == len(want)
+        if page["prev_cursor"] is None:
+            break
+        page = _page(state, before=page["prev_cursor"], limit=7, act=act, speaker=speaker)
+    assert got == want
+
+    got, page = [], _page(state, after=-1, limit=7, act=act, speaker=speaker)
+    while True:
+        got.extend(page["items"])
+        if page["next_cursor"] is None:
+            break
+        page = _page(state, after=page["next_cursor"], limit=7, act=act, speaker=speaker)
+    assert got == want
+
+
+def test_limit_larger_than_history(session):
+    state, rows = session
+    assert _page(state, limit=1000)["items"] == rows
+    assert _page(state, after=-1, limit=1000)["next_cursor"] is None
+
+
+def test_unapplied_segment_is_not_served(session):
+    # compaction이 segment를 썼지만 아직 state에 적용하기 전: archived 경계 뒤는 hot history에서 읽는다
+    state, rows = session
+    stores._write_archive_segment("s", 90, state.history[:10])
+    page = _page(state, before=100, limit=15)
+    assert page["items"] == rows[85:100]
+    assert page["matched"] == 120
+
+
+def test_no_archive(sess_dir):
+    state = make_state(0)
+    state.add_history(*_lines(12))
+    page = main.history_page("fresh", 0, state.history, state.history_meta(), limit=5)
+    assert [r["index"] for r in page["items"]] == list(range(7, 12))
+    assert page["prev_cursor"] == 7
@@ -0,0 +1,157 @@
+import asyncio
+import json
+
+import main
+import stores
+from conftest import make_state
+
+
+def _dump(state):
+    return {**state.model_dump(), "_seq": state._seq}
+
+
+def test_first_save_is_snapshot_then_deltas_append(sess_dir):
+    state = make_state(3)
+    stores.save_session("s", state)
+    assert stores._sess_path("s").exists()
+    assert stores._journal_path("s").read_text(encoding="utf-8") == ""
+
+    state.add_history("사회자: 문이 열린다", "민수: 들어간다")
+    state.set_act(2)
+    stores.save_session("s", state)
+    ops = [json.loads(l) for l in stores._journal_path("s").read_text(encoding="utf-8").splitlines()]
+    assert [op["op"] for op in ops] == ["history", "act"]
+    assert [op["seq"] for op in ops] == [state._seq - 1, state._seq]
+
+    loaded = stores.load_session("s")
+    assert _dump(loaded) == _dump(state)
+    assert loaded._journal_records == 2
+
+
+def test_replay_skips_records_folded_into_snapshot(sess_dir):
+    state = make_state(2)
+    stores.save_session("s", state)
+    state.add_history("민수: 하나")
+    stores.save_session("s", state)
+    stale = stores._journal_path("s").read_text(encoding="utf-8")
+
+    # 스냅샷 교체 후 journal을 비우기 전에 죽은 경우: 이미 접힌 record가 journal에 남아 있다
+    state._snapshotted = False
+    stores.save_session("s", state)
+    stores._journal_path("s").write_text(stale, encoding="utf-8")
+
+    loaded = stores.load_session("s")
+    assert loaded.history == state.history
+    assert loaded._seq == state._seq
+
+
+def test_torn_journal_tail_is_ignored_and_forces_snapshot(sess_dir):
+    state = make_state(1)
+    stores.save_session("s", state)
+    state.add_history("민수: 온전한 줄")
+    stores.save_session("s", state)
+    with stores._journal_path("s").open("a", encoding="utf-8") as f:
+        f.write('{"seq": 99, "op": "history", "lin')
+
+    loaded = stores.load_session("s")
+    assert loaded.history == state.history
+    assert loaded._snapshotted is False
+    loaded.add_history("민수: 다음 줄")
+    stores.save_session("s", loaded)
+    assert stores._journal_path("s").read_text(encoding="utf-8") == ""
+    assert stores.load_session("s").history == loaded.history
+
+
+def test_overlapping_seq_is_applied_and_resnapshotted(sess_dir):
+    state = make_state(0)
+    stores.save_session("s", state)
+    # CAS 이전에 두 worker가 같은 base에서 append한 journal: seq가 겹친다
+    base = state._seq
+    lines = [
+        json.dumps({"seq": base + 1, "op": "history", "lines": ["A: 1"]}),
+        json.dumps({"seq": base + 1, "op": "history", "lines": ["B: 1"]}),
+    ]
+    stores._journal_path("s").write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    loaded = stores.load_session("s")
+    assert loaded.history == ["A: 1", "B: 1"]
+    assert loaded._snapshotted is False
+
+
+def test_long_journal_is_compacted_into_snapshot(sess_dir, monkeypatch):
+    monkeypatch.setattr(stores, "SESSION_SNAPSHOT_EVERY", 3)
+    state = make_state(0)
+    stores.save_session("s", state)
+    for i in range(3):
+        state.add_history(f"민수: {i}")
+        stores.save_session("s", state)
+    assert len(stores._journal_path("s").read_text(encoding="utf-8").splitlines()) == 3
+
+    state.add_history("민수: 3")
+    stores.save_session("s", state)
+    assert stores._journal_path("s").read_text(encoding="utf-8") == ""
+    assert json.loads(stores._sess_path("s").read_text(encoding="utf-8"))["history"] == state.history
+    assert _dump(stores.load_session("s")) == _dump(state)
+
+
+def test_binary_snapshot_with_json_journal(sess_dir, monkeypatch):
+    monkeypatch.setattr(stores, "encode_session_payload",
+                        lambda payload, codec="binary", indent=None: stores.encode_snapshot(payload))
+    state = make_state(40)
+    stores.save_session("s", state)
+    assert stores._snap_path("s").exists() and not stores._sess_path("s").exists()
+    state.add_history("민수: 마지막")
+    state.set_intro_done(True)
+    stores.save_session("s", state)
+
+    assert _dump(stores.load_session("s")) == _dump(state)
+    peek = stores.peek_session("s", tail=3)
+    assert peek["recent_history"] == state.history[-3:]
+    assert peek["scene_intro_done"] is True
+
+
+def test_compact_op_replays(sess_dir):
+    state = make_state(10)
+    stores.save_session("s", state)
+    state.compact(6, 1, [{"act": 1, "start": 0, "end": 6, "core": {"facts": ["f"]}}])
+    stores.save_session("s", state)
+
+    loaded = stores.load_session("s")
+    assert loaded.archived_lines == 6
+    assert loaded.history == [f"민수: 대사 {i}" for i in range(6, 10)]
+    assert loaded.summary_tree["1"]["core"]["facts"] == ["f"]
+    assert loaded.total_lines == 10
+
+
+def test_compact_history_archives_and_summarises(sess_dir, monkeypatch):
+    cache = stores.SessionCache()
+    monkeypatch.setattr(stores, "sessions", cache)
+    monkeypatch.setattr(main, "sessions", cache)
+    monkeypatch.setattr(main, "HISTORY_HOT_MAX", 10)
+    monkeypatch.setattr(main, "HISTORY_HOT_KEEP", 4)
+    calls = []
+
+    async def fake_extract(lines, toks):
+        calls.append(list(lines))
+        return {"facts": [lines[0]]}
+
+    monkeypatch.setattr(main, "_aextract_core_strict", fake_extract)
+    lines = ["Act 1 scene: 부두"] + [f"민수: {i}" for i in range(5)] + ["Act 2 scene: 창고"] + [f"민수: {i}" for i in range(5, 12)]
+    state = make_state(0)
+    state.add_history(*lines)
+    cache.put("s", state)
+
+    assert asyncio.run(main.compact_history("s")) is True
+    n = len(lines) - 4
+    assert state.archived_lines == n
+    assert state.history == lines[n:]
+    assert state.archived_act == 2
+    assert [(s["start"], s["end"]) for s in state.summary_tree["1"]["scenes"]] == [(0, 6)]
+    assert [(s["start"], s["end"]) for s in state.summary_tree["2"]["scenes"]] == [(6, n)]
+    assert calls[0][0] == "Act 1 scene: 부두"
+    assert stores.load_archived_lines("s", 0, n) == lines[:n]
+
+    cache.flush_all()
+    loaded = stores.load_session("s")
+    assert loaded.archived_lines == n and loaded.history == lines[n:]
+    assert asyncio.run(main.compact_history("s")) is False
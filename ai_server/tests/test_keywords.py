@@ -0,0 +1,98 @@
+import json
+import random
+import re
+
+import pytest
+
+import dice
+
+
+def _regex_expr(buckets, text):
+    """The matcher KeywordAutomaton replaced: one alternation per bucket, first matching bucket wins."""
+    for _, expr, keywords in buckets:
+        kws = [k.lower() for k in keywords if k]
+        if kws and re.search("|".join(map(re.escape, kws)), text):
+            return expr
+    return None
+
+
+def _corpus(buckets, n=3000, seed=7):
+    keywords = [k.lower() for _, _, kws in buckets for k in kws]
+    alphabet = sorted({ch for k in keywords for ch in k}) + [" ", "a", "!", "의"]
+    rng = random.Random(seed)
+    texts = list(keywords)
+    texts += [f"{a} 그리고 {b}" for a, b in zip(keywords, reversed(keywords))]
+    for _ in range(n):
+        parts = []
+        for _ in range(rng.randint(1, 6)):
+            if rng.random() < 0.3:
+                kw = rng.choice(keywords)
+                cut = rng.randint(1, len(kw))
+                parts.append(kw[:cut] if rng.random() < 0.5 else kw)  # 키워드 앞부분만 (부분 일치 함정)
+            else:
+                parts.append("".join(rng.choice(alphabet) for _ in range(rng.randint(1, 5))))
+        texts.append("".join(parts))
+    return texts
+
+
+def test_default_buckets_match_regex():
+    buckets = dice._DEFAULT_DICE_BUCKETS
+    automaton = dice.KeywordAutomaton(buckets)
+    for text in _corpus(buckets):
+        assert automaton.expr_for(text) == _regex_expr(buckets, text), text
+
+
+def test_overlapping_keywords_match_regex():
+    # 접두/접미가 겹치는 키워드: 실패 링크 경로에서 출력이 합쳐지는지
+    buckets = [
+        ("low", "d4", ["abcd", "bcx"]),
+        ("mid", "d6", ["bc", "cab"]),
+        ("high", "d8", ["c", "aaab"]),
+    ]
+    automaton = dice.KeywordAutomaton(buckets)
+    rng = random.Random(3)
+    for _ in range(3000):
+        text = "".join(rng.choice("abcx") for _ in range(rng.randint(0, 12)))
+        assert automaton.expr_for(text) == _regex_expr(buckets, text), text
+
+
+@pytest.mark.parametrize("text,expr", [
+    ("단검으로 벤다", "d4"),
+    ("회피", "d6"),                    # combat_mid가 physical_light보다 먼저
+    ("정신력으로 버틴다", "d10"),       # mental_core가 physical_heavy(버티)보다 먼저
+    ("SAN 체크", "d10"),
+    ("", None),
+    ("평범한 하루", None),
+])
+def test_bucket_priority(text, expr):
+    assert dice._contextual_dice_expr(text) == expr
+
+
+def test_empty_and_blank_keywords_are_ignored():
+    automaton = dice.KeywordAutomaton([("x", "d4", ["", "칼"])])
+    assert automaton.expr_for("아무것도") is None
+    assert automaton.expr_for("칼") == "d4"
+
+
+def test_registry_per_world_sets_and_reload(tmp_path, monkeypatch):
+    monkeypatch.setattr(dice, "DICE_KEYWORDS_RELOAD", 0)
+    registry = dice.DiceKeywordRegistry(tmp_path)
+    fantasy = {"world": "판타지 왕국"}
+    assert registry.for_core(fantasy).expr_for("마법을 쓴다") is None
+
+    (tmp_path / "fantasy.json").write_text(json.dumps({
+        "match": ["판타지"],
+        "buckets": {"combat_heavy": ["도끼"], "magic": {"expr": "d12", "keywords": ["마법"]},
+                    "broken": {"expr": "not dice", "keywords": ["무시"]}},
+    }), encoding="utf-8")
+    automaton = registry.for_core(fantasy)
+    assert automaton.expr_for("마법을 쓴다") == "d12"
+    assert automaton.expr_for("도끼를 휘두른다") == "d8"
+    assert automaton.expr_for("무시") is None
+    assert registry.for_core({"world": "현대 도시"}).expr_for("마법") is None
+
+    (tmp_path / "default.json").write_text(json.dumps({"replace": True, "buckets": {"only": {"expr": "d3", "keywords": ["돌"]}}}),
+                                           encoding="utf-8")
+    assert registry.for_core(None).expr_for("단검") is None
+    assert registry.for_core(None).expr_for("돌을 던진다") == "d3"
+    assert registry.for_core(fantasy).expr_for("돌") == "d3"   # world 세트도 default 위에 쌓인다
@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+import stores
+from conftest import make_state
+
+
+@pytest.fixture
+def cache(sess_dir):
+    return stores.SessionCache(max_size=2, ttl=60)
+
+
+def test_put_is_write_back_until_flush(cache):
+    state = make_state(2)
+    cache.put("a", state)
+    assert stores.load_session("a") is None
+    assert "a" in cache._dirty
+
+    cache.flush_all()
+    assert not cache._dirty
+    assert stores.load_session("a").history == state.history
+    assert cache.get("a") is state
+
+
+def test_lru_eviction_flushes_dirty_session_outside_loop(cache):
+    for sid in "abc":
+        cache.put(sid, make_state(1))
+    assert list(cache._items) == ["b", "c"]
+    # 이벤트 루프 밖: 밀려난 dirty 세션은 바로 기록된다
+    assert "a" not in cache and not cache._evicted
+    assert stores.load_session("a") is not None
+
+
+def test_get_refreshes_lru_order(cache):
+    cache.put("a", make_state())
+    cache.put("b", make_state())
+    cache.get("a")
+    cache.put("c", make_state())
+    assert list(cache._items) == ["a", "c"]
+
+
+def test_evicted_dirty_session_is_revived_before_write(cache):
+    async def run():
+        a = make_state(1)
+        cache.put("a", a)
+        cache.put("b", make_state())
+        cache.put("c", make_state())
+        assert "a" in cache and "a" in cache._evicted
+        assert len(cache) == 2
+        # 기록 task가 돌기 전에 다시 요청 → 디스크가 아니라 메모리의 최신본
+        assert await cache.aget("a") is a
+        assert "a" in cache._dirty
+        await cache.aflush_all()
+        return a
+
+    a = asyncio.run(run())
+    assert not cache._evicted and not cache._dirty
+    assert stores.load_session("a").history == a.history
+
+
+def test_evicted_session_written_by_background_task(cache):
+    async def run():
+        for sid in "abc":
+            cache.put(sid, make_state(1))
+        await cache._evict_task
+        assert not cache._evicted
+
+    asyncio.run(run())
+    assert stores.load_session("a") is not None
+    assert stores.load_session("b") is None  # 아직 dirty로 캐시에 있음
+
+
+def test_failed_evicted_write_is_retried(cache, monkeypatch):
+    real = stores._write_cas
+    fail = {"on": True}
+
+    def flaky(*args):
+        if fail["on"]:
+            raise OSError("disk full")
+        return real(*args)
+
+    monkeypatch.setattr(stores, "_write_cas", flaky)
+
+    async def run():
+        for sid in "abc":
+            cache.put(sid, make_state(1))
+        await cache._evict_task
+        assert "a" in cache._evicted
+        fail["on"] = False
+        await cache.aflush_all()
+
+    asyncio.run(run())
+    assert not cache._evicted
+    assert stores.load_session("a").history == make_state(1).history
+
+
+def test_expire_drops_idle_sessions(sess_dir):
+    cache = stores.SessionCache(max_size=10, ttl=0)
+    cache.put("a", make_state(1))
+    cache.expire()
+    assert len(cache) == 0
+    assert stores.load_session("a") is not None
+
+
+def test_mark_dirty_ignores_unknown_session(cache):
+    cache.mark_dirty("missing")
+    assert not cache._dirty
+
+
+def test_miss_loads_from_store(cache):
+    state = make_state(3)
+    stores.save_session("a", state)
+    loaded = asyncio.run(cache.aget("a"))
+    assert loaded.history == state.history
+    assert "a" in cache and "a" not in cache._dirty
+    assert asyncio.run(cache.aget("nope")) is None